@@ -3,6 +3,9 @@ from authlib.integrations.flask_client import OAuth
 import os
 from app.services.param_store import get_param
 from app.services.secrets import get_secret
+from app.services import s3, ddb, worker_client
+from app.utils.lazy import lazy, warm_up
+from app.utils import metrics
 
 print("[DEBUG] Starting application…")
 
@@ -13,25 +16,36 @@ app = Flask(
     static_folder=os.path.join(BASE_DIR, "app", "static")
 )
 app.secret_key = os.urandom(24)
-
-# --- Cognito Config ---
-COGNITO_USER_POOL_ID = get_param("/n11326158/cognito/COGNITO_USER_POOL_ID")
-COGNITO_CLIENT_ID = get_param("/n11326158/cognito/COGNITO_CLIENT_ID")
-COGNITO_CLIENT_SECRET = get_secret()
-COGNITO_DOMAIN_URL = get_param("/n11326158/cognito/DOMAIN_URL")
+metrics.init_app(app, "api")
 
 # --- OAuth setup ---
 oauth = OAuth(app)
 app.oauth = oauth
 
-oauth.register(
-    name="oidc",
-    client_id=COGNITO_CLIENT_ID,
-    client_secret=COGNITO_CLIENT_SECRET,
-    server_metadata_url=f"{COGNITO_DOMAIN_URL}/{COGNITO_USER_POOL_ID}/.well-known/openid-configuration",
-    client_kwargs={"scope": "openid profile email"},
-)
-print("[DEBUG] Cognito OAuth provider registered")
+
+@lazy
+def oidc():
+    """Register the Cognito provider on first use, so SSM and Secrets Manager
+    aren't on the startup path."""
+    user_pool_id = get_param("/n11326158/cognito/COGNITO_USER_POOL_ID")
+    domain_url = get_param("/n11326158/cognito/DOMAIN_URL")
+    oauth.register(
+        name="oidc",
+        client_id=get_param("/n11326158/cognito/COGNITO_CLIENT_ID"),
+        client_secret=get_secret(),
+        server_metadata_url=f"{domain_url}/{user_pool_id}/.well-known/openid-configuration",
+        client_kwargs={"scope": "openid profile email"},
+    )
+    print("[DEBUG] Cognito OAuth provider registered")
+    return oauth.oidc
+
+
+app.oidc = oidc
+
+
+def load_oidc_metadata():
+    return oidc().load_server_metadata()
+
 
 # --- Root redirect ---
 @app.route("/")
@@ -54,6 +68,9 @@ app.register_blueprint(process_forward_bp, url_prefix="/process")
 
 print("[DEBUG] Registered blueprints: auth, client, upload, results, process_forward")
 
+# --- Background warm-up ---
+warm_up(s3.client, s3.bucket, ddb.uploads_table, ddb.results_table, worker_client.session, load_oidc_metadata)
+
 # --- Health check ---
 @app.route("/health")
 def health():
@@ -18,7 +18,7 @@ def login():
 
     print(f"[DEBUG] Using redirect URI: {redirect_uri}")
 
-    response = current_app.oauth.oidc.authorize_redirect(
+    response = current_app.oidc().authorize_redirect(
         redirect_uri,
         prompt="login"
     )
@@ -28,7 +28,7 @@ def login():
 @auth_bp.route("/authorize")
 def authorize():
     """Handle callback from Cognito."""
-    token = current_app.oauth.oidc.authorize_access_token()
+    token = current_app.oidc().authorize_access_token()
     user = token.get("userinfo") or {}
 
     def _decode_jwt(jwt):
@@ -70,14 +70,14 @@ def logout():
     """Log out user and redirect to Cognito Hosted UI logout."""
     session.clear()
 
-    authz = current_app.oauth.oidc.server_metadata.get("authorization_endpoint")
+    authz = current_app.oidc().server_metadata.get("authorization_endpoint")
     hosted_base = (
         authz.split("/oauth2/authorize")[0]
         if authz
         else get_param("/n11326158/cognito/HOSTED_UI_URL")
     )
 
-    client_id = getattr(current_app.oauth.oidc, "client_id", None)
+    client_id = getattr(current_app.oidc(), "client_id", None)
 
     if os.environ.get("FLASK_ENV") == "production":
         post_logout = get_param("/n11326158/app/POST_LOGOUT_URI_PROD")
@@ -1,14 +1,21 @@
+import io
 import os
 import time
 import uuid
-import shutil
-import tempfile
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor
 from flask import Blueprint, request, jsonify, session
-from PIL import Image, ImageFilter, ImageOps
-from app.services import s3, ddb
+from PIL import Image
+from app.services import s3, ddb, result_cache, source_cache, executor
+from app.utils.planner import canonical_operations, compile_plan, decode_reduction, rebase_plan
+from app.utils import tiling, thumbnails, metrics, keys, encoding, decode, animation
 
 process_bp = Blueprint("process", __name__)
 
+MAX_BATCH_JOBS = int(os.environ.get("MAX_BATCH_JOBS", 50))
+# Sources a batch decodes at once; each holds a full decoded image in memory
+BATCH_SOURCE_CONCURRENCY = max(1, int(os.environ.get("BATCH_SOURCE_CONCURRENCY", executor.POOL_SIZE)))
+
 
 def unique_filename(prefix, original_name):
     """Generate a unique filename with timestamp and UUID."""
@@ -18,75 +25,361 @@ def unique_filename(prefix, original_name):
     return candidate
 
 
-@process_bp.route("/", methods=["POST"])
-def process_image():
-    """Handle image processing requests from the API service."""
-    print("[DEBUG] /process route hit (POST)")
-    data = request.json
-    print(f"[DEBUG] Incoming request data: {data}")
+def save_result(filename, result, username):
+    """Write the DynamoDB record for a finished result (as returned by render_result)."""
+    return ddb.save_result_metadata(
+        filename,
+        os.path.basename(result["key"]),
+        {
+            "username": username,
+            "role": "admin" if username == "admin1" else "user"
+        },
+        thumbnails.thumbnail_key(result["key"]),
+        result["key"],
+        result["format"],
+        result["size_bytes"]
+    )
+
+
+def find_source(filename, owner):
+    """(key, ETag) of an upload: the object behind the owner's newest record
+    for it (usually in the content store), else the owner's folder and the
+    legacy flat layout; (None, None) if it doesn't exist."""
+    records = sorted(ddb.find_uploads(owner, filename), key=lambda r: r.get("timestamp", 0), reverse=True)
+    candidates = [keys.record_key(r) for r in records]
+    candidates += [keys.upload_key(owner, filename), keys.legacy_key(keys.UPLOADS, filename)]
+    for key in dict.fromkeys(candidates):
+        etag = s3.get_etag(key)
+        if etag:
+            return key, etag
+    return None, None
+
+
+def cached_result(etag, operations):
+    """Return (cache key, existing result or None) for a job."""
+    key = result_cache.cache_key(etag, operations) if etag else None
+    cached = result_cache.results.get(key) if key else None
+    if cached and not s3.get_etag(cached["key"]):
+        result_cache.results.invalidate(key)
+        cached = None
+    return key, cached
+
+
+def claim_result(cached, filename, username):
+    """Copy a cached result (and its thumbnail) into `username`'s results
+    folder, so every record owns the object it points at and deleting one
+    never breaks another."""
+    base = os.path.splitext(filename)[0]
+    ext = os.path.splitext(cached["key"])[1]
+    out_key = keys.result_key(username, unique_filename("processed", base + ext))
+    s3.copy_object(cached["key"], out_key)
+    try:
+        s3.copy_object(thumbnails.thumbnail_key(cached["key"]), thumbnails.thumbnail_key(out_key))
+    except Exception as e:
+        print(f"[WARN] No thumbnail copied for {out_key}: {e}")
+    return dict(cached, key=out_key)
+
+
+def reduction(plans_for, size, mode):
+    """Largest decode reduction every plan for a `size` source allows."""
+    return min((decode_reduction(plan, size) for plan in plans_for(size, mode)), default=1)
+
 
+def decode_source(src, plans_for):
+    """Open and decode a source at the smallest resolution every plan allows.
+
+    `plans_for(size, mode)` returns the compiled plans the source will be
+    rendered with. Animated sources come back as an animation.Animation
+    holding every frame. Returns (image, full-resolution size).
+    """
+    with metrics.timer("decode"):
+        img = Image.open(src)
+        size = img.size
+        if animation.is_animated(img):
+            # Every frame is expanded to RGBA, so refuse before decoding any
+            if animation.source_bytes(img) > tiling.MEMORY_BUDGET:
+                raise tiling.MemoryBudgetExceeded(
+                    f"{img.n_frames} frames of {img.width}x{img.height} need more than "
+                    f"{tiling.MEMORY_BUDGET // tiling.MB} MB"
+                )
+            return animation.decode(img), size
+        return decode.load(img, reduction(plans_for, size, img.mode)), size
+
+
+def covers(entry, plans_for):
+    """Whether a cached decode is at least as detailed as the plans need."""
+    img, size = entry["value"], entry["size"]
+    if isinstance(img, animation.Animation):
+        return True
+    factor = reduction(plans_for, size, img.mode)
+    return img.width >= size[0] // factor and img.height >= size[1] // factor
+
+
+def load_source(s3_key, etag, plans_for):
+    """Decode the source at `s3_key`, going through the worker's source cache.
+
+    In "decoded" mode a cached image for the same ETag is reused when it
+    covers the plans' resolution; in "raw" mode only the download is
+    skipped. Returns (image, full-resolution size) like decode_source.
+    """
+    cache = source_cache.sources
+    if etag and cache.mode == "decoded":
+        entry = cache.get(s3_key, etag, lambda e: covers(e, plans_for))
+        if entry:
+            print(f"[DEBUG] Source cache hit for {s3_key}")
+            return entry["value"], entry["size"]
+    elif etag and cache.mode == "raw":
+        entry = cache.get(s3_key, etag)
+        if entry:
+            print(f"[DEBUG] Source cache hit for {s3_key}")
+            return decode_source(io.BytesIO(entry["value"]), plans_for)
+
+    with s3.download_fileobj_from_s3(s3_key) as src:
+        if etag and cache.mode == "raw" and cache.admits(src.seek(0, io.SEEK_END)):
+            src.seek(0)
+            data = src.read()
+            cache.put(s3_key, etag, data, len(data))
+        src.seek(0)
+        img, size = decode_source(src, plans_for)
+    if etag and cache.mode == "decoded":
+        cache.put(s3_key, etag, img, source_cache.image_bytes(img), size)
+    return img, size
+
+
+def render_result(img, filename, operations, username, size=None):
+    """Render one operation set on a decoded source and upload it into the
+    user's results folder.
+
+    `size` is the source's full resolution when `img` is a reduced decode.
+    Returns {key, format, size_bytes} for the stored result.
+    """
+    size = size or img.size
+    plan = compile_plan(operations, size, img.mode)
+    if img.size != size:
+        plan = rebase_plan(plan, size)
+    base, ext = os.path.splitext(filename)
+    out_format = Image.registered_extensions()[ext.lower()]
+    with s3.spooled_buffer() as out:
+        if isinstance(img, animation.Animation):
+            used_format, thumb = executor.render_animation(img, plan, out, operations.get("output"))
+        else:
+            # Huge outputs are rendered in bands and always come back as PNG
+            used_format, thumb = executor.submit(img, plan, out_format, out, operations.get("output"))
+        size_bytes = out.tell()
+        if used_format != out_format:
+            ext = encoding.EXTENSIONS.get(used_format, ext)
+        out_key = keys.result_key(username, unique_filename("processed", base + ext))
+        s3.upload_fileobj_to_s3(out, out_key, Image.MIME.get(used_format))
+    s3.upload_fileobj_to_s3(
+        io.BytesIO(thumb), thumbnails.thumbnail_key(out_key), thumbnails.content_type()
+    )
+    print(f"[DEBUG] Stored {used_format} result {out_key}: {size_bytes} bytes")
+    return {"key": out_key, "format": used_format, "size_bytes": size_bytes}
+
+
+def run_job(data):
+    """Process one {filename, operations, username[, owner]} job and return (body, status).
+
+    The source is read from `owner`'s uploads (the requester's by default).
+    """
     filename = data.get("filename")
-    operations = data.get("operations", {})
+    username = data.get("username")
 
     if not filename:
-        return jsonify({"error": "Filename required"}), 400
-
-    s3_input_key = f"uploads/{filename}"
-    tmp_dir = tempfile.mkdtemp()
-    tmp_in = os.path.join(tmp_dir, filename)
+        return {"error": "Filename required"}, 400
+    try:
+        operations = canonical_operations(data.get("operations", {}))
+    except ValueError as e:
+        return {"error": str(e)}, 400
 
     try:
-        s3.download_file_from_s3(s3_input_key, tmp_in)
-        img = Image.open(tmp_in)
-        print(f"[DEBUG] Opened image: size={img.size}, mode={img.mode}")
-
-        if "rotate" in operations:
-            img = img.rotate(float(operations["rotate"]), expand=True)
-        if "blur" in operations:
-            img = img.filter(ImageFilter.GaussianBlur(radius=float(operations["blur"])))
-        if "resize" in operations:
-            w = int(operations["resize"].get("width", img.width))
-            h = int(operations["resize"].get("height", img.height))
-            img = img.resize((w, h))
-        if "upscale" in operations:
-            factor = float(operations["upscale"])
-            img = img.resize((int(img.width * factor), int(img.height * factor)))
-        if operations.get("grayscale"):
-            img = ImageOps.grayscale(img)
-        if "flip" in operations:
-            flip_type = operations["flip"].lower()
-            if flip_type == "horizontal":
-                img = ImageOps.mirror(img)
-            elif flip_type == "vertical":
-                img = ImageOps.flip(img)
-
-        out_name = unique_filename("processed", filename)
-        tmp_out = os.path.join(tmp_dir, out_name)
-        img.save(tmp_out)
-
-        s3_key = f"results/{out_name}"
-        s3.upload_file_to_s3(tmp_out, s3_key)
-
-        user = session.get("user", {})
-        record = ddb.save_result_metadata(
-            filename,
-            out_name,
-            {
-                "username": user.get("cognito:username"),
-                "role": "admin" if user.get("cognito:username") == "admin1" else "user"
-            }
-        )
-        record["s3_key"] = s3_key
-
-        return jsonify({
+        s3_input_key, etag = find_source(filename, data.get("owner") or username)
+        if not s3_input_key:
+            return {"error": f"Source {filename} not found"}, 404
+
+        key, cached = cached_result(etag, operations)
+        if cached:
+            print(f"[DEBUG] Result cache hit for {filename}: {cached}")
+            result = claim_result(cached, filename, username)
+            return {
+                "message": f"Processed {filename}",
+                "result": os.path.basename(result["key"]),
+                "metadata": save_result(filename, result, username),
+                "cached": True
+            }, 200
+
+        img, size = load_source(s3_input_key, etag, lambda size, mode: [compile_plan(operations, size, mode)])
+        print(f"[DEBUG] Opened image: size={size}, decoded={img.size}, mode={img.mode}")
+
+        result = render_result(img, filename, operations, username, size)
+        if key:
+            result_cache.results.put(key, result)
+
+        record = save_result(filename, result, username)
+
+        return {
             "message": f"Processed {filename}",
-            "result": out_name,
+            "result": record["output"],
             "metadata": record
-        }), 200
+        }, 200
+
+    except tiling.MemoryBudgetExceeded as e:
+        print(f"[DEBUG] Job over memory budget: {e}")
+        return {"error": f"Output too large: {str(e)}"}, 413
 
     except Exception as e:
         print(f"[DEBUG] Processing failed: {e}")
-        return jsonify({"error": f"Processing failed: {str(e)}"}), 500
+        return {"error": f"Processing failed: {str(e)}"}, 500
+
+
+def run_source_group(filename, jobs, owner, username):
+    """Run every job for one source, downloading and decoding it at most once.
+
+    `jobs` is a list of (index, canonical operations); returns a list of
+    (index, result or None, error or None).
+    """
+    outcomes, pending = [], []
+    s3_input_key, etag = find_source(filename, owner)
+    if not s3_input_key:
+        return [(i, None, "Source not found") for i, _ in jobs]
+
+    for i, operations in jobs:
+        key, cached = cached_result(etag, operations)
+        if cached:
+            try:
+                outcomes.append((i, claim_result(cached, filename, username), None))
+            except Exception as e:
+                print(f"[DEBUG] Batch job {i} failed: {e}")
+                outcomes.append((i, None, str(e)))
+        else:
+            pending.append((i, operations, key))
+    if not pending:
+        return outcomes
+
+    img, size = load_source(
+        s3_input_key, etag,
+        lambda size, mode: [compile_plan(operations, size, mode) for _, operations, _ in pending]
+    )
+    print(f"[DEBUG] Batch source {filename}: size={size}, decoded={img.size}, mode={img.mode}, jobs={len(pending)}")
+    # Animations are shared as-is; their frames go to the pool per job
+    source = nullcontext(img) if isinstance(img, animation.Animation) else executor.SharedImage(img)
+    with source as shared, ThreadPoolExecutor(len(pending)) as threads:
+        futures = [
+            (i, key, threads.submit(metrics.collected, render_result, shared, filename, operations, username, size))
+            for i, operations, key in pending
+        ]
+        for i, key, future in futures:
+            try:
+                result, timings = future.result()
+                metrics.merge(timings)
+            except Exception as e:
+                print(f"[DEBUG] Batch job {i} failed: {e}")
+                outcomes.append((i, None, str(e)))
+                continue
+            if key:
+                result_cache.results.put(key, result)
+            outcomes.append((i, result, None))
+    return outcomes
+
+
+def run_batch(data):
+    """Process a {jobs: [{filename, operations}], username[, owner]} batch and return (body, status)."""
+    jobs = data.get("jobs") or []
+    username = data.get("username")
+    owner = data.get("owner") or username
+
+    if not jobs:
+        return {"error": "No jobs given"}, 400
+    if not isinstance(jobs, list) or any(not isinstance(job, dict) for job in jobs):
+        return {"error": "Jobs must be a list of {filename, operations} objects"}, 400
+    if len(jobs) > MAX_BATCH_JOBS:
+        return {"error": f"At most {MAX_BATCH_JOBS} jobs per batch"}, 400
+    if any(not job.get("filename") or not isinstance(job["filename"], str) for job in jobs):
+        return {"error": "Filename required for every job"}, 400
+
+    groups = {}
+    try:
+        for i, job in enumerate(jobs):
+            groups.setdefault(job["filename"], []).append((i, canonical_operations(job.get("operations", {}))))
+    except ValueError as e:
+        return {"error": f"Job {i}: {e}"}, 400
+
+    results = [None] * len(jobs)
+    with ThreadPoolExecutor(min(len(groups), BATCH_SOURCE_CONCURRENCY)) as threads:
+        futures = {
+            filename: threads.submit(metrics.collected, run_source_group, filename, group, owner, username)
+            for filename, group in groups.items()
+        }
+        for filename, future in futures.items():
+            try:
+                outcomes, timings = future.result()
+                metrics.merge(timings)
+            except Exception as e:
+                print(f"[DEBUG] Batch source {filename} failed: {e}")
+                outcomes = [(i, None, str(e)) for i, _ in groups[filename]]
+            for i, result, error in outcomes:
+                results[i] = {"filename": filename, "result": None, "s3_key": None}
+                if result:
+                    results[i].update(
+                        result=os.path.basename(result["key"]),
+                        s3_key=result["key"],
+                        format=result["format"],
+                        size_bytes=result["size_bytes"]
+                    )
+                if error:
+                    results[i]["error"] = f"Processing failed: {error}"
+
+    done = [r for r in results if r["result"]]
+    records = ddb.save_result_metadata_batch(
+        [
+            (r["filename"], r["result"], thumbnails.thumbnail_key(r["s3_key"]), r["s3_key"], r["format"], r["size_bytes"])
+            for r in done
+        ],
+        {"username": username, "role": "admin" if username == "admin1" else "user"}
+    ) if done else []
+    for r, record in zip(done, records):
+        r["metadata"] = record
+
+    return {
+        "message": f"Processed {len(done)} of {len(jobs)} jobs",
+        "results": results
+    }, 200 if len(done) == len(jobs) else 207
+
+
+@process_bp.route("/", methods=["POST"])
+def process_image():
+    """Handle image processing requests from the API service."""
+    print("[DEBUG] /process route hit (POST)")
+    data = request.json
+    print(f"[DEBUG] Incoming request data: {data}")
+
+    if "username" not in data:
+        data["username"] = session.get("user", {}).get("cognito:username")
+
+    body, status = run_job(data)
+    return jsonify(body), status
+
+
+@process_bp.route("/batch", methods=["POST"])
+def process_batch():
+    """Handle a batch of (filename, operations) jobs from the API service."""
+    print("[DEBUG] /process/batch route hit (POST)")
+    data = request.json
+
+    if "username" not in data:
+        data["username"] = session.get("user", {}).get("cognito:username")
+
+    body, status = run_batch(data)
+    return jsonify(body), status
+
+
+@process_bp.route("/cache", methods=["GET"])
+def cache_stats():
+    """Report result cache size and hit/miss counters."""
+    return jsonify(result_cache.results.stats()), 200
+
 
-    finally:
-        shutil.rmtree(tmp_dir, ignore_errors=True)
+@process_bp.route("/cache/sources", methods=["GET"])
+def source_cache_stats():
+    """Report this worker's source cache size and hit/miss/eviction counters."""
+    return jsonify(source_cache.sources.stats()), 200
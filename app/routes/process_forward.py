@@ -1,93 +1,148 @@
-import time
+import os
+import math
 import requests
-from flask import Blueprint, request, jsonify, session
+from flask import Blueprint, request, jsonify, session, url_for
 from app.utils.auth_helper import login_required
+from app.utils import metrics
+from app.services import job_queue, worker_client, loadgen, background
+from app.services.worker_client import WorkerUnavailable
 
 process_forward_bp = Blueprint("process_forward", __name__)
 
-WORKER_URL = "http://internal-n11326158-alb-1562283677.ap-southeast-2.elb.amazonaws.com"
+# "async" enqueues jobs for the worker pool instead of waiting on the worker
+PROCESS_MODE = os.environ.get("PROCESS_MODE", "sync")
 
+# Load tests started from the dashboard run in the background; one at a time
+MAX_STRESS_DURATION = float(os.environ.get("MAX_STRESS_DURATION", 300))
+# Each unit of concurrency is a client thread in the API process
+MAX_STRESS_CONCURRENCY = int(os.environ.get("MAX_STRESS_CONCURRENCY", 64))
 
-def check_worker_health():
-    """Ping the worker's /health endpoint before sending a job."""
+
+def stamp_user(data):
+    """Attach the caller's username; only admins may process another user's uploads."""
+    username = session.get("user", {}).get("cognito:username")
+    data["username"] = username
+    if username != "admin1" or not data.get("owner"):
+        data["owner"] = username
+    return data
+
+
+def forward(path, data, timeout):
+    """POST a job to the worker; fails fast with 503 while its circuit is open."""
     try:
-        resp = requests.get(f"{WORKER_URL}/", timeout=5)
-        if resp.status_code == 200:
-            data = resp.json()
-            if data.get("status") == "worker service running":
-                print("[DEBUG] Worker health check: OK")
-                return True
-        print(f"[WARN] Worker health check failed: {resp.text}")
-    except requests.exceptions.RequestException as e:
-        print(f"[ERROR] Worker health check request failed: {e}")
-    return False
+        with metrics.timer("worker"):
+            resp = worker_client.post(path, data, timeout)
+        metrics.add_upstream(resp.headers.get("Server-Timing"), "worker_")
+        return jsonify(resp.json()), resp.status_code
+    except WorkerUnavailable:
+        return jsonify({"error": "Worker service unavailable"}), 503
+    except (requests.exceptions.RequestException, ValueError) as e:
+        print(f"[ERROR] Failed to contact worker: {e}")
+        return jsonify({"error": "Worker service unreachable"}), 500
 
 
 @process_forward_bp.route("/", methods=["POST"])
 @login_required
 def process_image():
     """Forward image processing requests to the worker service."""
-    data = request.json
+    data = stamp_user(request.get_json(silent=True) or {})
 
-    if not check_worker_health():
-        return jsonify({"error": "Worker service unavailable"}), 503
+    # Workers only consume the queue in async mode, so sync mode never queues
+    if data.pop("async", True) and PROCESS_MODE == "async":
+        if not data.get("filename"):
+            return jsonify({"error": "Filename required"}), 400
+        job_id = job_queue.get_queue().submit(data)
+        return jsonify({
+            "job_id": job_id,
+            "status": "queued",
+            "status_url": url_for("process_forward.job_status", job_id=job_id)
+        }), 202
+
+    return forward("/process", data, timeout=120)
+
+
+@process_forward_bp.route("/batch", methods=["POST"])
+@login_required
+def process_batch():
+    """Forward a batch of (filename, operations) jobs to the worker in one request."""
+    data = stamp_user(request.get_json(silent=True) or {})
+
+    return forward("/process/batch", data, timeout=600)
+
+
+@process_forward_bp.route("/worker", methods=["GET"])
+@login_required
+def worker_status():
+    """Report the API's view of the worker circuit."""
+    return jsonify(worker_client.status()), 200
+
+
+@process_forward_bp.route("/jobs/<job_id>", methods=["GET"])
+@login_required
+def job_status(job_id):
+    """Return the status, and once finished the result, of a queued job."""
+    job = job_queue.get_queue().get(job_id)
+    username = session.get("user", {}).get("cognito:username")
+    # Other users' jobs read as missing, so ids can't be probed
+    if not job or (username != "admin1" and job.get("username") != username):
+        return jsonify({"error": "Job not found"}), 404
+    return jsonify(job), 200
 
-    try:
-        resp = requests.post(f"{WORKER_URL}/process", json=data, timeout=120)
-        return jsonify(resp.json()), resp.status_code
-    except requests.exceptions.RequestException as e:
-        print(f"[ERROR] Failed to contact worker: {e}")
-        return jsonify({"error": "Worker service unreachable"}), 500
 
 @process_forward_bp.route("/stress", methods=["POST"])
 @login_required
 def stress_test():
-    """Send repeated /process requests to stress test worker scaling."""
+    """Start a background load test against the worker and return its id."""
     print("[DEBUG] /stress route hit (POST)")
-    data = request.json
+    data = request.get_json(silent=True) or {}
     filename = data.get("filename")
-    duration = int(data.get("duration", 30))
 
     if not filename:
         return jsonify({"error": "Filename required"}), 400
 
-    if not check_worker_health():
+    if worker_client.breaker.state == "open":
         return jsonify({"error": "Worker service unavailable"}), 503
 
-    worker_url = f"{WORKER_URL}/process"
-    end_time = time.time() + duration
-    sent, successes, failures = 0, 0, 0
-
-    print(f"[INFO] Starting stress test for {duration}s (spamming {worker_url})")
-
-    while time.time() < end_time:
-        try:
-            # Heavier workload: upscale image 30x and apply minor rotation
-            resp = requests.post(worker_url, json={
-                "filename": filename,
-                "operations": {
-                    "rotate": 5,
-                    "upscale": 30
-                }
-            }, timeout=60)
-
-            sent += 1
-            if resp.status_code == 200:
-                successes += 1
-            else:
-                failures += 1
-                print(f"[WARN] Request failed: {resp.status_code}")
-
-        except Exception as e:
-            failures += 1
-            print(f"[ERROR] Request error: {e}")
-
-    summary = {
-        "duration": duration,
-        "requests_sent": sent,
-        "successes": successes,
-        "failures": failures
-    }
-
-    print(f"[INFO] Stress test summary: {summary}")
-    return jsonify(summary), 200
+    try:
+        kwargs = {
+            "duration": min(float(data.get("duration") or 30), MAX_STRESS_DURATION),
+            "concurrency": min(int(data.get("concurrency", 8)), MAX_STRESS_CONCURRENCY),
+            "rate": float(data["rate"]) if data.get("rate") else None,
+            "mix": data.get("mix"),
+        }
+        if not kwargs["duration"] > 0 or kwargs["concurrency"] < 1:
+            raise ValueError("duration and concurrency must be positive")
+        if kwargs["rate"] is not None and not (0 < kwargs["rate"] < math.inf):
+            raise ValueError("rate must be a positive number")
+        if kwargs["mix"] is not None:
+            loadgen.check_mix(kwargs["mix"])
+    except (TypeError, ValueError) as e:
+        return jsonify({"error": f"Invalid stress test settings: {e}"}), 400
+
+    # The worker reads sources from the requester's folder (or an admin's chosen owner)
+    job = stamp_user({"owner": data.get("owner")})
+    kwargs.update(user=job["username"], owner=job["owner"])
+
+    run_id = background.start(
+        "stress", lambda progress: loadgen.run(f"{worker_client.WORKER_URL}/process", filename, **kwargs),
+        started_by=job["username"]
+    )
+    if not run_id:
+        return jsonify({"error": "A stress test is already running"}), 409
+    return jsonify({
+        "run_id": run_id,
+        "status": "running",
+        "status_url": url_for("process_forward.stress_status", run_id=run_id)
+    }), 202
+
+
+@process_forward_bp.route("/stress/<run_id>", methods=["GET"])
+@login_required
+def stress_status(run_id):
+    """Return the report of a stress test once it has finished."""
+    run = background.get(run_id)
+    username = session.get("user", {}).get("cognito:username")
+    # Other users' runs read as missing, like queued jobs
+    if not run or run["kind"] != "stress" or (username != "admin1" and run["started_by"] != username):
+        return jsonify({"error": "Stress test not found"}), 404
+    return jsonify(run), 200
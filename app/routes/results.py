@@ -1,29 +1,71 @@
-from flask import Blueprint, jsonify, request, session
+from flask import Blueprint, jsonify, request, session, url_for
 from app.utils.auth_helper import login_required
-from app.services import s3, ddb
+from app.services import s3, ddb, background
+from app.utils import thumbnails, keys
 
 results_bp = Blueprint("results", __name__)
 
 
+def attach_previews(records, check_exists=False):
+    """Add presigned preview_url (the thumbnail when there is one) and download_url."""
+    records = [m for m in records if "output" in m]
+    originals = [keys.record_key(m) for m in records]
+    previews = [m.get("thumbnail") or key for m, key in zip(records, originals)]
+    urls = s3.presign_urls(set(originals + previews), check_exists=check_exists)
+    for m, original, preview in zip(records, originals, previews):
+        m["preview_url"] = urls[preview]
+        m["download_url"] = urls[original]
+
+
 @results_bp.route("/", methods=["GET"])
 @login_required
 def list_results():
-    """List all result files stored in S3."""
+    """List one page of the caller's result objects in S3.
+
+    Only the caller's own folder is listed, a page at a time: pass the
+    returned `next_token` back as `?token=` for the next page. Admins may
+    list another user's folder with `?user=`, or the top level with
+    `?user=*`, which returns the user folders and any legacy flat objects.
+    """
     print("[DEBUG] /results/ (GET) hit → listing results from S3")
-    files = s3.list_files_with_prefix("results/")
-    print(f"[DEBUG] Files found in S3 results/: {files}")
-    return jsonify({"results": files}), 200
+    user = session.get("user", {})
+    username = user.get("cognito:username")
+    role = "admin" if username == "admin1" else "user"
+    limit = min(int(request.args.get("limit", 100)), s3.LIST_PAGE_MAX)
+
+    requested = request.args.get("user") if role == "admin" else None
+    prefix = keys.RESULTS if requested == "*" else keys.user_prefix(keys.RESULTS, requested or username)
+
+    page = s3.list_page(prefix, limit, request.args.get("token"))
+    print(f"[DEBUG] Listed {len(page['keys'])} objects under {prefix}")
+    return jsonify({
+        "prefix": prefix,
+        "results": page["keys"],
+        "folders": page["folders"],
+        "next_token": page["next_token"]
+    }), 200
 
 
 @results_bp.route("/<filename>", methods=["GET"])
+@login_required
 def get_result(filename):
-    """Generate a pre-signed URL to download a specific result file."""
+    """Generate a pre-signed URL to download a specific result file.
+
+    The file is the caller's, found through its record; admins can fetch
+    another user's with `?user=`.
+    """
     print(f"[DEBUG] /results/{filename} (GET) hit → presigned URL")
-    s3_key = f"results/{filename}"
-    url = s3.generate_presigned_url(s3_key)
+    user = session.get("user", {})
+    role = "admin" if user.get("cognito:username") == "admin1" else "user"
+    owner = request.args.get("user") or user.get("username")
+    if role != "admin" and owner != user.get("username"):
+        print(f"[DEBUG] Permission denied for user {user.get('cognito:username')}")
+        return jsonify({"error": "Permission denied"}), 403
+    matches = ddb.find_results(owner, filename)
+    url = s3.generate_presigned_url(keys.record_key(matches[0])) if matches else None
 
     if not url:
-        print(f"[DEBUG] File not found in S3: {s3_key}")
+        print(f"[DEBUG] File not found: {filename}")
         return jsonify({"error": "File not found"}), 404
 
     print(f"[DEBUG] Generated presigned URL: {url}")
@@ -33,42 +75,57 @@ def get_result(filename):
 @results_bp.route("/metadata", methods=["GET"])
 @login_required
 def get_metadata():
-    """Return paginated, sortable, and filterable result metadata."""
-    print("[DEBUG] /results/metadata (GET) hit")
-    metadata = ddb.load_results()
-    print(f"[DEBUG] Loaded metadata count: {len(metadata)}")
+    """Return paginated, sortable, and filterable result metadata.
 
+    Time-sorted listings come straight from the DynamoDB indexes and page
+    with an opaque `cursor`; `page` or any other sort column falls back to
+    sorting the caller's records in memory.
+    """
+    print("[DEBUG] /results/metadata (GET) hit")
     user = session.get("user", {})
     role = "admin" if user.get("cognito:username") == "admin1" else "user"
 
-    if role != "admin":
-        before = len(metadata)
-        username = user.get("cognito:username")
-        metadata = [m for m in metadata if m.get("user") == username]
-        print(f"[DEBUG] User '{username}' filtered metadata count: {before} → {len(metadata)}")
-
-    page = int(request.args.get("page", 1))
+    page = request.args.get("page")
     limit = int(request.args.get("limit", 5))
     sort = request.args.get("sort", "timestamp")
     order = request.args.get("order", "desc")
+    cursor = request.args.get("cursor")
     filter_user = request.args.get("user")
     filter_input = request.args.get("input")
 
     print(f"[DEBUG] Query params → page={page}, limit={limit}, sort={sort}, "
           f"order={order}, filter_user={filter_user}, filter_input={filter_input}")
 
-    if filter_user and role == "admin":
-        before = len(metadata)
-        metadata = [m for m in metadata if m.get("user", "").lower() == filter_user.lower()]
-        print(f"[DEBUG] Filtered by user={filter_user}: {before} → {len(metadata)}")
+    # Non-admins only ever see their own results; the admin user filter
+    # matches case-insensitively, through the lower-cased user index
+    any_case = role == "admin"
+    scope = (filter_user or None) if any_case else user.get("cognito:username")
 
+    match = None
     if filter_input:
+        needle = filter_input.lower()
+        match = lambda m: needle in m.get("input", "").lower() or needle in m.get("user", "").lower()
+
+    if page is None and sort == "timestamp":
+        try:
+            metadata, next_cursor = ddb.query_results(scope, limit, cursor, order == "asc", match, any_case)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        print(f"[DEBUG] Index query returned {len(metadata)} results, more={bool(next_cursor)}")
+        attach_previews(metadata, request.args.get("verify") == "1")
+        return jsonify({
+            "limit": limit,
+            "results": metadata,
+            "next_cursor": next_cursor
+        }), 200
+
+    page = int(page or 1)
+    metadata = ddb.load_results(scope, any_case)
+    print(f"[DEBUG] Loaded metadata count: {len(metadata)}")
+
+    if match:
         before = len(metadata)
-        metadata = [
-            m for m in metadata
-            if filter_input.lower() in m.get("input", "").lower()
-            or filter_input.lower() in m.get("user", "").lower()
-        ]
+        metadata = [m for m in metadata if match(m)]
         print(f"[DEBUG] Filtered by input={filter_input}: {before} → {len(metadata)}")
 
     reverse = (order == "desc")
@@ -84,10 +141,7 @@ def get_metadata():
     paginated = metadata[start:end]
     print(f"[DEBUG] Pagination applied: total={total}, returning {len(paginated)} results")
 
-    for m in paginated:
-        if "output" in m:
-            s3_key = f"results/{m['output']}"
-            m["preview_url"] = s3.generate_presigned_url(s3_key)
+    attach_previews(paginated, request.args.get("verify") == "1")
 
     return jsonify({
         "page": page,
@@ -97,39 +151,69 @@ def get_metadata():
     }), 200
 
 
+def clear_all(progress):
+    """Background task behind /results/clear: objects, thumbnails, then metadata."""
+    objects = s3.clear_prefix(keys.RESULTS, progress)
+    objects += s3.clear_prefix(thumbnails.THUMBNAIL_PREFIX + keys.RESULTS, progress)
+    print("[DEBUG] Cleared all results from S3")
+    records = ddb.clear_results(progress)
+    print("[DEBUG] Cleared all result metadata from DynamoDB")
+    return {"objects": objects, "records": records}
+
+
 @results_bp.route("/clear", methods=["DELETE"])
 @login_required
 def clear_results():
-    """Delete all result files and metadata."""
+    """Start deleting all result files and metadata in the background."""
     print("[DEBUG] /results/clear (DELETE) hit")
-    try:
-        s3.clear_prefix("results/")
-        print("[DEBUG] Cleared all results from S3")
-        ddb.clear_results()
-        print("[DEBUG] Cleared all result metadata from DynamoDB")
-        return jsonify({"message": "All results and metadata cleared"}), 200
-    except Exception as e:
-        print(f"[DEBUG] Error clearing results: {e}")
-        return jsonify({"error": str(e)}), 500
+    op_id = background.start("clear_results", clear_all)
+    if not op_id:
+        return jsonify({"error": "Already clearing results"}), 409
+    return jsonify({
+        "operation_id": op_id,
+        "status": "running",
+        "status_url": url_for("results.clear_status", op_id=op_id)
+    }), 202
+
+
+@results_bp.route("/clear/<op_id>", methods=["GET"])
+@login_required
+def clear_status(op_id):
+    """Report progress of a clear started with DELETE /results/clear."""
+    op = background.get(op_id)
+    if not op:
+        return jsonify({"error": "Operation not found"}), 404
+    return jsonify(op), 200
 
 
 @results_bp.route("/<filename>", methods=["DELETE"])
 @login_required
 def delete_result(filename):
-    """Delete a specific result file and its metadata."""
+    """Delete a specific result file and its metadata.
+
+    Admins can delete another user's result with `?user=`.
+    """
     print(f"[DEBUG] /results/{filename} (DELETE) hit")
+    user = session.get("user", {})
+    role = "admin" if user.get("cognito:username") == "admin1" else "user"
+    owner = request.args.get("user") or user.get("cognito:username")
+    if role != "admin" and owner != user.get("cognito:username"):
+        print(f"[DEBUG] Permission denied for user {user.get('cognito:username')}")
+        return jsonify({"error": "Permission denied"}), 403
     try:
-        s3_key = f"results/{filename}"
-        s3.delete_file_from_s3(s3_key)
-        print(f"[DEBUG] Deleted file from S3: {s3_key}")
+        matches = ddb.find_results(owner, filename)
 
-        metadata = ddb.load_results()
-        match = next((m for m in metadata if m.get("output") == filename), None)
+        s3_key = keys.record_key(matches[0]) if matches else keys.result_key(owner, filename)
+        # Records from cache hits before results were copied per user can
+        # point into another user's folder; that object isn't ours to delete
+        if keys.folder_owner(s3_key, keys.RESULTS) in (None, owner or keys.NO_OWNER):
+            s3.delete_keys(thumbnails.object_keys(matches[0] if matches else {}, s3_key))
+            print(f"[DEBUG] Deleted file and thumbnail from S3: {s3_key}")
 
-        if match:
+        for match in matches:
             ddb.delete_result_metadata(match["id"])
             print(f"[DEBUG] Deleted metadata from DynamoDB: {match['id']}")
-        else:
+        if not matches:
             print(f"[DEBUG] No metadata entry found for {filename}")
 
         return jsonify({"message": f"Result '{filename}' deleted"}), 200
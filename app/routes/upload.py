@@ -1,15 +1,33 @@
+import io
 import os
+import re
+import math
 import tempfile
-from flask import Blueprint, request, jsonify, session
+import mimetypes
+from flask import Blueprint, request, jsonify, session, url_for
 from werkzeug.utils import secure_filename
 from app.utils.auth_helper import login_required
-from app.services import s3, ddb
+from app.services import s3, ddb, background, content
+from app.utils import thumbnails, keys
 from PIL import Image
 
 upload_bp = Blueprint("upload", __name__)
 
 ALLOWED_EXTENSIONS = {"png", "jpg", "jpeg", "gif"}
 
+MB = 1024 * 1024
+# Direct (browser → S3) uploads: size cap, and the size above which they go up in parts
+MAX_UPLOAD_BYTES = int(os.environ.get("MAX_UPLOAD_BYTES", 5 * 1024 * MB))
+DIRECT_MULTIPART_THRESHOLD = int(os.environ.get("DIRECT_MULTIPART_THRESHOLD", 64 * MB))
+DIRECT_PART_SIZE = int(os.environ.get("DIRECT_PART_SIZE", 16 * MB))
+# S3 allows at most this many parts per multipart upload
+MAX_PARTS = 10000
+# Resolution is read from the first PROBE_BYTES of an upload, retrying with
+# larger reads (e.g. JPEGs with big EXIF blocks) up to PROBE_MAX_BYTES
+PROBE_BYTES = int(os.environ.get("UPLOAD_PROBE_BYTES", 64 * 1024))
+PROBE_MAX_BYTES = int(os.environ.get("UPLOAD_PROBE_MAX_BYTES", 4 * MB))
+SHA256_HEX = re.compile(r"^[0-9a-f]{64}$")
+
 
 def allowed_file(filename):
     """Check if the file extension is allowed."""
@@ -18,6 +36,29 @@ def allowed_file(filename):
     return ok
 
 
+def replace_previous(user, filename, record):
+    """Drop `user`'s older records for `filename` now that `record` replaces
+    them, releasing the objects they held."""
+    for old in ddb.find_uploads(user.get("username"), filename):
+        if old["id"] != record["id"]:
+            ddb.delete_upload_metadata(old["id"])
+            # An upload that kept its own object overwrote the old one in place
+            if keys.record_key(old) != keys.record_key(record):
+                content.release_record(old)
+            print(f"[DEBUG] Replaced earlier upload record {old['id']}")
+
+
+def attach_previews(records, check_exists=False):
+    """Add presigned preview_url (the thumbnail when there is one) and download_url."""
+    records = [f for f in records if "filename" in f]
+    originals = [keys.record_key(f) for f in records]
+    previews = [f.get("thumbnail") or key for f, key in zip(records, originals)]
+    urls = s3.presign_urls(set(originals + previews), check_exists=check_exists)
+    for f, original, preview in zip(records, originals, previews):
+        f["preview_url"] = urls[preview]
+        f["download_url"] = urls[original]
+
+
 @upload_bp.route("/", methods=["POST"])
 @login_required
 def upload_file():
@@ -50,68 +91,305 @@ def upload_file():
     resolution = "Unknown"
     file_size = os.path.getsize(tmp_path)
     print(f"[DEBUG] File size: {file_size} bytes")
+    with open(tmp_path, "rb") as f:
+        digest = content.digest_file(f)
+    print(f"[DEBUG] Content SHA-256: {digest}")
+
+    # Identical bytes are stored once; later uploads only add a reference
+    s3_key, stored = content.acquire(digest, lambda key: s3.upload_file_to_s3(tmp_path, key))
+    print(f"[DEBUG] Upload stored at key={s3_key} (new object: {stored})")
+    thumb_key = thumbnails.thumbnail_key(s3_key)
+    needs_thumb = stored or not s3.get_etag(thumb_key)
 
+    thumb = None
     try:
         with Image.open(tmp_path) as img:
             resolution = f"{img.width}x{img.height}"
             print(f"[DEBUG] Image resolution: {resolution}")
+            if needs_thumb:
+                thumb = thumbnails.make_thumbnail(img)
     except Exception as e:
         print(f"[DEBUG] Could not read image resolution: {e}")
 
-    s3_key = f"uploads/{filename}"
-    s3.upload_file_to_s3(tmp_path, s3_key)
-    print(f"[DEBUG] Uploaded file to S3 at key={s3_key}")
+    if thumb:
+        s3.upload_fileobj_to_s3(io.BytesIO(thumb), thumb_key, thumbnails.content_type())
+    elif needs_thumb:
+        thumb_key = None
 
     user = session.get("user", {})
-    record = ddb.save_upload_metadata(filename, resolution, file_size, user)
-    record["s3_key"] = s3_key
+    record = ddb.save_upload_metadata(filename, resolution, file_size, user, thumb_key, s3_key, digest)
     print(f"[DEBUG] Saved upload metadata to DynamoDB: {record}")
+    replace_previous(user, filename, record)
 
     return jsonify({
         "message": "File uploaded successfully",
-        "metadata": record
+        "metadata": record,
+        "deduplicated": not stored
     }), 201
 
 
+def probe_upload(s3_key):
+    """(resolution, size in bytes) of an uploaded object, read from its header.
+
+    Only the first few KB are fetched with a ranged GET; the total size
+    comes back in the same response's Content-Range.
+    """
+    nbytes = PROBE_BYTES
+    while True:
+        head, size = s3.read_head(s3_key, nbytes)
+        try:
+            with Image.open(io.BytesIO(head)) as img:
+                return f"{img.width}x{img.height}", size
+        except Exception as e:
+            if len(head) >= size or nbytes >= PROBE_MAX_BYTES:
+                print(f"[DEBUG] Could not read image resolution: {e}")
+                return "Unknown", size
+            nbytes = min(nbytes * 4, PROBE_MAX_BYTES)
+            print(f"[DEBUG] Header of {s3_key} incomplete, retrying with {nbytes} bytes")
+
+
+def _content_missing(key):
+    raise ValueError("Content is no longer stored; upload the file again")
+
+
+def link_upload(progress, digest, filename, user):
+    """Background half of a direct upload the browser skipped because the
+    user already has these bytes: reference them under a new record."""
+    s3_key, _ = content.acquire(digest, _content_missing)
+    resolution, file_size = probe_upload(s3_key)
+    thumb_key = thumbnails.thumbnail_key(s3_key)
+    if not s3.get_etag(thumb_key):
+        thumb_key = None
+    record = ddb.save_upload_metadata(filename, resolution, file_size, user, thumb_key, s3_key, digest)
+    print(f"[DEBUG] Linked upload {filename} to stored content {digest[:12]}…")
+    progress(records=1)
+    replace_previous(user, filename, record)
+    return record
+
+
+def register_upload(progress, s3_key, filename, user):
+    """Background half of a direct upload: write the record, then move the
+    object into the content store and thumbnail it.
+
+    The record goes in as soon as the header is read, so the upload is
+    listed and processable right away (from `s3_key`, where the browser
+    put it). The content hash is the SHA-256 S3 verified on the way in, so
+    the bytes never pass through here to be hashed; uploads sent without one
+    (multipart, or too big for the browser to hash) keep their own object.
+    """
+    resolution, file_size = probe_upload(s3_key)
+    record = ddb.save_upload_metadata(filename, resolution, file_size, user, None, s3_key)
+    print(f"[DEBUG] Saved upload metadata to DynamoDB: {record}")
+    progress(records=1)
+
+    digest = s3.get_sha256(s3_key)
+    key, stored = s3_key, True
+    if digest:
+        key, stored = content.acquire(digest, lambda key: s3.copy_object(s3_key, key))
+
+    thumb_key = thumbnails.thumbnail_key(key)
+    if stored or not s3.get_etag(thumb_key):
+        try:
+            with s3.download_fileobj_from_s3(s3_key) as src, Image.open(src) as img:
+                thumb = thumbnails.make_thumbnail(img)
+            s3.upload_fileobj_to_s3(io.BytesIO(thumb), thumb_key, thumbnails.content_type())
+            progress(thumbnails=1)
+        except Exception as e:
+            print(f"[DEBUG] Could not thumbnail {s3_key}: {e}")
+            thumb_key = None
+
+    if digest:
+        ddb.set_content(record["id"], digest, key, thumb_key)
+        s3.delete_file_from_s3(s3_key)
+        record.update(s3_key=key, content_hash=digest, thumbnail=thumb_key)
+        print(f"[DEBUG] Upload {filename} moved to {key} (new object: {stored})")
+    elif thumb_key:
+        ddb.set_thumbnail(ddb.uploads_table(), record["id"], thumb_key)
+        record["thumbnail"] = thumb_key
+    replace_previous(user, filename, record)
+    return record
+
+
+@upload_bp.route("/presign", methods=["POST"])
+@login_required
+def presign_upload():
+    """Issue credentials for the browser to upload one file straight to S3.
+
+    Body: {filename, size[, sha256]}. When the user already has an upload
+    with that SHA-256 the answer is {duplicate: true} and nothing needs to
+    be sent. Other users' files are never reported: a bare hash is not
+    proof of having the bytes. Otherwise files up to
+    DIRECT_MULTIPART_THRESHOLD get a presigned POST, pinned to the SHA-256
+    when one is given so identical uploads can be stored once; larger ones
+    a multipart upload with a presigned PUT URL per part. Either way the
+    browser calls /upload/complete afterwards.
+    """
+    print("[DEBUG] /upload/presign (POST) hit")
+    data = request.json or {}
+    digest = str(data.get("sha256") or "").lower()
+
+    if not data.get("filename"):
+        return jsonify({"error": "No file selected"}), 400
+    if not allowed_file(data["filename"]):
+        return jsonify({"error": "Invalid file type"}), 400
+    try:
+        size = int(data.get("size") or 0)
+    except (TypeError, ValueError):
+        size = 0
+    if not 0 < size <= MAX_UPLOAD_BYTES:
+        return jsonify({"error": f"File size must be between 1 and {MAX_UPLOAD_BYTES} bytes"}), 400
+
+    filename = secure_filename(data["filename"])
+    user = session.get("user", {})
+    s3_key = keys.upload_key(user.get("username"), filename)
+    content_type = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+    body = {"filename": filename, "key": s3_key}
+
+    if SHA256_HEX.match(digest) and ddb.owns_content(user.get("username"), digest) and content.exists(digest):
+        print(f"[DEBUG] {filename} is already stored as {digest[:12]}…, skipping the transfer")
+        body.update(duplicate=True, key=keys.content_key(digest))
+    elif size <= DIRECT_MULTIPART_THRESHOLD:
+        body["post"] = s3.presign_post(s3_key, content_type, size, digest if SHA256_HEX.match(digest) else None)
+    else:
+        part_size = max(DIRECT_PART_SIZE, math.ceil(size / MAX_PARTS))
+        upload_id, urls = s3.start_multipart(s3_key, content_type, math.ceil(size / part_size))
+        body["multipart"] = {"upload_id": upload_id, "part_size": part_size, "urls": urls}
+
+    return jsonify(body), 200
+
+
+@upload_bp.route("/complete", methods=["POST"])
+@login_required
+def complete_upload():
+    """Finish a direct upload started with /upload/presign.
+
+    Body: {filename[, upload_id, parts: [{part, etag}]]}, or {filename,
+    sha256} when /upload/presign reported a duplicate. Multipart uploads
+    are assembled here; the record is written in the background, so the
+    response is 202 with a status_url.
+    """
+    print("[DEBUG] /upload/complete (POST) hit")
+    data = request.json or {}
+    filename = secure_filename(data.get("filename") or "")
+    if not filename or not allowed_file(filename):
+        return jsonify({"error": "Invalid file"}), 400
+
+    user = session.get("user", {})
+    s3_key = keys.upload_key(user.get("username"), filename)
+
+    digest = str(data.get("sha256") or "").lower()
+    if digest:
+        if not SHA256_HEX.match(digest):
+            return jsonify({"error": "Invalid sha256"}), 400
+        if not ddb.owns_content(user.get("username"), digest):
+            return jsonify({"error": "Only files you have already uploaded can be linked by hash"}), 403
+        op_id = background.start("register_upload", link_upload, digest, filename, user, exclusive=False)
+        return jsonify({
+            "operation_id": op_id,
+            "status": "running",
+            "status_url": url_for("upload.complete_status", op_id=op_id)
+        }), 202
+
+    if data.get("upload_id"):
+        try:
+            parts = [{"PartNumber": int(p["part"]), "ETag": str(p["etag"])} for p in data.get("parts") or []]
+        except (TypeError, ValueError, KeyError):
+            return jsonify({"error": "Parts must be a list of {part, etag} objects"}), 400
+        try:
+            s3.complete_multipart(s3_key, data["upload_id"], parts)
+        except Exception as e:
+            print(f"[DEBUG] Completing multipart upload failed: {e}")
+            return jsonify({"error": f"Could not complete upload: {e}"}), 400
+
+    op_id = background.start("register_upload", register_upload, s3_key, filename, user, exclusive=False)
+    return jsonify({
+        "operation_id": op_id,
+        "status": "running",
+        "status_url": url_for("upload.complete_status", op_id=op_id)
+    }), 202
+
+
+@upload_bp.route("/complete/<op_id>", methods=["GET"])
+@login_required
+def complete_status(op_id):
+    """Report the record written for an upload finished with /upload/complete."""
+    op = background.get(op_id)
+    if not op:
+        return jsonify({"error": "Operation not found"}), 404
+    return jsonify(op), 200
+
+
+@upload_bp.route("/abort", methods=["POST"])
+@login_required
+def abort_upload():
+    """Abort a multipart direct upload so S3 drops its parts."""
+    data = request.json or {}
+    filename = secure_filename(data.get("filename") or "")
+    if not filename or not data.get("upload_id"):
+        return jsonify({"error": "filename and upload_id required"}), 400
+
+    s3_key = keys.upload_key(session.get("user", {}).get("username"), filename)
+    try:
+        s3.abort_multipart(s3_key, data["upload_id"])
+    except Exception as e:
+        return jsonify({"error": str(e)}), 400
+    return jsonify({"message": "Upload aborted"}), 200
+
+
 @upload_bp.route("/list", methods=["GET"])
 @login_required
 def list_uploads():
-    """List uploaded files with filtering, sorting, and pagination."""
-    print("[DEBUG] /upload/list (GET) hit")
-    files = ddb.load_uploads()
-    print(f"[DEBUG] Loaded {len(files)} uploads from DynamoDB")
+    """List uploaded files with filtering, sorting, and pagination.
 
+    Time-sorted listings come straight from the DynamoDB indexes and page
+    with an opaque `cursor`; `page` or any other sort column falls back to
+    sorting the caller's records in memory.
+    """
+    print("[DEBUG] /upload/list (GET) hit")
     user = session.get("user", {})
     role = "admin" if user.get("cognito:username") == "admin1" else "user"
 
-    if role != "admin":
-        before = len(files)
-        username = user.get("cognito:username")
-        files = [f for f in files if f.get("user") == username]
-        print(f"[DEBUG] Filtered uploads for {username}: {before} → {len(files)}")
-
-    page = int(request.args.get("page", 1))
+    page = request.args.get("page")
     limit = int(request.args.get("limit", 10))
     sort = request.args.get("sort", "timestamp")
     order = request.args.get("order", "desc")
+    cursor = request.args.get("cursor")
     filter_user = request.args.get("user")
     filter_input = request.args.get("q")
 
     print(f"[DEBUG] Query params → page={page}, limit={limit}, sort={sort}, "
           f"order={order}, filter_user={filter_user}, filter_input={filter_input}")
 
-    if filter_user and role == "admin":
-        before = len(files)
-        files = [f for f in files if f.get("user", "").lower() == filter_user.lower()]
-        print(f"[DEBUG] Filtered by user={filter_user}: {before} → {len(files)}")
+    # Non-admins only ever see their own uploads; the admin user filter
+    # matches case-insensitively, through the lower-cased user index
+    any_case = role == "admin"
+    scope = (filter_user or None) if any_case else user.get("cognito:username")
 
+    match = None
     if filter_input:
+        needle = filter_input.lower()
+        match = lambda f: needle in f.get("filename", "").lower() or needle in f.get("user", "").lower()
+
+    if page is None and sort == "timestamp":
+        try:
+            files, next_cursor = ddb.query_uploads(scope, limit, cursor, order == "asc", match, any_case)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        print(f"[DEBUG] Index query returned {len(files)} uploads, more={bool(next_cursor)}")
+        attach_previews(files, request.args.get("verify") == "1")
+        return jsonify({
+            "limit": limit,
+            "results": files,
+            "next_cursor": next_cursor
+        }), 200
+
+    page = int(page or 1)
+    files = ddb.load_uploads(scope, any_case)
+    print(f"[DEBUG] Loaded {len(files)} uploads from DynamoDB")
+
+    if match:
         before = len(files)
-        files = [
-            f for f in files
-            if filter_input.lower() in f.get("filename", "").lower()
-            or filter_input.lower() in f.get("user", "").lower()
-        ]
+        files = [f for f in files if match(f)]
         print(f"[DEBUG] Filtered by input={filter_input}: {before} → {len(files)}")
 
     reverse = (order == "desc")
@@ -128,10 +406,7 @@ def list_uploads():
     paginated = files[start:end]
     print(f"[DEBUG] Pagination applied: total={total}, returning {len(paginated)} uploads")
 
-    for f in paginated:
-        if "filename" in f:
-            s3_key = f"uploads/{f['filename']}"
-            f["preview_url"] = s3.generate_presigned_url(s3_key)
+    attach_previews(paginated, request.args.get("verify") == "1")
 
     return jsonify({
         "page": page,
@@ -142,14 +417,25 @@ def list_uploads():
 
 
 @upload_bp.route("/<filename>", methods=["GET"])
+@login_required
 def get_upload(filename):
-    """Generate a pre-signed URL to download a specific uploaded file."""
+    """Generate a pre-signed URL to download a specific uploaded file.
+
+    The file is the caller's, found through its record; admins can fetch
+    another user's with `?user=`.
+    """
     print(f"[DEBUG] /upload/{filename} (GET) hit")
-    s3_key = f"uploads/{filename}"
-    url = s3.generate_presigned_url(s3_key)
+    user = session.get("user", {})
+    role = "admin" if user.get("cognito:username") == "admin1" else "user"
+    owner = request.args.get("user") or user.get("username")
+    if role != "admin" and owner != user.get("username"):
+        print(f"[DEBUG] Permission denied for user {user.get('cognito:username')}")
+        return jsonify({"error": "Permission denied"}), 403
+    matches = ddb.find_uploads(owner, filename)
+    url = s3.generate_presigned_url(keys.record_key(matches[0])) if matches else None
 
     if not url:
-        print(f"[DEBUG] File not found in S3: {s3_key}")
+        print(f"[DEBUG] File not found: {filename}")
         return jsonify({"error": "File not found"}), 404
 
     print(f"[DEBUG] Generated presigned URL for {filename}: {url}")
@@ -162,44 +448,66 @@ def delete_upload(filename):
     """Delete a specific uploaded file and its metadata."""
     print(f"[DEBUG] /upload/{filename} (DELETE) hit")
 
-    uploads = ddb.load_uploads()
-    file_meta = next((f for f in uploads if f.get("filename") == filename), None)
+    user = session.get("user", {})
+    role = "admin" if user.get("cognito:username") == "admin1" else "user"
+    owner = request.args.get("user") or user.get("cognito:username")
+
+    matches = ddb.find_uploads(owner, filename)
+    file_meta = matches[0] if matches else None
     print(f"[DEBUG] Metadata lookup for {filename}: {file_meta}")
 
     if not file_meta:
         print("[DEBUG] Metadata not found")
         return jsonify({"error": "Metadata not found"}), 404
 
-    user = session.get("user", {})
-    role = "admin" if user.get("cognito:username") == "admin1" else "user"
-
     if role != "admin" and file_meta.get("user") != user.get("cognito:username"):
         print(f"[DEBUG] Permission denied for user {user.get('cognito:username')}")
         return jsonify({"error": "Permission denied"}), 403
 
     try:
-        s3_key = f"uploads/{filename}"
-        s3.delete_file_from_s3(s3_key)
-        print(f"[DEBUG] Deleted file from S3: {s3_key}")
-        ddb.delete_upload_metadata(file_meta["id"])
-        print(f"[DEBUG] Deleted metadata from DynamoDB: {file_meta['id']}")
+        for record in matches:
+            ddb.delete_upload_metadata(record["id"])
+            print(f"[DEBUG] Deleted metadata from DynamoDB: {record['id']}")
+            # Shared content is only deleted with its last reference
+            if content.release_record(record):
+                print(f"[DEBUG] Deleted file from S3: {keys.record_key(record)}")
         return jsonify({"message": f"File '{filename}' deleted successfully"}), 200
     except Exception as e:
         print(f"[DEBUG] Error deleting upload: {e}")
         return jsonify({"error": str(e)}), 500
 
 
+def clear_all(progress):
+    """Background task behind /upload/clear: objects (the content store
+    included), thumbnails, then metadata and content reference counters."""
+    objects = s3.clear_prefix(keys.UPLOADS, progress)
+    objects += s3.clear_prefix(thumbnails.THUMBNAIL_PREFIX + keys.UPLOADS, progress)
+    print("[DEBUG] Cleared all uploads from S3")
+    records = ddb.clear_uploads(progress)
+    print("[DEBUG] Cleared all upload metadata from DynamoDB")
+    return {"objects": objects, "records": records}
+
+
 @upload_bp.route("/clear", methods=["DELETE"])
 @login_required
 def clear_uploads():
-    """Delete all uploaded files and metadata."""
+    """Start deleting all upload files and metadata in the background."""
     print("[DEBUG] /upload/clear (DELETE) hit")
-    try:
-        s3.clear_prefix("uploads/")
-        print("[DEBUG] Cleared all uploads from S3")
-        ddb.clear_uploads()
-        print("[DEBUG] Cleared all upload metadata from DynamoDB")
-        return jsonify({"message": "All uploads and metadata cleared"}), 200
-    except Exception as e:
-        print(f"[DEBUG] Error clearing uploads: {e}")
-        return jsonify({"error": str(e)}), 500
+    op_id = background.start("clear_uploads", clear_all)
+    if not op_id:
+        return jsonify({"error": "Already clearing uploads"}), 409
+    return jsonify({
+        "operation_id": op_id,
+        "status": "running",
+        "status_url": url_for("upload.clear_status", op_id=op_id)
+    }), 202
+
+
+@upload_bp.route("/clear/<op_id>", methods=["GET"])
+@login_required
+def clear_status(op_id):
+    """Report progress of a clear started with DELETE /upload/clear."""
+    op = background.get(op_id)
+    if not op:
+        return jsonify({"error": "Operation not found"}), 404
+    return jsonify(op), 200
@@ -0,0 +1,65 @@
+import time
+import uuid
+import threading
+
+# Finished operations are forgotten after this many seconds
+KEEP_FINISHED = 3600
+
+_operations = {}
+_lock = threading.Lock()
+
+
+def start(kind, fn, *args, exclusive=True, started_by=None, **kwargs):
+    """Run fn(progress, *args, **kwargs) on a background thread.
+
+    `progress` is a callable taking counters (e.g. deleted=1000) that are
+    added to the operation's progress as it runs; fn's return value
+    becomes its "result". `started_by` (a username) is kept on the
+    operation so status routes can hide it from other users. Returns the
+    operation id, or None when `exclusive` and another operation of the
+    same kind is still running.
+    """
+    with _lock:
+        _expire()
+        if exclusive and any(op["kind"] == kind and op["status"] == "running" for op in _operations.values()):
+            return None
+        op_id = uuid.uuid4().hex
+        op = _operations[op_id] = {
+            "id": op_id,
+            "kind": kind,
+            "status": "running",
+            "progress": {},
+            "started": time.time(),
+            "started_by": started_by,
+        }
+
+    def progress(**counts):
+        with _lock:
+            for name, n in counts.items():
+                op["progress"][name] = op["progress"].get(name, 0) + n
+
+    def run():
+        try:
+            result = fn(progress, *args, **kwargs)
+            update = {"status": "done", "result": result}
+        except Exception as e:
+            print(f"[ERROR] Background {kind} {op_id} failed: {e}")
+            update = {"status": "failed", "error": str(e)}
+        with _lock:
+            op.update(update, finished=time.time())
+
+    threading.Thread(target=run, name=f"{kind}-{op_id[:6]}", daemon=True).start()
+    return op_id
+
+
+def get(op_id):
+    """A snapshot of the operation, or None if unknown."""
+    with _lock:
+        op = _operations.get(op_id)
+        return dict(op, progress=dict(op["progress"])) if op else None
+
+
+def _expire():
+    now = time.time()
+    for op_id in [i for i, op in _operations.items() if now - op.get("finished", now) > KEEP_FINISHED]:
+        del _operations[op_id]
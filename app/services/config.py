@@ -0,0 +1,148 @@
+import os
+import json
+import time
+import threading
+import boto3
+
+PREFIX = "/n11326158/"
+REGION = "ap-southeast-2"
+
+# "ssm" loads the whole prefix from Parameter Store; "file" runs fully offline
+BACKEND = os.environ.get("CONFIG_BACKEND", "ssm")
+# JSON {parameter name: value}; overrides SSM, or is the only source for "file"
+OVERRIDES_FILE = os.environ.get("CONFIG_FILE")
+# Optional JSON snapshot of the last SSM load, reused on warm restarts.
+# SecureString parameters are left out (they are fetched again on first use)
+# and the file is created owner-only (0600).
+SNAPSHOT_FILE = os.environ.get("CONFIG_SNAPSHOT")
+TTL = int(os.environ.get("CONFIG_TTL", 300))
+
+
+def env_name(name):
+    """Environment variable that overrides a parameter.
+
+    /n11326158/s3/APP_BUCKET → CONFIG_S3_APP_BUCKET
+    """
+    return "CONFIG_" + name[len(PREFIX):].replace("/", "_").upper()
+
+
+class Config:
+    """In-memory copy of every parameter under PREFIX, refreshed after TTL.
+
+    SSM is only called outside `_lock`, so a slow refresh never blocks
+    readers; while one thread refreshes, the others keep the cached values.
+    """
+
+    def __init__(self):
+        self._values = {}
+        self._loaded = 0.0
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        self._client = None
+
+    def _ssm(self):
+        if self._client is None:
+            self._client = boto3.client("ssm", region_name=REGION)
+        return self._client
+
+    def _fetch(self):
+        """Load the whole prefix in one paginated by-path fetch.
+
+        Returns (values, names of the SecureString parameters among them).
+        """
+        values, secure = {}, set()
+        paginator = self._ssm().get_paginator("get_parameters_by_path")
+        for page in paginator.paginate(Path=PREFIX, Recursive=True, WithDecryption=True):
+            for param in page["Parameters"]:
+                values[param["Name"]] = param["Value"]
+                if param.get("Type") == "SecureString":
+                    secure.add(param["Name"])
+        print(f"[DEBUG] Loaded {len(values)} parameters from SSM")
+        return values, secure
+
+    def _read_snapshot(self):
+        try:
+            with open(SNAPSHOT_FILE) as f:
+                snapshot = json.load(f)
+        except (OSError, ValueError):
+            return None
+        print(f"[DEBUG] Read config snapshot {SNAPSHOT_FILE}")
+        return snapshot
+
+    def _write_snapshot(self, values, loaded, secure):
+        """Save every plain parameter; secrets never reach the disk."""
+        tmp = f"{SNAPSHOT_FILE}.tmp"
+        plain = {name: value for name, value in values.items() if name not in secure}
+        try:
+            fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with open(fd, "w") as f:
+                json.dump({"loaded": loaded, "values": plain}, f)
+            os.replace(tmp, SNAPSHOT_FILE)
+        except OSError as e:
+            print(f"[DEBUG] Could not write config snapshot: {e}")
+
+    def _overrides(self):
+        if not OVERRIDES_FILE:
+            return {}
+        with open(OVERRIDES_FILE) as f:
+            return json.load(f)
+
+    def _load(self):
+        """(values, loaded time) from the snapshot, SSM or nothing at all."""
+        if BACKEND == "file":
+            return {}, time.time()
+
+        if not self._loaded and SNAPSHOT_FILE:
+            snapshot = self._read_snapshot()
+            if snapshot and time.time() - snapshot["loaded"] < TTL:
+                return snapshot["values"], snapshot["loaded"]
+
+        values, secure = self._fetch()
+        loaded = time.time()
+        if SNAPSHOT_FILE:
+            self._write_snapshot(values, loaded, secure)
+        return values, loaded
+
+    def _refresh(self):
+        # Only the first load waits for a refresh already in progress
+        if not self._refresh_lock.acquire(blocking=not self._loaded):
+            return
+        try:
+            if time.time() - self._loaded < TTL:
+                return
+            try:
+                values, loaded = self._load()
+            except Exception as e:
+                if not self._values:
+                    raise
+                # Keep serving the last good values; try again on the next access
+                print(f"[DEBUG] Config refresh failed, keeping cached values: {e}")
+                return
+            values.update(self._overrides())
+            with self._lock:
+                self._values, self._loaded = values, loaded
+        finally:
+            self._refresh_lock.release()
+
+    def get(self, name):
+        env = os.environ.get(env_name(name))
+        if env is not None:
+            return env
+
+        if time.time() - self._loaded >= TTL:
+            self._refresh()
+        with self._lock:
+            if name in self._values:
+                return self._values[name]
+
+        if BACKEND == "file":
+            raise KeyError(f"Parameter {name} not configured")
+        # Outside PREFIX, a secret left out of the snapshot or created since
+        # the last load: fetch it alone
+        value = self._ssm().get_parameter(Name=name, WithDecryption=True)["Parameter"]["Value"]
+        with self._lock:
+            self._values[name] = value
+        return value
+
+
+config = Config()
@@ -0,0 +1,95 @@
+import time
+import hashlib
+from app.services import s3, ddb
+from app.utils import keys, thumbnails
+
+# Read size used while hashing
+HASH_CHUNK = 1024 * 1024
+# A first reference waits this long for an in-flight deletion of the same
+# content to finish; older deleting marks are left by crashed releases
+DELETE_WAIT = 30
+DELETE_POLL = 0.2
+
+
+def digest_file(fileobj):
+    """SHA-256 hex digest of a binary file object, read from its start."""
+    fileobj.seek(0)
+    digest = hashlib.sha256()
+    for chunk in iter(lambda: fileobj.read(HASH_CHUNK), b""):
+        digest.update(chunk)
+    fileobj.seek(0)
+    return digest.hexdigest()
+
+
+def exists(digest):
+    """Whether an object with this content is stored and referenced."""
+    return ddb.get_content_refs(digest) > 0 and bool(s3.get_etag(keys.content_key(digest)))
+
+
+def acquire(digest, store):
+    """Take a reference to the object holding `digest`'s bytes.
+
+    `store(key)` is called to write the object when this is the first
+    reference (or the object has gone missing). Returns (key, whether it
+    was stored now).
+    """
+    key = keys.content_key(digest)
+    refs = ddb.add_content_ref(digest, 1)
+    try:
+        if refs == 1:
+            _wait_for_delete(digest)
+        stored = refs == 1 or not s3.get_etag(key)
+        if stored:
+            store(key)
+    except Exception:
+        release(digest)
+        raise
+    print(f"[DEBUG] Content {digest[:12]}… now has {refs} references (stored={stored})")
+    return key, stored
+
+
+def _wait_for_delete(digest):
+    """Block while a release is deleting this content's object, so a fresh
+    copy stored by acquire() can't be deleted underneath it."""
+    deadline = time.time() + DELETE_WAIT
+    while time.time() < deadline:
+        item = ddb.get_content(digest) or {}
+        marked = item.get("deleting")
+        if not marked or time.time() - int(marked) > DELETE_WAIT:
+            return
+        time.sleep(DELETE_POLL)
+
+
+def release(digest):
+    """Drop a reference; the last one deletes the object and its thumbnail.
+
+    The counter is marked "deleting" before the S3 delete, and a concurrent
+    acquire() taking the first new reference waits for the mark to clear
+    before it stores the object again. Returns True when the object was
+    deleted for good.
+    """
+    refs = ddb.add_content_ref(digest, -1)
+    if refs > 0 or not ddb.mark_content_deleting(digest):
+        return False
+    key = keys.content_key(digest)
+    try:
+        s3.delete_keys([key, thumbnails.thumbnail_key(key)])
+    except Exception:
+        ddb.unmark_content_deleting(digest)
+        raise
+    if not ddb.drop_content(digest):
+        # Referenced again while deleting: the new owner stores it afresh
+        ddb.unmark_content_deleting(digest)
+        print(f"[DEBUG] Content {digest[:12]}… re-referenced during delete")
+        return False
+    print(f"[DEBUG] Content {digest[:12]}… unreferenced, deleted {key}")
+    return True
+
+
+def release_record(record):
+    """Let go of an upload record's object: its content reference, or for
+    records from before deduplication, the object itself."""
+    if record.get("content_hash"):
+        return release(record["content_hash"])
+    s3.delete_keys(thumbnails.object_keys(record, keys.record_key(record)))
+    return True
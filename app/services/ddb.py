@@ -1,100 +1,437 @@
+import os
 import boto3
 import time
 import uuid
+import json
+import base64
+from concurrent.futures import ThreadPoolExecutor
+from boto3.dynamodb.conditions import Key
+from botocore.exceptions import ClientError
 
 from app.services.param_store import get_param
+from app.utils.lazy import lazy
+from app.utils.metrics import timed
+from app.utils.keys import NO_OWNER
 
-REGION = get_param("/n11326158/REGION")
-UPLOADS_TABLE = get_param("/n11326158/dynamodb/UPLOADS_TABLE")
-RESULTS_TABLE = get_param("/n11326158/dynamodb/RESULTS_TABLE")
+@lazy
+def dynamodb():
+    """DynamoDB resource, built on first use so importing this module stays cheap."""
+    return boto3.resource("dynamodb", region_name=get_param("/n11326158/REGION"))
 
-dynamodb = boto3.resource("dynamodb", region_name=REGION)
-uploads_table = dynamodb.Table(UPLOADS_TABLE)
-results_table = dynamodb.Table(RESULTS_TABLE)
+
+@lazy
+def uploads_table():
+    return dynamodb().Table(get_param("/n11326158/dynamodb/UPLOADS_TABLE"))
+
+
+@lazy
+def results_table():
+    return dynamodb().Table(get_param("/n11326158/dynamodb/RESULTS_TABLE"))
+
+
+# GSIs: per-user history, and every record of a kind ("upload"/"result") by time
+USER_INDEX = "user-timestamp-index"
+KIND_INDEX = "kind-timestamp-index"
+# Per-user history keyed on the lower-cased user, for case-insensitive lookups
+FOLDED_USER_INDEX = "user_folded-timestamp-index"
+QUERY_BATCH = 100
+# Point lookups of one user's records by exact filename / output name
+UPLOAD_NAME_INDEX = "user-filename-index"
+RESULT_NAME_INDEX = "user-output-index"
+# Point lookup of one user's uploads holding a given content hash (sparse:
+# only deduplicated records carry content_hash)
+UPLOAD_CONTENT_INDEX = "user-content-index"
+# Parallel scan segments used to empty a table
+CLEAR_SEGMENTS = int(os.environ.get("DDB_CLEAR_SEGMENTS", 4))
+# Reference counters of content-addressed upload objects live in the uploads
+# table under this id prefix, with kind "content"
+CONTENT_PREFIX = "content#"
+
+
+# ---------- Index queries ----------
+def encode_cursor(item, partition):
+    """Opaque token pointing just past `item` in an index."""
+    key = {k: item[k] for k in ("id", partition, "timestamp")}
+    return base64.urlsafe_b64encode(json.dumps(key, default=int).encode()).decode()
+
+
+def decode_cursor(token, partition, value):
+    """Start key behind an encode_cursor token for the `partition` = `value`
+    listing; ValueError when it is malformed or from another listing."""
+    try:
+        key = json.loads(base64.urlsafe_b64decode(token.encode()))
+    except (ValueError, TypeError):
+        raise ValueError("Invalid cursor")
+    if (not isinstance(key, dict) or set(key) != {"id", partition, "timestamp"}
+            or key[partition] != value or not isinstance(key["timestamp"], int)):
+        raise ValueError("Invalid cursor")
+    return key
+
+
+def folded(user):
+    """Lower-cased user, the key of FOLDED_USER_INDEX."""
+    return (user or NO_OWNER).lower()
+
+
+@timed("ddb_query")
+def query_page(table, index, partition, value, limit, cursor=None, ascending=False, match=None):
+    """Return (items, next cursor) from one partition of a timestamp-sorted index.
+
+    `match` is an optional predicate applied to each item; pages keep being
+    read until `limit` items match or the partition runs out. A malformed
+    `cursor` raises ValueError.
+    """
+    kwargs = {
+        "IndexName": index,
+        "KeyConditionExpression": Key(partition).eq(value),
+        "ScanIndexForward": ascending,
+    }
+    if cursor:
+        kwargs["ExclusiveStartKey"] = decode_cursor(cursor, partition, value)
+
+    items = []
+    while True:
+        kwargs["Limit"] = QUERY_BATCH if match else limit - len(items)
+        response = table.query(**kwargs)
+        for item in response.get("Items", []):
+            if match and not match(item):
+                continue
+            items.append(item)
+            if len(items) == limit:
+                return items, encode_cursor(item, partition)
+        if "LastEvaluatedKey" not in response:
+            return items, None
+        kwargs["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+
+
+@timed("ddb_query")
+def query_all(table, index, partition, value):
+    """Every item in one partition of an index, newest first."""
+    kwargs = {"IndexName": index, "KeyConditionExpression": Key(partition).eq(value), "ScanIndexForward": False}
+    items = []
+    while True:
+        response = table.query(**kwargs)
+        items.extend(response.get("Items", []))
+        if "LastEvaluatedKey" not in response:
+            return items
+        kwargs["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+
+
+def _user_partition(user, any_case):
+    """(index, partition attribute, value) holding `user`'s records."""
+    if any_case:
+        return FOLDED_USER_INDEX, "user_folded", folded(user)
+    return USER_INDEX, "user", user
+
+
+def _query_kind(table, kind, user, limit, cursor, ascending, match, any_case):
+    if user:
+        return query_page(table, *_user_partition(user, any_case), limit, cursor, ascending, match)
+    return query_page(table, KIND_INDEX, "kind", kind, limit, cursor, ascending, match)
+
+
+@timed("ddb_query")
+def _find(table, index, name_attr, user, name):
+    """Every record of `user` whose `name_attr` is exactly `name`."""
+    kwargs = {
+        "IndexName": index,
+        "KeyConditionExpression": Key("user").eq(user or NO_OWNER) & Key(name_attr).eq(name),
+    }
+    items = []
+    while True:
+        response = table.query(**kwargs)
+        items.extend(response.get("Items", []))
+        if "LastEvaluatedKey" not in response:
+            return items
+        kwargs["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+
+
+def _without_nulls(record):
+    """Drop None attributes; NULL index keys (e.g. thumbnail-less records) would be rejected."""
+    return {k: v for k, v in record.items() if v is not None}
+
+
+def _clear_segment(table, segment, progress):
+    """Delete every item in one parallel-scan segment, reading keys only."""
+    # Resources aren't thread-safe; each segment gets its own
+    table = boto3.session.Session().resource(
+        "dynamodb", region_name=table.meta.client.meta.region_name
+    ).Table(table.name)
+    kwargs = {"ProjectionExpression": "id", "Segment": segment, "TotalSegments": CLEAR_SEGMENTS}
+    deleted = 0
+    with table.batch_writer() as batch:
+        while True:
+            response = table.scan(**kwargs)
+            items = response.get("Items", [])
+            for item in items:
+                batch.delete_item(Key={"id": item["id"]})
+            deleted += len(items)
+            if progress and items:
+                progress(records=len(items))
+            if "LastEvaluatedKey" not in response:
+                return deleted
+            kwargs["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+
+
+@timed("ddb_delete")
+def clear_table(table, progress=None):
+    """Delete every item of a table with CLEAR_SEGMENTS parallel key-only scans."""
+    with ThreadPoolExecutor(CLEAR_SEGMENTS) as pool:
+        futures = [pool.submit(_clear_segment, table, i, progress) for i in range(CLEAR_SEGMENTS)]
+        return sum(f.result() for f in futures)
 
 
 # ---------- Uploads ----------
-def save_upload_metadata(filename, resolution, size_bytes, user):
+@timed("ddb_put")
+def save_upload_metadata(filename, resolution, size_bytes, user, thumbnail=None, s3_key=None,
+                         content_hash=None):
     record = {
         "id": str(uuid.uuid4()),
         "filename": filename,
+        "s3_key": s3_key,
+        "content_hash": content_hash,
         "resolution": resolution,
         "size_bytes": size_bytes,
-        "user": user.get("username"),
+        "thumbnail": thumbnail,
+        "user": user.get("username") or NO_OWNER,
+        "user_folded": folded(user.get("username")),
+        "kind": "upload",
         "timestamp": int(time.time())
     }
     print(f"[DEBUG] Saving upload metadata → {record}")
-    uploads_table.put_item(Item=record)
+    uploads_table().put_item(Item=_without_nulls(record))
     return record
 
 
-def load_uploads():
-    """Return all upload records with pagination handling."""
-    print("[DEBUG] Scanning DynamoDB for uploads")
-    items = []
-    response = uploads_table.scan()
-    items.extend(response.get("Items", []))
+def query_uploads(user=None, limit=10, cursor=None, ascending=False, match=None, any_case=False):
+    """One page of uploads by time, for one user (matched case-insensitively
+    with `any_case`) or (user=None) everyone."""
+    print(f"[DEBUG] Querying uploads user={user}, limit={limit}, cursor={bool(cursor)}")
+    return _query_kind(uploads_table(), "upload", user, limit, cursor, ascending, match, any_case)
 
-    while "LastEvaluatedKey" in response:
-        response = uploads_table.scan(ExclusiveStartKey=response["LastEvaluatedKey"])
-        items.extend(response.get("Items", []))
 
+def find_uploads(user, filename):
+    """`user`'s upload records for `filename` (re-uploads share one object)."""
+    print(f"[DEBUG] Looking up upload {filename} of {user}")
+    return _find(uploads_table(), UPLOAD_NAME_INDEX, "filename", user, filename)
+
+
+def load_uploads(user=None, any_case=False):
+    """Return all upload records, `user`'s or everyone's, from the indexes."""
+    if user:
+        print(f"[DEBUG] Querying DynamoDB for uploads of {user}")
+        return query_all(uploads_table(), *_user_partition(user, any_case))
+
+    print("[DEBUG] Querying DynamoDB for every upload")
+    items = query_all(uploads_table(), KIND_INDEX, "kind", "upload")
     print(f"[DEBUG] Loaded {len(items)} upload records from DynamoDB")
     return items
 
 
+@timed("ddb_delete")
 def delete_upload_metadata(upload_id):
     print(f"[DEBUG] Deleting upload metadata id={upload_id}")
-    uploads_table.delete_item(Key={"id": upload_id})
+    uploads_table().delete_item(Key={"id": upload_id})
+
+
+@timed("ddb_update")
+def add_content_ref(digest, delta):
+    """Atomically add `delta` to an upload object's reference count; returns the new count."""
+    response = uploads_table().update_item(
+        Key={"id": CONTENT_PREFIX + digest},
+        UpdateExpression="ADD refs :d SET kind = :k",
+        ExpressionAttributeValues={":d": delta, ":k": "content"},
+        ReturnValues="UPDATED_NEW",
+    )
+    return int(response["Attributes"]["refs"])
+
+
+@timed("ddb_query")
+def get_content(digest):
+    """An upload object's counter item ({refs[, deleting]}), or None."""
+    return uploads_table().get_item(Key={"id": CONTENT_PREFIX + digest}, ConsistentRead=True).get("Item")
+
+
+def get_content_refs(digest):
+    item = get_content(digest)
+    return int(item["refs"]) if item else 0
+
+
+@timed("ddb_query")
+def owns_content(user, digest):
+    """Whether `user` has an upload record holding the content `digest`."""
+    response = uploads_table().query(
+        IndexName=UPLOAD_CONTENT_INDEX,
+        KeyConditionExpression=Key("user").eq(user or NO_OWNER) & Key("content_hash").eq(digest),
+        ProjectionExpression="id",
+        Limit=1,
+    )
+    return bool(response.get("Items"))
+
+
+def _conditional(call, **kwargs):
+    """Run a conditional write; False when its condition didn't hold."""
+    try:
+        call(**kwargs)
+        return True
+    except ClientError as e:
+        if e.response["Error"]["Code"] == "ConditionalCheckFailedException":
+            return False
+        raise
+
+
+@timed("ddb_update")
+def mark_content_deleting(digest):
+    """Claim an unreferenced object for deletion; False if it was referenced
+    again or someone else is already deleting it."""
+    return _conditional(
+        uploads_table().update_item,
+        Key={"id": CONTENT_PREFIX + digest},
+        UpdateExpression="SET deleting = :t",
+        ConditionExpression="refs <= :z AND attribute_not_exists(deleting)",
+        ExpressionAttributeValues={":t": int(time.time()), ":z": 0},
+    )
+
 
+@timed("ddb_update")
+def unmark_content_deleting(digest):
+    uploads_table().update_item(Key={"id": CONTENT_PREFIX + digest}, UpdateExpression="REMOVE deleting")
 
-def clear_uploads():
+
+@timed("ddb_delete")
+def drop_content(digest):
+    """Delete an object's counter if it is still unreferenced; False if it was
+    referenced again in the meantime."""
+    return _conditional(
+        uploads_table().delete_item,
+        Key={"id": CONTENT_PREFIX + digest},
+        ConditionExpression="refs <= :z",
+        ExpressionAttributeValues={":z": 0},
+    )
+
+
+@timed("ddb_update")
+def set_content(record_id, content_hash, s3_key, thumbnail=None):
+    """Point an upload record at the content-addressed object it now shares."""
+    expression = "SET s3_key = :k, content_hash = :h"
+    values = {":k": s3_key, ":h": content_hash}
+    if thumbnail:
+        expression += ", thumbnail = :t"
+        values[":t"] = thumbnail
+    uploads_table().update_item(Key={"id": record_id}, UpdateExpression=expression, ExpressionAttributeValues=values)
+
+
+def clear_uploads(progress=None):
     print("[DEBUG] Clearing all uploads from DynamoDB")
-    items = load_uploads()
-    with uploads_table.batch_writer() as batch:
-        for item in items:
-            batch.delete_item(Key={"id": item["id"]})
-    print(f"[DEBUG] Cleared {len(items)} upload records")
+    deleted = clear_table(uploads_table(), progress)
+    print(f"[DEBUG] Cleared {deleted} upload records")
+    return deleted
 
 
 # ---------- Results ----------
-def save_result_metadata(input_file, output_file, user):
+@timed("ddb_put")
+def save_result_metadata(input_file, output_file, user, thumbnail=None, s3_key=None,
+                         output_format=None, size_bytes=None):
     record = {
         "id": str(uuid.uuid4()),
         "input": input_file,
         "output": output_file,
-        "user": user.get("username"),
+        "s3_key": s3_key,
+        "format": output_format,
+        "size_bytes": size_bytes,
+        "thumbnail": thumbnail,
+        "user": user.get("username") or NO_OWNER,
+        "user_folded": folded(user.get("username")),
+        "kind": "result",
         "timestamp": int(time.time())
     }
     print(f"[DEBUG] Saving result metadata → {record}")
-    results_table.put_item(Item=record)
+    results_table().put_item(Item=_without_nulls(record))
     return record
 
 
-def load_results():
-    """Return all result records with pagination handling."""
-    print("[DEBUG] Scanning DynamoDB for results")
-    items = []
-    response = results_table.scan()
-    items.extend(response.get("Items", []))
+@timed("ddb_batch_write")
+def save_result_metadata_batch(entries, user):
+    """Save one record per (input_file, output_file, thumbnail, s3_key, format,
+    size_bytes) entry in a single batch."""
+    now = int(time.time())
+    records = [
+        {
+            "id": str(uuid.uuid4()),
+            "input": input_file,
+            "output": output_file,
+            "s3_key": s3_key,
+            "format": output_format,
+            "size_bytes": size_bytes,
+            "thumbnail": thumbnail,
+            "user": user.get("username") or NO_OWNER,
+            "user_folded": folded(user.get("username")),
+        "user_folded": folded(user.get("username")),
+            "kind": "result",
+            "timestamp": now
+        }
+        for input_file, output_file, thumbnail, s3_key, output_format, size_bytes in entries
+    ]
+    print(f"[DEBUG] Batch saving {len(records)} result records")
+    with results_table().batch_writer() as batch:
+        for record in records:
+            batch.put_item(Item=_without_nulls(record))
+    return records
 
-    while "LastEvaluatedKey" in response:
-        response = results_table.scan(ExclusiveStartKey=response["LastEvaluatedKey"])
-        items.extend(response.get("Items", []))
 
+def query_results(user=None, limit=5, cursor=None, ascending=False, match=None, any_case=False):
+    """One page of results by time, for one user (matched case-insensitively
+    with `any_case`) or (user=None) everyone."""
+    print(f"[DEBUG] Querying results user={user}, limit={limit}, cursor={bool(cursor)}")
+    return _query_kind(results_table(), "result", user, limit, cursor, ascending, match, any_case)
+
+
+def find_results(user, output_file):
+    """`user`'s result records for `output_file` (cache hits share one object)."""
+    print(f"[DEBUG] Looking up result {output_file} of {user}")
+    return _find(results_table(), RESULT_NAME_INDEX, "output", user, output_file)
+
+
+def load_results(user=None, any_case=False):
+    """Return all result records, `user`'s or everyone's, from the indexes."""
+    if user:
+        print(f"[DEBUG] Querying DynamoDB for results of {user}")
+        return query_all(results_table(), *_user_partition(user, any_case))
+
+    print("[DEBUG] Querying DynamoDB for every result")
+    items = query_all(results_table(), KIND_INDEX, "kind", "result")
     print(f"[DEBUG] Loaded {len(items)} result records from DynamoDB")
     return items
 
 
+@timed("ddb_update")
+def set_thumbnail(table, record_id, thumbnail):
+    """Point an existing record at its (backfilled) thumbnail."""
+    table.update_item(
+        Key={"id": record_id},
+        UpdateExpression="SET thumbnail = :t",
+        ExpressionAttributeValues={":t": thumbnail},
+    )
+
+
+@timed("ddb_update")
+def set_s3_key(table, record_id, s3_key, thumbnail=None):
+    """Point an existing record at its object's (migrated) key and thumbnail."""
+    expression, values = "SET s3_key = :k", {":k": s3_key}
+    if thumbnail:
+        expression += ", thumbnail = :t"
+        values[":t"] = thumbnail
+    table.update_item(Key={"id": record_id}, UpdateExpression=expression, ExpressionAttributeValues=values)
+
+
+@timed("ddb_delete")
 def delete_result_metadata(result_id):
     print(f"[DEBUG] Deleting result metadata id={result_id}")
-    results_table.delete_item(Key={"id": result_id})
+    results_table().delete_item(Key={"id": result_id})
 
 
-def clear_results():
+def clear_results(progress=None):
     print("[DEBUG] Clearing all results from DynamoDB")
-    items = load_results()
-    with results_table.batch_writer() as batch:
-        for item in items:
-            batch.delete_item(Key={"id": item["id"]})
-    print(f"[DEBUG] Cleared {len(items)} result records")
+    deleted = clear_table(results_table(), progress)
+    print(f"[DEBUG] Cleared {deleted} result records")
+    return deleted
@@ -0,0 +1,315 @@
+import io
+import os
+import math
+import shutil
+import tempfile
+import threading
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing.shared_memory import SharedMemory
+from PIL import Image
+from app.utils import tiling, thumbnails, metrics, encoding
+from app.utils.planner import execute_plan, output_size
+
+# Size of the render pool; 0 renders on the request thread instead
+POOL_SIZE = int(os.environ.get("WORKER_PROCESSES", os.cpu_count() or 1))
+# Pin each pool process to its own core
+PIN_CPUS = os.environ.get("WORKER_PIN_CPUS", "0") == "1"
+
+# Image info passed to pool processes with the pixels
+KEPT_INFO = ("transparency", "icc_profile", "exif")
+# Rows copied into shared memory per step, bounding the extra copy
+SHARE_BAND_ROWS = 256
+# Chunk size when copying a tiled render's file into the output buffer
+COPY_CHUNK = 4 * 1024 * 1024
+
+_pool = None
+_pool_lock = threading.Lock()
+_cpu_counter = None
+
+
+def render(img, plan, out_format, out, output=None):
+    """Run a plan and encode the result into `out`.
+
+    `out_format` is the source's format, kept unless the `output` settings
+    ask for another one. Returns (format used, encoded thumbnail bytes).
+    """
+    if tiling.needs_tiling(img, plan):
+        with metrics.timer("tiled_render"):
+            thumb = tiling.execute_tiled(
+                img, plan, out,
+                preview=lambda source, size: thumbnails.make_thumbnail(source, thumbnails.fit(size))
+            )
+        return "PNG", thumb
+    img = execute_plan(img, plan)
+    with metrics.timer("encode"):
+        out_format = encoding.encode(img, out, out_format, output)
+    with metrics.timer("thumbnail"):
+        return out_format, thumbnails.make_thumbnail(img)
+
+
+def _init_process(counter, cpus):
+    if not PIN_CPUS:
+        return
+    with counter.get_lock():
+        index = counter.value
+        counter.value += 1
+    cpu = cpus[index % len(cpus)]
+    os.sched_setaffinity(0, {cpu})
+    print(f"[DEBUG] Render process {os.getpid()} pinned to CPU {cpu}")
+
+
+def _attach(name, mode, size, palette, info):
+    """Pool side: rebuild an image from a SharedImage's args."""
+    shm = SharedMemory(name=name)
+    try:
+        img = Image.frombytes(mode, size, shm.buf)
+    finally:
+        shm.close()
+    if palette:
+        img.putpalette(palette)
+    img.info.update(info)
+    return img
+
+
+def _share(data):
+    """Pool side: copy `data` into a new segment; returns (name, nbytes).
+
+    Pool processes share the parent's resource tracker, so segments are
+    tracked once and released by the parent's unlink().
+    """
+    result = SharedMemory(create=True, size=max(len(data), 1))
+    result.buf[:len(data)] = data
+    name = result.name
+    result.close()
+    return name, len(data)
+
+
+def _take(name, nbytes):
+    """Parent side: copy out and unlink a segment made by _share."""
+    result = SharedMemory(name=name)
+    try:
+        return bytes(result.buf[:nbytes])
+    finally:
+        result.close()
+        result.unlink()
+
+
+def _render_task(name, mode, size, palette, info, plan, out_format, output):
+    """Pool side: read pixels from shared memory, render, and hand back the
+    encoded output plus stage timings.
+
+    The output comes back as ("shm", segment, nbytes) for the parent to
+    unlink, or, for tiled renders that can outgrow memory, as
+    ("file", path) of a temp file the banded PNG was streamed into.
+    """
+    img = _attach(name, mode, size, palette, info)
+
+    if tiling.needs_tiling(img, plan):
+        out = tempfile.NamedTemporaryFile(prefix="render-", suffix=".png", delete=False)
+        try:
+            with out, metrics.collect() as timings:
+                out_format, thumb = render(img, plan, out_format, out, output)
+        except BaseException:
+            os.unlink(out.name)
+            raise
+        return ("file", out.name), out_format, thumb, timings
+
+    out = io.BytesIO()
+    with metrics.collect() as timings:
+        out_format, thumb = render(img, plan, out_format, out, output)
+
+    data = out.getbuffer()
+    handle = ("shm", *_share(data))
+    del data
+    return handle, out_format, thumb, timings
+
+
+def _receive(handle, out):
+    """Parent side: write a _render_task output into `out` and release it."""
+    if handle[0] == "file":
+        try:
+            with open(handle[1], "rb") as f:
+                shutil.copyfileobj(f, out, COPY_CHUNK)
+        finally:
+            os.unlink(handle[1])
+        return
+    _, name, nbytes = handle
+    result = SharedMemory(name=name)
+    try:
+        out.write(result.buf[:nbytes])
+    finally:
+        result.close()
+        result.unlink()
+
+
+def _frames_task(frames, plan):
+    """Pool side of render_frames: run the plan on a run of frames (given as
+    SharedImage args) and hand each back in its own segment, plus timings."""
+    rendered = []
+    with metrics.collect() as timings:
+        for args in frames:
+            img = execute_plan(_attach(*args), plan)
+            rendered.append((*_share(img.tobytes()), img.mode, img.size))
+    return rendered, timings
+
+
+def get_pool():
+    """Return this process's render pool, created on first use."""
+    global _pool, _cpu_counter
+    with _pool_lock:
+        if _pool is None and POOL_SIZE > 0:
+            method = "forkserver" if "forkserver" in mp.get_all_start_methods() else "spawn"
+            ctx = mp.get_context(method)
+            _cpu_counter = ctx.Value("i", 0)
+            cpus = sorted(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else [0]
+            _pool = ProcessPoolExecutor(
+                max_workers=POOL_SIZE,
+                mp_context=ctx,
+                initializer=_init_process,
+                initargs=(_cpu_counter, cpus),
+            )
+            print(f"[DEBUG] Started render pool: {POOL_SIZE} processes ({method})")
+        return _pool
+
+
+def reset_pool(pool):
+    """Drop a broken pool so get_pool() builds a new one."""
+    global _pool
+    with _pool_lock:
+        if _pool is pool:
+            _pool = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+class SharedImage:
+    """Decoded pixels placed in shared memory once and reusable by many renders."""
+
+    def __init__(self, img):
+        img.load()
+        self.img = img
+        stride = len(img.crop((0, 0, img.width, 1)).tobytes())
+        self.shm = SharedMemory(create=True, size=max(stride * img.height, 1))
+        # Copy band by band so a full tobytes() copy never sits beside the image
+        for top in range(0, img.height, SHARE_BAND_ROWS):
+            band = img.crop((0, top, img.width, min(img.height, top + SHARE_BAND_ROWS))).tobytes()
+            self.shm.buf[top * stride:top * stride + len(band)] = band
+        self.args = (
+            self.shm.name,
+            img.mode,
+            img.size,
+            img.getpalette() if img.mode == "P" else None,
+            {k: v for k, v in img.info.items() if k in KEPT_INFO},
+        )
+
+    @property
+    def size(self):
+        return self.img.size
+
+    @property
+    def mode(self):
+        return self.img.mode
+
+    def close(self):
+        self.shm.close()
+        self.shm.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def submit(img, plan, out_format, out, output=None):
+    """Render in the process pool, passing pixels through shared memory.
+
+    `img` is a PIL image or a SharedImage. Encoded output is written into
+    `out`; returns (format used, encoded thumbnail bytes).
+    """
+    pool = get_pool()
+    if pool is None:
+        source = img.img if isinstance(img, SharedImage) else img
+        return render(source, plan, out_format, out, output)
+
+    shared = img if isinstance(img, SharedImage) else SharedImage(img)
+    try:
+        handle, out_format, thumb, timings = pool.submit(
+            _render_task, *shared.args, plan, out_format, output
+        ).result()
+    except BrokenProcessPool:
+        # A render process died (e.g. OOM-killed); start a fresh pool next time
+        reset_pool(pool)
+        raise
+    finally:
+        if shared is not img:
+            shared.close()
+
+    # Stages timed in the pool process count here, where /metrics is served
+    for stage, seconds in timings:
+        metrics.record(stage, seconds)
+
+    _receive(handle, out)
+    return out_format, thumb
+
+
+def render_frames(frames, plan):
+    """Run a plan on every frame, spreading contiguous runs of frames over
+    the pool; returns the rendered frames in order."""
+    pool = get_pool()
+    if pool is None or len(frames) == 1:
+        return [execute_plan(frame, plan) for frame in frames]
+
+    shared = []
+    try:
+        for frame in frames:
+            shared.append(SharedImage(frame))
+        run = math.ceil(len(shared) / POOL_SIZE)
+        futures = [
+            pool.submit(_frames_task, [s.args for s in shared[i:i + run]], plan)
+            for i in range(0, len(shared), run)
+        ]
+        results, error = [], None
+        for future in futures:
+            try:
+                results.append(future.result())
+            except Exception as e:
+                error = error or e
+
+        # Take back every segment handed over, even when another run failed
+        rendered = []
+        for frames_out, timings in results:
+            for stage, seconds in timings:
+                metrics.record(stage, seconds)
+            for name, nbytes, mode, size in frames_out:
+                rendered.append(Image.frombytes(mode, size, _take(name, nbytes)))
+        if error:
+            if isinstance(error, BrokenProcessPool):
+                reset_pool(pool)
+            raise error
+        return rendered
+    finally:
+        for s in shared:
+            s.close()
+
+
+def render_animation(anim, plan, out, output=None):
+    """Render every frame of an Animation and encode it into `out`.
+
+    Returns (format used, encoded thumbnail bytes of the first frame).
+    """
+    if not encoding.stores_animation(output):
+        # A still format was asked for: render and store the first frame
+        return render(anim.frames[0], plan, "GIF", out, output)
+    w, h = output_size(plan, anim.size)
+    if w * h * 4 * len(anim) > tiling.MEMORY_BUDGET:
+        raise tiling.MemoryBudgetExceeded(
+            f"{len(anim)} frames of {w}x{h} need more than {tiling.MEMORY_BUDGET // tiling.MB} MB"
+        )
+    with metrics.timer("frames"):
+        frames = render_frames(anim.frames, plan)
+    with metrics.timer("encode"):
+        out_format = encoding.encode_animation(anim.with_frames(frames), out, output)
+    with metrics.timer("thumbnail"):
+        return out_format, thumbnails.make_thumbnail(frames[0])
@@ -0,0 +1,215 @@
+import os
+import json
+import time
+import uuid
+import sqlite3
+import threading
+from contextlib import closing
+
+# The API and worker run in separate containers, so the SQLite file must sit
+# on a volume both mount; without one, jobs go through SQS
+SQLITE_PATH = os.environ.get("JOB_QUEUE_PATH")
+BACKEND = os.environ.get("JOB_QUEUE_BACKEND", "sqlite" if SQLITE_PATH else "sqs")
+JOB_TIMEOUT = int(os.environ.get("JOB_TIMEOUT", 900))
+POLL_INTERVAL = float(os.environ.get("JOB_POLL_INTERVAL", 0.5))
+
+
+class SQLiteJobQueue:
+    """Local stand-in for the job queue, shared through a SQLite file."""
+
+    def __init__(self, path=SQLITE_PATH):
+        if not path:
+            raise RuntimeError("JOB_QUEUE_PATH must name a file on a volume shared by the API and worker")
+        self.path = path
+        with closing(self._connect()) as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                "id TEXT PRIMARY KEY, payload TEXT, status TEXT, "
+                "status_code INTEGER, result TEXT, created REAL, updated REAL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created)")
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=30, isolation_level=None)
+
+    def submit(self, payload):
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        with closing(self._connect()) as conn:
+            conn.execute(
+                "INSERT INTO jobs (id, payload, status, created, updated) VALUES (?, ?, 'queued', ?, ?)",
+                (job_id, json.dumps(payload), now, now),
+            )
+        print(f"[DEBUG] Queued job {job_id} (sqlite)")
+        return job_id
+
+    def claim(self):
+        """Atomically move the oldest queued job to running and return it."""
+        now = time.time()
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            # Jobs stuck in running past the timeout belong to a dead worker
+            conn.execute(
+                "UPDATE jobs SET status = 'queued' WHERE status = 'running' AND updated < ?",
+                (now - JOB_TIMEOUT,),
+            )
+            row = conn.execute(
+                "SELECT id, payload FROM jobs WHERE status = 'queued' ORDER BY created LIMIT 1"
+            ).fetchone()
+            if row:
+                conn.execute("UPDATE jobs SET status = 'running', updated = ? WHERE id = ?", (now, row[0]))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        finally:
+            conn.close()
+
+        if not row:
+            time.sleep(POLL_INTERVAL)
+            return None
+        return {"id": row[0], "payload": json.loads(row[1])}
+
+    def complete(self, job, result, status_code):
+        status = "done" if status_code < 400 else "failed"
+        with closing(self._connect()) as conn:
+            conn.execute(
+                "UPDATE jobs SET status = ?, status_code = ?, result = ?, updated = ? WHERE id = ?",
+                (status, status_code, json.dumps(result), time.time(), job["id"]),
+            )
+
+    def get(self, job_id):
+        with closing(self._connect()) as conn:
+            row = conn.execute(
+                "SELECT id, status, status_code, result, created, updated, payload FROM jobs WHERE id = ?",
+                (job_id,),
+            ).fetchone()
+        if not row:
+            return None
+        return {
+            "id": row[0],
+            "status": row[1],
+            "status_code": row[2],
+            "result": json.loads(row[3]) if row[3] else None,
+            "created": row[4],
+            "updated": row[5],
+            "username": json.loads(row[6]).get("username"),
+        }
+
+
+class SQSJobQueue:
+    """SQS delivers the jobs; a DynamoDB table holds their status and results."""
+
+    def __init__(self):
+        import boto3
+        from app.services.param_store import get_param
+
+        region = get_param("/n11326158/REGION")
+        self.queue_url = get_param("/n11326158/sqs/JOBS_QUEUE_URL")
+        self.sqs = boto3.client("sqs", region_name=region)
+        self.table = boto3.resource("dynamodb", region_name=region).Table(
+            get_param("/n11326158/dynamodb/JOBS_TABLE")
+        )
+
+    def submit(self, payload):
+        job_id = uuid.uuid4().hex
+        now = int(time.time())
+        self.table.put_item(Item={
+            "id": job_id, "status": "queued", "username": payload.get("username"), "created": now, "updated": now
+        })
+        self.sqs.send_message(QueueUrl=self.queue_url, MessageBody=json.dumps({"id": job_id, "payload": payload}))
+        print(f"[DEBUG] Queued job {job_id} (sqs)")
+        return job_id
+
+    def claim(self):
+        response = self.sqs.receive_message(
+            QueueUrl=self.queue_url,
+            MaxNumberOfMessages=1,
+            WaitTimeSeconds=20,
+            VisibilityTimeout=JOB_TIMEOUT,
+        )
+        messages = response.get("Messages", [])
+        if not messages:
+            return None
+        job = json.loads(messages[0]["Body"])
+        job["receipt"] = messages[0]["ReceiptHandle"]
+        self.table.update_item(
+            Key={"id": job["id"]},
+            UpdateExpression="SET #s = :s, updated = :u",
+            ExpressionAttributeNames={"#s": "status"},
+            ExpressionAttributeValues={":s": "running", ":u": int(time.time())},
+        )
+        return job
+
+    def complete(self, job, result, status_code):
+        self.table.update_item(
+            Key={"id": job["id"]},
+            UpdateExpression="SET #s = :s, status_code = :c, #r = :r, updated = :u",
+            ExpressionAttributeNames={"#s": "status", "#r": "result"},
+            ExpressionAttributeValues={
+                ":s": "done" if status_code < 400 else "failed",
+                ":c": status_code,
+                ":r": json.dumps(result),
+                ":u": int(time.time()),
+            },
+        )
+        self.sqs.delete_message(QueueUrl=self.queue_url, ReceiptHandle=job["receipt"])
+
+    def get(self, job_id):
+        item = self.table.get_item(Key={"id": job_id}).get("Item")
+        if not item:
+            return None
+        if item.get("result"):
+            item["result"] = json.loads(item["result"])
+        return item
+
+
+BACKENDS = {"sqlite": SQLiteJobQueue, "sqs": SQSJobQueue}
+
+_queue = None
+_queue_lock = threading.Lock()
+
+
+def get_queue():
+    """Return the configured queue backend, created on first use."""
+    global _queue
+    with _queue_lock:
+        if _queue is None:
+            print(f"[DEBUG] Using job queue backend: {BACKEND}")
+            _queue = BACKENDS[BACKEND]()
+        return _queue
+
+
+def _consume(handler):
+    queue = get_queue()
+    while True:
+        try:
+            job = queue.claim()
+        except Exception as e:
+            print(f"[ERROR] Failed to claim job: {e}")
+            time.sleep(POLL_INTERVAL)
+            continue
+        if job is None:
+            continue
+
+        print(f"[DEBUG] Running job {job['id']}")
+        try:
+            result, status_code = handler(job["payload"])
+        except Exception as e:
+            result, status_code = {"error": f"Processing failed: {str(e)}"}, 500
+        try:
+            queue.complete(job, result, status_code)
+        except Exception as e:
+            print(f"[ERROR] Failed to record job {job['id']}: {e}")
+
+
+def start_workers(handler, count):
+    """Start `count` daemon threads pulling jobs and passing payloads to handler.
+
+    The queue backend is created by the threads themselves, so startup
+    doesn't wait on it.
+    """
+    for i in range(count):
+        threading.Thread(target=_consume, args=(handler,), name=f"job-worker-{i}", daemon=True).start()
+    print(f"[DEBUG] Started {count} job workers")
@@ -0,0 +1,180 @@
+import math
+import time
+import random
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from requests.adapters import HTTPAdapter
+
+# Default operation mix: the old /stress workload plus the cheap operations
+DEFAULT_MIX = [
+    {"weight": 2, "operations": {"rotate": 5, "upscale": 30}},
+    {"weight": 3, "operations": {"blur": 2}},
+    {"weight": 3, "operations": {"grayscale": True}},
+    {"weight": 2, "operations": {"resize": {"width": 800, "height": 600}, "flip": "horizontal"}},
+]
+
+# Latency histogram bucket upper bounds (seconds), roughly log-spaced
+BUCKETS = [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, math.inf]
+
+
+def percentile(sorted_values, p):
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return None
+    rank = max(1, math.ceil(p / 100 * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+class Recorder:
+    """Thread-safe collector of per-request outcomes."""
+
+    def __init__(self):
+        self.latencies = []
+        self.errors = Counter()
+        self.ops = Counter()
+        self.sent = 0
+        self._lock = threading.Lock()
+
+    def record(self, name, latency, error=None):
+        with self._lock:
+            self.sent += 1
+            self.ops[name] += 1
+            if error is None:
+                self.latencies.append(latency)
+            else:
+                self.errors[error] += 1
+
+    def report(self, elapsed):
+        with self._lock:
+            latencies = sorted(self.latencies)
+            errors = dict(self.errors)
+            ops = dict(self.ops)
+            sent = self.sent
+
+        histogram, lower = [], 0
+        for upper in BUCKETS:
+            count = sum(1 for v in latencies if lower < v <= upper)
+            histogram.append({"le": "+Inf" if upper == math.inf else upper, "count": count})
+            lower = upper
+
+        return {
+            "elapsed": round(elapsed, 3),
+            "requests_sent": sent,
+            "successes": len(latencies),
+            "failures": sent - len(latencies),
+            "throughput": round(len(latencies) / elapsed, 3) if elapsed else 0.0,
+            "latency": {
+                "p50": percentile(latencies, 50),
+                "p95": percentile(latencies, 95),
+                "p99": percentile(latencies, 99),
+                "max": latencies[-1] if latencies else None,
+                "mean": sum(latencies) / len(latencies) if latencies else None,
+            },
+            "histogram": histogram,
+            "errors": errors,
+            "operations": ops,
+        }
+
+
+def _session(concurrency, headers=None):
+    s = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=concurrency)
+    s.mount("http://", adapter)
+    s.mount("https://", adapter)
+    s.headers.update(headers or {})
+    return s
+
+
+def check_mix(mix):
+    """Raise ValueError unless `mix` is a non-empty list of
+    {weight, operations[, name]} entries with some positive weight."""
+    if not isinstance(mix, list) or not mix:
+        raise ValueError("mix must be a non-empty list of {weight, operations} objects")
+    for i, entry in enumerate(mix):
+        if not isinstance(entry, dict) or not isinstance(entry.get("operations"), dict):
+            raise ValueError(f"mix entry {i} must be an object with an operations object")
+        weight = entry.get("weight", 1)
+        if isinstance(weight, bool) or not isinstance(weight, (int, float)) or not 0 <= weight < math.inf:
+            raise ValueError(f"mix entry {i} weight must be a non-negative number")
+        if not isinstance(entry.get("name", ""), str):
+            raise ValueError(f"mix entry {i} name must be a string")
+    if not any(entry.get("weight", 1) > 0 for entry in mix):
+        raise ValueError("mix needs at least one entry with a positive weight")
+
+
+def _pick(mix, rng):
+    """Choose one entry of the mix, weighted by its "weight"."""
+    return rng.choices(mix, weights=[m.get("weight", 1) for m in mix])[0]
+
+
+def _send(session, url, job, entry, timeout, recorder, scheduled):
+    name = entry.get("name") or ",".join(entry["operations"])
+    try:
+        resp = session.post(url, json={**job, "operations": entry["operations"]}, timeout=timeout)
+        # Latency counts from when the request was due, so a backed-up
+        # client doesn't hide server slowness (coordinated omission)
+        latency = time.perf_counter() - scheduled
+        error = None if resp.status_code == 200 else f"HTTP {resp.status_code}"
+    except requests.exceptions.RequestException as e:
+        latency = time.perf_counter() - scheduled
+        error = type(e).__name__
+    recorder.record(name, latency, error)
+
+
+def run(url, filename, duration=30, concurrency=8, rate=None, mix=None,
+        timeout=60, headers=None, seed=None, stop=None, user=None, owner=None):
+    """Drive `url` with jobs for `duration` seconds and return a report.
+
+    `user` is sent as the jobs' username and `owner` (default `user`) as
+    the uploader of `filename`; the worker looks sources up per user.
+
+    Without `rate` this is closed-loop: `concurrency` clients each send
+    the next request as soon as the last one returns. With `rate` it is
+    open-loop: requests arrive as a Poisson process at `rate` per second
+    regardless of how fast they complete, with at most `concurrency` in
+    flight (the rest queue and their wait counts as latency).
+    """
+    mix = mix or DEFAULT_MIX
+    job = {"filename": filename}
+    if user:
+        job.update(username=user, owner=owner or user)
+    rng = random.Random(seed)
+    recorder = Recorder()
+    session = _session(concurrency, headers)
+    stop = stop or threading.Event()
+    start = time.perf_counter()
+    deadline = start + duration
+
+    print(f"[INFO] Load test: {url} for {duration}s, concurrency={concurrency}, "
+          f"rate={rate or 'closed-loop'}")
+
+    if rate:
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            due = start
+            while not stop.is_set():
+                due += rng.expovariate(rate)
+                if due >= deadline:
+                    break
+                delay = due - time.perf_counter()
+                if delay > 0:
+                    stop.wait(delay)
+                pool.submit(_send, session, url, job, _pick(mix, rng), timeout, recorder, due)
+    else:
+        def client(seed):
+            client_rng = random.Random(seed)
+            while not stop.is_set() and time.perf_counter() < deadline:
+                _send(session, url, job, _pick(mix, client_rng), timeout, recorder, time.perf_counter())
+
+        threads = [threading.Thread(target=client, args=(rng.random(),), daemon=True) for _ in range(concurrency)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+    report = recorder.report(time.perf_counter() - start)
+    report.update({"url": url, "duration": duration, "concurrency": concurrency, "rate": rate})
+    print(f"[INFO] Load test finished: {report['successes']} ok, {report['failures']} failed, "
+          f"{report['throughput']} req/s")
+    return report
@@ -1,7 +1,5 @@
-import boto3
+from app.services.config import config
 
 
 def get_param(name):
-    client = boto3.client("ssm", region_name="ap-southeast-2")
-    response = client.get_parameter(Name=name)
-    return response["Parameter"]["Value"]
\ No newline at end of file
+    return config.get(name)
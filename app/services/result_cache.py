@@ -0,0 +1,71 @@
+import os
+import json
+import time
+import threading
+from collections import OrderedDict
+
+MAX_ENTRIES = int(os.environ.get("RESULT_CACHE_MAX_ENTRIES", 512))
+MAX_AGE = int(os.environ.get("RESULT_CACHE_MAX_AGE", 24 * 3600))
+
+
+def cache_key(etag, operations):
+    """Build a cache key from the source ETag and canonical operations."""
+    canonical = json.dumps(operations, sort_keys=True, separators=(",", ":"))
+    return etag.strip('"') + ":" + canonical
+
+
+class ResultCache:
+    """LRU map of (source ETag, operations) → result key with age expiry."""
+
+    def __init__(self, max_entries=MAX_ENTRIES, max_age=MAX_AGE):
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and time.time() - entry["stored"] > self.max_age:
+                del self._entries[key]
+                self.evictions += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry["value"]
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = {"value": value, "stored": time.time()}
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key):
+        """Drop an entry whose result object no longer exists."""
+        with self._lock:
+            if self._entries.pop(key, None) is not None:
+                # The lookup that found it was not a real hit
+                self.hits -= 1
+                self.misses += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "max_age": self.max_age,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+
+results = ResultCache()
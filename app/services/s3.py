@@ -1,79 +1,294 @@
 import boto3
 import os
+import base64
+import time
+import tempfile
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
+from boto3.s3.transfer import TransferConfig
+from botocore.exceptions import ClientError
 from app.services.param_store import get_param
+from app.utils.lazy import lazy
+from app.utils.metrics import timed
 
-REGION = get_param("/n11326158/REGION")
-BUCKET = get_param("/n11326158/s3/APP_BUCKET")
+MB = 1024 * 1024
+# In-memory transfers spill to a temp file above this many bytes
+SPILL_THRESHOLD = int(os.environ.get("S3_SPILL_THRESHOLD", 256 * MB))
 
-s3 = boto3.client("s3", region_name=REGION)
+# Cached presigned URLs are reused for this long, then re-signed
+PRESIGN_CACHE_TTL = int(os.environ.get("PRESIGN_CACHE_TTL", 300))
+PRESIGN_CACHE_MAX = 10000
 
+_presign_cache = {}
+_presign_lock = threading.Lock()
 
+# delete_objects takes at most 1000 keys; pages of that size are deleted in parallel
+DELETE_BATCH = 1000
+DELETE_WORKERS = int(os.environ.get("S3_DELETE_WORKERS", 8))
+# list_objects_v2 returns at most this many keys per request
+LIST_PAGE_MAX = 1000
+
+# Shared by every transfer; large upscale outputs go up as parallel parts
+TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=int(os.environ.get("S3_MULTIPART_THRESHOLD", 16 * MB)),
+    multipart_chunksize=int(os.environ.get("S3_MULTIPART_CHUNKSIZE", 16 * MB)),
+    max_concurrency=int(os.environ.get("S3_MAX_CONCURRENCY", 16)),
+    use_threads=True,
+)
+
+
+@lazy
+def bucket():
+    return get_param("/n11326158/s3/APP_BUCKET")
+
+
+@lazy
+def client():
+    """S3 client, built on first use so importing this module stays cheap."""
+    return boto3.client("s3", region_name=get_param("/n11326158/REGION"))
+
+
+@timed("s3_upload")
 def upload_file_to_s3(local_path, key):
-    print(f"[DEBUG] Uploading {local_path} → s3://{BUCKET}/{key}")
-    s3.upload_file(local_path, BUCKET, key)
+    print(f"[DEBUG] Uploading {local_path} → s3://{bucket()}/{key}")
+    client().upload_file(local_path, bucket(), key, Config=TRANSFER_CONFIG)
     return key
 
 
+@timed("s3_download")
 def download_file_from_s3(key, local_path):
-    print(f"[DEBUG] Downloading s3://{BUCKET}/{key} → {local_path}")
-    s3.download_file(BUCKET, key, local_path)
+    print(f"[DEBUG] Downloading s3://{bucket()}/{key} → {local_path}")
+    client().download_file(bucket(), key, local_path, Config=TRANSFER_CONFIG)
     return local_path
 
 
+def spooled_buffer():
+    """File object kept in memory until it grows past SPILL_THRESHOLD."""
+    return tempfile.SpooledTemporaryFile(max_size=SPILL_THRESHOLD)
+
+
+@timed("s3_download")
+def download_fileobj_from_s3(key):
+    """Download an object into a spooled buffer, rewound and ready to decode."""
+    print(f"[DEBUG] Streaming s3://{bucket()}/{key} into memory")
+    buf = spooled_buffer()
+    client().download_fileobj(bucket(), key, buf, Config=TRANSFER_CONFIG)
+    buf.seek(0)
+    return buf
+
+
+@timed("s3_upload")
+def upload_fileobj_to_s3(fileobj, key, content_type=None):
+    """Upload a file object (e.g. an encoded image buffer) from its start."""
+    print(f"[DEBUG] Streaming buffer → s3://{bucket()}/{key}")
+    fileobj.seek(0)
+    extra = {"ContentType": content_type} if content_type else None
+    client().upload_fileobj(fileobj, bucket(), key, ExtraArgs=extra, Config=TRANSFER_CONFIG)
+    return key
+
+
+@timed("s3_presign")
 def generate_presigned_url(key, expires=3600):
     print(f"[DEBUG] Generating presigned URL for {key}, expires={expires}s")
     try:
         # Optional: verify existence first
-        s3.head_object(Bucket=BUCKET, Key=key)
-    except s3.exceptions.ClientError as e:
+        client().head_object(Bucket=bucket(), Key=key)
+    except ClientError as e:
         print(f"[DEBUG] Presigned URL failed, object not found: {key}")
         return None
 
-    return s3.generate_presigned_url(
+    return client().generate_presigned_url(
         "get_object",
-        Params={"Bucket": BUCKET, "Key": key},
+        Params={"Bucket": bucket(), "Key": key},
         ExpiresIn=expires
     )
 
 
+@timed("s3_presign")
+def presign_urls(keys, expires=3600, check_exists=False):
+    """Return {key: presigned GET URL} for keys already known from metadata.
+
+    Signing is local, so no request leaves the process unless check_exists
+    is set, in which case missing objects map to None. A signed URL is
+    reused for PRESIGN_CACHE_TTL seconds so dashboard refreshes get the same
+    URLs (and the browser cache keeps working).
+    """
+    now = time.time()
+    ttl = min(PRESIGN_CACHE_TTL, expires / 2)
+    urls = {}
+    with _presign_lock:
+        if len(_presign_cache) > PRESIGN_CACHE_MAX:
+            for k in [k for k, (_, signed) in _presign_cache.items() if now - signed >= ttl]:
+                del _presign_cache[k]
+        for key in keys:
+            hit = _presign_cache.get((key, expires))
+            if hit and now - hit[1] < ttl:
+                urls[key] = hit[0]
+
+    for key in keys:
+        if key in urls:
+            continue
+        if check_exists and not get_etag(key):
+            urls[key] = None
+            continue
+        url = client().generate_presigned_url(
+            "get_object",
+            Params={"Bucket": bucket(), "Key": key},
+            ExpiresIn=expires
+        )
+        urls[key] = url
+        with _presign_lock:
+            _presign_cache[(key, expires)] = (url, now)
+
+    print(f"[DEBUG] Presigned {len(keys)} keys")
+    return urls
+
+
+@timed("s3_presign")
+def presign_post(key, content_type, max_bytes, sha256=None, expires=900):
+    """Presigned POST letting a browser upload one object straight to `key`.
+
+    The policy pins the content type and caps the size at `max_bytes`; with
+    a hex `sha256` it also pins the checksum, so S3 rejects any other bytes
+    and stores the checksum for get_sha256(). Returns {url, fields}; the
+    file goes last in the multipart form.
+    """
+    print(f"[DEBUG] Presigning POST for {key} ({content_type}, ≤{max_bytes} bytes)")
+    fields = {"Content-Type": content_type}
+    if sha256:
+        fields["x-amz-checksum-sha256"] = base64.b64encode(bytes.fromhex(sha256)).decode()
+    return client().generate_presigned_post(
+        bucket(), key,
+        Fields=fields,
+        Conditions=[{k: v} for k, v in fields.items()] + [["content-length-range", 1, max_bytes]],
+        ExpiresIn=expires,
+    )
+
+
+@timed("s3_presign")
+def start_multipart(key, content_type, parts, expires=3600):
+    """Open a multipart upload and presign a PUT URL for each of `parts` parts.
+
+    Returns (upload id, [url of part 1, 2, ...]). The browser needs the
+    ETag of each part back, so the bucket's CORS rules must expose ETag.
+    """
+    upload_id = client().create_multipart_upload(
+        Bucket=bucket(), Key=key, ContentType=content_type
+    )["UploadId"]
+    print(f"[DEBUG] Started multipart upload {upload_id[:12]}… for {key}, {parts} parts")
+    urls = [
+        client().generate_presigned_url(
+            "upload_part",
+            Params={"Bucket": bucket(), "Key": key, "UploadId": upload_id, "PartNumber": n},
+            ExpiresIn=expires,
+        )
+        for n in range(1, parts + 1)
+    ]
+    return upload_id, urls
+
+
+@timed("s3_upload")
+def complete_multipart(key, upload_id, parts):
+    """Assemble uploaded parts, given as [{"PartNumber": n, "ETag": etag}]."""
+    print(f"[DEBUG] Completing multipart upload of {key} from {len(parts)} parts")
+    client().complete_multipart_upload(
+        Bucket=bucket(), Key=key, UploadId=upload_id,
+        MultipartUpload={"Parts": sorted(parts, key=lambda p: p["PartNumber"])},
+    )
+    return key
+
+
+def abort_multipart(key, upload_id):
+    print(f"[DEBUG] Aborting multipart upload of {key}")
+    client().abort_multipart_upload(Bucket=bucket(), Key=key, UploadId=upload_id)
+
+
+@timed("s3_download")
+def read_head(key, nbytes):
+    """First `nbytes` of an object as (bytes, total object size)."""
+    response = client().get_object(Bucket=bucket(), Key=key, Range=f"bytes=0-{nbytes - 1}")
+    data = response["Body"].read()
+    total = response.get("ContentRange", "").rpartition("/")[2]
+    return data, int(total) if total.isdigit() else response["ContentLength"]
+
+
+@timed("s3_delete")
 def delete_file_from_s3(key):
-    print(f"[DEBUG] Deleting s3://{BUCKET}/{key}")
-    s3.delete_object(Bucket=BUCKET, Key=key)
+    print(f"[DEBUG] Deleting s3://{bucket()}/{key}")
+    client().delete_object(Bucket=bucket(), Key=key)
 
 
-def clear_prefix(prefix):
-    print(f"[DEBUG] Clearing all objects under s3://{BUCKET}/{prefix}")
-    continuation = None
-    while True:
-        kwargs = {"Bucket": BUCKET, "Prefix": prefix}
-        if continuation:
-            kwargs["ContinuationToken"] = continuation
+@timed("s3_copy")
+def copy_object(src_key, dst_key):
+    """Server-side copy within the bucket; multipart for large objects."""
+    print(f"[DEBUG] Copying s3://{bucket()}/{src_key} → {dst_key}")
+    client().copy({"Bucket": bucket(), "Key": src_key}, bucket(), dst_key, Config=TRANSFER_CONFIG)
+    return dst_key
 
-        response = s3.list_objects_v2(**kwargs)
-        if "Contents" not in response:
-            break
 
-        for obj in response["Contents"]:
-            print(f"[DEBUG] Deleting {obj['Key']}")
-            s3.delete_object(Bucket=BUCKET, Key=obj["Key"])
+def delete_keys(keys):
+    """Delete up to DELETE_BATCH keys in one request; returns (deleted, failed keys)."""
+    response = client().delete_objects(
+        Bucket=bucket(),
+        Delete={"Objects": [{"Key": k} for k in keys], "Quiet": True},
+    )
+    failed = [e["Key"] for e in response.get("Errors", [])]
+    for error in response.get("Errors", []):
+        print(f"[WARN] Could not delete {error['Key']}: {error.get('Code')}")
+    return len(keys) - len(failed), failed
 
-        if response.get("IsTruncated"):
-            continuation = response["NextContinuationToken"]
-        else:
-            break
 
+@timed("s3_delete")
+def clear_prefix(prefix, progress=None):
+    """Delete every object under `prefix` and return how many were deleted.
+
+    Listing pages are at most DELETE_BATCH keys, which is exactly what one
+    delete_objects call takes, so each page becomes one delete request;
+    deletes run in parallel while the listing keeps paging, with at most
+    2 * DELETE_WORKERS queued. `progress`, if given, is called with
+    objects=/failed_objects= counts as each delete finishes.
+    """
+    print(f"[DEBUG] Clearing all objects under s3://{bucket()}/{prefix}")
+    paginator = client().get_paginator("list_objects_v2")
+    pages = paginator.paginate(Bucket=bucket(), Prefix=prefix, PaginationConfig={"PageSize": DELETE_BATCH})
+    deleted = 0
 
+    def collect(finished):
+        nonlocal deleted
+        for future in finished:
+            done, failed = future.result()
+            deleted += done
+            if progress:
+                progress(objects=done, failed_objects=len(failed))
+
+    pending = set()
+    with ThreadPoolExecutor(DELETE_WORKERS) as pool:
+        for page in pages:
+            if not page.get("Contents"):
+                continue
+            pending.add(pool.submit(delete_keys, [obj["Key"] for obj in page["Contents"]]))
+            finished, pending = wait(pending, timeout=0)
+            if len(pending) >= 2 * DELETE_WORKERS:
+                more, pending = wait(pending, return_when=FIRST_COMPLETED)
+                finished |= more
+            collect(finished)
+        collect(as_completed(pending))
+    print(f"[DEBUG] Deleted {deleted} objects under {prefix}")
+    return deleted
+
+
+@timed("s3_list")
 def list_files_with_prefix(prefix):
     """Return list of keys under a given prefix."""
-    print(f"[DEBUG] Listing objects under s3://{BUCKET}/{prefix}")
+    print(f"[DEBUG] Listing objects under s3://{bucket()}/{prefix}")
     keys = []
     continuation = None
     while True:
-        kwargs = {"Bucket": BUCKET, "Prefix": prefix}
+        kwargs = {"Bucket": bucket(), "Prefix": prefix}
         if continuation:
             kwargs["ContinuationToken"] = continuation
 
-        response = s3.list_objects_v2(**kwargs)
+        response = client().list_objects_v2(**kwargs)
         for obj in response.get("Contents", []):
             keys.append(obj["Key"])
 
@@ -83,3 +298,47 @@ def list_files_with_prefix(prefix):
             break
     print(f"[DEBUG] Found {len(keys)} objects")
     return keys
+
+
+@timed("s3_list")
+def list_page(prefix, limit=LIST_PAGE_MAX, token=None):
+    """One page of the objects directly under `prefix`.
+
+    Deeper keys are rolled up into `folders` (delimiter "/"), so listing a
+    user's folder, or the top level, costs one request per page however
+    big the rest of the bucket is. Pass `next_token` back to continue.
+    """
+    kwargs = {"Bucket": bucket(), "Prefix": prefix, "Delimiter": "/", "MaxKeys": limit}
+    if token:
+        kwargs["ContinuationToken"] = token
+    response = client().list_objects_v2(**kwargs)
+    return {
+        "keys": [obj["Key"] for obj in response.get("Contents", [])],
+        "folders": [p["Prefix"] for p in response.get("CommonPrefixes", [])],
+        "next_token": response.get("NextContinuationToken") if response.get("IsTruncated") else None,
+    }
+
+
+@timed("s3_head")
+def get_sha256(key):
+    """Hex SHA-256 of a whole object, as S3 verified it on upload; None when
+    the object was stored without one (or only with per-part checksums)."""
+    try:
+        response = client().head_object(Bucket=bucket(), Key=key, ChecksumMode="ENABLED")
+    except ClientError:
+        print(f"[DEBUG] No object at s3://{bucket()}/{key}")
+        return None
+    checksum = response.get("ChecksumSHA256")
+    if not checksum or response.get("ChecksumType", "FULL_OBJECT") != "FULL_OBJECT" or "-" in checksum:
+        return None
+    return base64.b64decode(checksum).hex()
+
+
+@timed("s3_head")
+def get_etag(key):
+    """Return the ETag of an object, or None if it does not exist."""
+    try:
+        return client().head_object(Bucket=bucket(), Key=key)["ETag"]
+    except ClientError:
+        print(f"[DEBUG] No object at s3://{bucket()}/{key}")
+        return None
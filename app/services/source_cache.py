@@ -0,0 +1,107 @@
+import os
+import threading
+from collections import OrderedDict
+
+MB = 1024 * 1024
+# "decoded" keeps decoded images, "raw" the downloaded bytes, "off" nothing
+MODE = os.environ.get("SOURCE_CACHE_MODE", "decoded").lower()
+MAX_BYTES = int(os.environ.get("SOURCE_CACHE_BYTES", 256 * MB))
+# Sources bigger than this share of the budget are never cached
+MAX_ENTRY_SHARE = float(os.environ.get("SOURCE_CACHE_MAX_ENTRY_SHARE", 0.25))
+
+# Pillow stores these modes one byte per pixel and I;16 in two; every
+# other mode takes four (RGB is padded to RGBX)
+PIXEL_BYTES = {"1": 1, "L": 1, "P": 1, "I;16": 2, "I;16L": 2, "I;16B": 2}
+
+
+def image_bytes(img):
+    """Approximate memory held by a decoded image or animation's frames."""
+    frames = getattr(img, "frames", [img])
+    return sum(f.width * f.height * PIXEL_BYTES.get(f.mode, 4) for f in frames)
+
+
+class SourceCache:
+    """LRU map of S3 key → the source read for one ETag of it, bounded by bytes.
+
+    Only the newest ETag of a key is kept: a lookup with a different ETag
+    drops the entry as stale.
+    """
+
+    def __init__(self, max_bytes=MAX_BYTES, mode=MODE, max_entry_share=MAX_ENTRY_SHARE):
+        self.max_bytes = max_bytes
+        self.mode = mode if max_bytes > 0 else "off"
+        self.max_entry_bytes = int(max_bytes * max_entry_share)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self.evictions = 0
+        self.rejected = 0
+
+    @property
+    def enabled(self):
+        return self.mode in ("decoded", "raw")
+
+    def admits(self, nbytes):
+        """Whether a source of `nbytes` is small enough to be cached."""
+        return self.enabled and nbytes <= self.max_entry_bytes
+
+    def get(self, key, etag, usable=None):
+        """Entry ({value, size, bytes}) stored for (key, etag), or None.
+
+        `usable(entry)` can turn down an entry that doesn't fit the caller,
+        e.g. a decode at too low a resolution; that counts as a miss.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry["etag"] != etag:
+                self._drop(key)
+                self.stale += 1
+                entry = None
+            if entry is None or (usable and not usable(entry)):
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, key, etag, value, nbytes, size=None):
+        """Store `value` for (key, etag), replacing what was kept for the key."""
+        if not self.admits(nbytes):
+            with self._lock:
+                self.rejected += 1
+            return False
+        with self._lock:
+            self._drop(key)
+            self._entries[key] = {"etag": etag, "value": value, "size": size, "bytes": nbytes}
+            self.bytes += nbytes
+            while self.bytes > self.max_bytes:
+                self._drop(next(iter(self._entries)))
+                self.evictions += 1
+        print(f"[DEBUG] Cached {self.mode} source {key}: {nbytes} bytes, {self.bytes}/{self.max_bytes} used")
+        return True
+
+    def _drop(self, key):
+        entry = self._entries.pop(key, None)
+        if entry:
+            self.bytes -= entry["bytes"]
+
+    def stats(self):
+        with self._lock:
+            return {
+                "mode": self.mode,
+                "entries": len(self._entries),
+                "bytes": self.bytes,
+                "max_bytes": self.max_bytes,
+                "max_entry_bytes": self.max_entry_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "stale": self.stale,
+                "evictions": self.evictions,
+                "rejected": self.rejected,
+            }
+
+
+sources = SourceCache()
@@ -0,0 +1,154 @@
+import os
+import time
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from app.utils.lazy import lazy
+
+WORKER_URL = os.environ.get(
+    "WORKER_URL", "http://internal-n11326158-alb-1562283677.ap-southeast-2.elb.amazonaws.com"
+)
+
+# Keep-alive connections held open to the worker ALB
+POOL_SIZE = int(os.environ.get("WORKER_POOL_SIZE", 32))
+# Consecutive failures that open the breaker, and how long it stays open
+FAILURE_THRESHOLD = int(os.environ.get("WORKER_FAILURE_THRESHOLD", 5))
+RESET_TIMEOUT = float(os.environ.get("WORKER_RESET_TIMEOUT", 30))
+HEALTH_INTERVAL = float(os.environ.get("WORKER_HEALTH_INTERVAL", 10))
+
+# Responses that mean the worker (not the job) is in trouble
+UNAVAILABLE_STATUSES = {502, 503, 504}
+
+
+class WorkerUnavailable(Exception):
+    pass
+
+
+class CircuitBreaker:
+    """Closed → open after FAILURE_THRESHOLD straight failures; after
+    RESET_TIMEOUT one trial request is let through (half-open) and its
+    outcome closes or re-opens the breaker."""
+
+    def __init__(self, threshold=FAILURE_THRESHOLD, reset_timeout=RESET_TIMEOUT):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.trial_running = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        if time.time() - self.opened_at >= self.reset_timeout:
+            return "half-open"
+        return "open"
+
+    def allow(self):
+        with self._lock:
+            state = self.state
+            if state == "closed":
+                return True
+            if state == "half-open" and not self.trial_running:
+                self.trial_running = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            if self.opened_at is not None:
+                print("[INFO] Worker circuit closed")
+            self.failures = 0
+            self.opened_at = None
+            self.trial_running = False
+
+    def record_failure(self):
+        with self._lock:
+            self.trial_running = False
+            self._fail()
+
+    def record_inconclusive(self):
+        """The request neither proved nor disproved the worker healthy
+        (e.g. it was accepted but outran its read timeout)."""
+        with self._lock:
+            self.trial_running = False
+
+    def record_probe(self, healthy):
+        """Outcome of a background health probe. A failed probe counts like
+        a failed request; a healthy one only cuts an open breaker's wait
+        short, leaving it to a real request to close the breaker and clear
+        the failure count."""
+        with self._lock:
+            if not healthy:
+                self._fail()
+            elif self.state == "open":
+                self.opened_at = time.time() - self.reset_timeout
+
+    def _fail(self):
+        self.failures += 1
+        if self.opened_at is not None or self.failures >= self.threshold:
+            if self.opened_at is None:
+                print(f"[WARN] Worker circuit opened after {self.failures} failures")
+            self.opened_at = time.time()
+
+
+breaker = CircuitBreaker()
+
+
+@lazy
+def session():
+    """Shared keep-alive session; starts the health monitor on first use."""
+    s = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=POOL_SIZE)
+    s.mount("http://", adapter)
+    s.mount("https://", adapter)
+    threading.Thread(target=_monitor, name="worker-health", daemon=True).start()
+    return s
+
+
+def _probe():
+    try:
+        resp = session().get(f"{WORKER_URL}/", timeout=5)
+        return resp.status_code == 200 and resp.json().get("status") == "worker service running"
+    except (requests.exceptions.RequestException, ValueError) as e:
+        print(f"[DEBUG] Worker health probe failed: {e}")
+        return False
+
+
+def _monitor():
+    """Probe the worker in the background so the breaker learns about
+    outages (and recoveries) without any job paying for the check."""
+    while True:
+        time.sleep(HEALTH_INTERVAL)
+        breaker.record_probe(_probe())
+
+
+def post(path, payload, timeout):
+    """POST to the worker through the pooled session and the breaker.
+
+    Raises WorkerUnavailable without touching the network while the
+    breaker is open; request errors propagate. Only connection errors
+    (including connect timeouts) and UNAVAILABLE_STATUSES count against
+    the worker: a read timeout means it accepted the job, which may just
+    be a long one.
+    """
+    if not breaker.allow():
+        raise WorkerUnavailable("Worker service unavailable")
+    try:
+        resp = session().post(f"{WORKER_URL}{path}", json=payload, timeout=timeout)
+    except requests.exceptions.ConnectionError:
+        breaker.record_failure()
+        raise
+    except requests.exceptions.RequestException:
+        breaker.record_inconclusive()
+        raise
+    if resp.status_code in UNAVAILABLE_STATUSES:
+        breaker.record_failure()
+    else:
+        breaker.record_success()
+    return resp
+
+
+def status():
+    return {"state": breaker.state, "failures": breaker.failures}
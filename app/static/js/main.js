@@ -28,35 +28,97 @@ function showToast(message, type = "info") {
 }
 
 // ---------------- Upload ----------------
+// Parts of a multipart upload sent at once
+const UPLOAD_PART_CONCURRENCY = 4;
+// Files up to this size are hashed first so re-uploads of your own files are
+// skipped; S3 checks the hash on single-request uploads so they can be deduplicated
+const UPLOAD_HASH_LIMIT = 256 * 1024 * 1024;
+// Give up polling a queued job after this long (the worker's JOB_TIMEOUT)
+const JOB_POLL_TIMEOUT_MS = 15 * 60 * 1000;
+
+async function sha256Hex(file) {
+  if (!window.crypto || !crypto.subtle || file.size > UPLOAD_HASH_LIMIT) return undefined;
+  const digest = await crypto.subtle.digest("SHA-256", await file.arrayBuffer());
+  return Array.from(new Uint8Array(digest), b => b.toString(16).padStart(2, "0")).join("");
+}
+
+async function postJson(url, body) {
+  return fetch(url, {
+    method: "POST",
+    headers: { "Content-Type": "application/json" },
+    body: JSON.stringify(body)
+  });
+}
+
+// Send the file's bytes straight to S3 with the credentials from /upload/presign;
+// returns the body /upload/complete expects
+async function sendToS3(file, grant, sha256) {
+  if (grant.duplicate) return { filename: grant.filename, sha256 };
+
+  if (grant.post) {
+    const form = new FormData();
+    Object.entries(grant.post.fields).forEach(([k, v]) => form.append(k, v));
+    form.append("file", file);
+    const res = await fetch(grant.post.url, { method: "POST", body: form });
+    if (!res.ok) throw new Error(`S3 upload failed (${res.status})`);
+    return { filename: grant.filename };
+  }
+
+  const { upload_id, part_size, urls } = grant.multipart;
+  const parts = [];
+  let next = 0;
+  async function sendParts() {
+    while (next < urls.length) {
+      const i = next++;
+      const res = await fetch(urls[i], { method: "PUT", body: file.slice(i * part_size, (i + 1) * part_size) });
+      if (!res.ok) throw new Error(`Part ${i + 1} failed (${res.status})`);
+      parts.push({ part: i + 1, etag: res.headers.get("ETag") });
+    }
+  }
+  try {
+    await Promise.all(Array.from({ length: UPLOAD_PART_CONCURRENCY }, sendParts));
+  } catch (err) {
+    await postJson("/upload/abort", { filename: grant.filename, upload_id });
+    throw err;
+  }
+  return { filename: grant.filename, upload_id, parts };
+}
+
 async function uploadFile(event) {
   event.preventDefault();
   showSpinner();
 
-  const fileInput = document.getElementById("file");
-  const formData = new FormData();
-  formData.append("file", fileInput.files[0]);
+  const file = document.getElementById("file").files[0];
 
   try {
-    const res = await fetch("/upload/", { method: "POST", body: formData });
-    const data = await res.json();
+    const sha256 = file ? await sha256Hex(file) : undefined;
+    const presign = await postJson("/upload/presign", { filename: file && file.name, size: file && file.size, sha256 });
+    const grant = await presign.json();
+    if (!presign.ok) return showToast("Error: " + (grant.error || "Failed to upload"), "error");
 
-    if (res.ok) {
-      showToast(`Uploaded: ${data.metadata.filename}`, "success");
+    const completed = await sendToS3(file, grant, sha256);
+    const op = await waitForOperation(await postJson("/upload/complete", completed));
+
+    if (op.status === "done") {
+      showToast(`Uploaded: ${op.result.filename}`, "success");
       await populateFileDropdown();
       await viewUploads();
     } else {
-      showToast("Error: " + (data.error || "Failed to upload"), "error");
+      showToast("Error: " + (op.error || "Failed to upload"), "error");
     }
+  } catch (err) {
+    showToast("Error: " + err.message, "error");
   } finally {
     hideSpinner();
   }
 }
 
-async function populateFileDropdown(page = 1, limit = 50, sort = "filename", order = "asc", filter = "") {
+// The newest uploads, straight from the time index (one page, no full sort)
+async function populateFileDropdown(limit = 50, filter = "") {
   const stressSelect = document.getElementById("stress-file");
 
   try {
-    let url = `/upload/list?page=${page}&limit=${limit}&sort=${sort}&order=${order}`;
+    let url = `/upload/list?limit=${limit}&sort=timestamp&order=desc`;
     if (filter) url += `&q=${encodeURIComponent(filter)}`;
 
     const res = await fetch(url);
@@ -82,11 +144,12 @@ async function populateFileDropdown(page = 1, limit = 50, sort = "filename", ord
   }
 }
 
-async function deleteUpload(filename) {
+async function deleteUpload(filename, user) {
   if (!confirm(`Delete upload "${filename}"?`)) return;
 
   showSpinner();
-  const res = await fetch(`/upload/${filename}`, { method: "DELETE" });
+  const query = user ? `?user=${encodeURIComponent(user)}` : "";
+  const res = await fetch(`/upload/${filename}${query}`, { method: "DELETE" });
   const data = await res.json();
   hideSpinner();
 
@@ -118,20 +181,50 @@ function saveSettings() {
       height: parseInt(document.getElementById("resize-height").value) || undefined
     },
     grayscale: document.getElementById("grayscale").checked,
-    flip: document.getElementById("flip").value || undefined
+    flip: document.getElementById("flip").value || undefined,
+    output: {
+      format: document.getElementById("output-format").value || undefined,
+      quality: parseInt(document.getElementById("output-quality").value) || undefined,
+      lossless: document.getElementById("output-lossless").checked || undefined
+    }
   };
   closeSettings();
   showToast("Settings saved");
 }
 
-async function processUpload(filename) {
+async function processUpload(filename, owner) {
   showSpinner();
   const res = await fetch("/process/", {
     method: "POST",
     headers: { "Content-Type": "application/json" },
-    body: JSON.stringify({ filename, operations: processSettings })
+    body: JSON.stringify({ filename, owner: owner || undefined, operations: processSettings })
   });
-  const data = await res.json();
+  let data = await res.json();
+
+  // Queued job: poll until the worker pool finishes it or we give up
+  if (res.status === 202) {
+    let job = data;
+    const deadline = Date.now() + JOB_POLL_TIMEOUT_MS;
+    while (job.status === "queued" || job.status === "running") {
+      if (Date.now() > deadline) {
+        job = { status: "failed", error: "Timed out waiting for the job" };
+        break;
+      }
+      await new Promise(resolve => setTimeout(resolve, 1000));
+      const poll = await fetch(data.status_url);
+      job = await poll.json();
+      if (!poll.ok) job.status = "failed";
+    }
+    data = job.result || job;
+    hideSpinner();
+    if (job.status === "done") {
+      showToast("Processed: " + data.result, "success");
+      await viewResults();
+    } else {
+      showToast("Error: " + (data.error || "Failed to process"), "error");
+    }
+    return;
+  }
   hideSpinner();
 
   if (res.ok) {
@@ -145,19 +238,33 @@ async function processUpload(filename) {
 async function stressTest() {
   const filename = document.getElementById("stress-file").value;
   const duration = parseInt(document.getElementById("duration").value, 10);
+  const concurrency = parseInt(document.getElementById("concurrency").value, 10) || 8;
+  const rate = parseFloat(document.getElementById("rate").value) || undefined;
   if (!filename) return showToast("Please select a file.", "error");
 
   showSpinner();
   const res = await fetch("/process/stress", {
     method: "POST",
     headers: { "Content-Type": "application/json" },
-    body: JSON.stringify({ filename, duration })
+    body: JSON.stringify({ filename, duration, concurrency, rate })
   });
-  const data = await res.json();
+  let data = await res.json();
+
+  // The load test runs in the background; poll until its report is ready
+  if (res.status === 202) {
+    const statusUrl = data.status_url;
+    while (data.status === "running") {
+      await new Promise(resolve => setTimeout(resolve, 2000));
+      data = await (await fetch(statusUrl)).json();
+    }
+  }
   hideSpinner();
 
-  if (res.ok) {
-    showToast(`Stress Test completed on ${filename}`, "info");
+  if (data.status === "done") {
+    const r = data.result;
+    const ms = v => (v == null ? "-" : `${Math.round(v * 1000)}ms`);
+    showToast(`Stress test on ${filename}: ${r.successes} ok, ${r.failures} failed, ` +
+      `${r.throughput.toFixed(2)} req/s, p50 ${ms(r.latency.p50)}, p95 ${ms(r.latency.p95)}, p99 ${ms(r.latency.p99)}`, "info");
     await viewResults();
   } else {
     showToast("Error: " + (data.error || "Stress test failed"), "error");
@@ -172,9 +279,12 @@ let sortDirection = "desc";
 let totalPages = 1;
 let currentFilter = "";
 
+let resultsCursors = [null];
+
 async function viewResults(page = 1, sort = sortColumn, order = sortDirection, filter = currentFilter) {
   showSpinner();
-  let url = `/results/metadata?page=${page}&limit=${resultsPerPage}&sort=${sort}&order=${order}`;
+  let url = `/results/metadata?limit=${resultsPerPage}&sort=${sort}&order=${order}`;
+  url += pageParam(resultsCursors, page, sort);
   if (filter) url += `&input=${encodeURIComponent(filter)}`;
 
   const res = await fetch(url);
@@ -185,14 +295,21 @@ async function viewResults(page = 1, sort = sortColumn, order = sortDirection, f
     return showToast("Error loading results: " + (data.error || "Unknown error"), "error");
   }
 
-  currentPage = data.page;
-  totalPages = Math.ceil(data.total / resultsPerPage);
   renderResultsPage(data.results);
+  const paginationDiv = document.getElementById("pagination");
+  if ("next_cursor" in data) {
+    currentPage = page;
+    resultsCursors[page] = data.next_cursor;
+    renderCursorPagination(paginationDiv, page, !!data.next_cursor, viewResults);
+  } else {
+    currentPage = data.page;
+    totalPages = Math.ceil(data.total / resultsPerPage);
+    renderPagination(paginationDiv, totalPages, viewResults);
+  }
 }
 
 function renderResultsPage(results) {
   const resultsDiv = document.getElementById("results");
-  const paginationDiv = document.getElementById("pagination");
 
   let html = `
     <table class="results-table">
@@ -217,12 +334,12 @@ function renderResultsPage(results) {
         <td class="filename-cell" title="${r.output}">${r.output}</td>
         <td>${new Date(r.timestamp * 1000).toLocaleString()}</td>
         <td>
-          <a href="${r.preview_url}" target="_blank">
+          <a href="${r.download_url || r.preview_url}" target="_blank">
             <img src="${r.preview_url}" alt="Processed" class="thumbnail">
           </a>
         </td>
         <td>
-          ${isAdmin() ? `<button class="danger-btn" onclick="deleteResult('${r.output}')">Delete</button>` : ""}
+          ${isAdmin() ? `<button class="danger-btn" onclick="deleteResult('${r.output}', '${r.user || ""}')">Delete</button>` : ""}
         </td>
       </tr>
     `;
@@ -230,15 +347,14 @@ function renderResultsPage(results) {
 
   html += "</tbody></table>";
   resultsDiv.innerHTML = html;
-
-  renderPagination(paginationDiv, totalPages, viewResults);
 }
 
-async function deleteResult(filename) {
+async function deleteResult(filename, user) {
   if (!confirm(`Delete result "${filename}"?`)) return;
 
   showSpinner();
-  const res = await fetch(`/results/${filename}`, { method: "DELETE" });
+  const query = user ? `?user=${encodeURIComponent(user)}` : "";
+  const res = await fetch(`/results/${filename}${query}`, { method: "DELETE" });
   const data = await res.json();
   hideSpinner();
 
@@ -269,28 +385,52 @@ function applyFilter() {
   currentFilter = document.getElementById("filter-input").value.trim();
   viewResults(1, sortColumn, sortDirection, currentFilter);
 }
+// Poll a 202 background operation until it finishes; `describe` turns its
+// progress counters into a toast message (none if omitted)
+async function waitForOperation(res, describe) {
+  let op = await res.json();
+  if (res.status !== 202) return { status: "failed", error: op.error };
+  const statusUrl = op.status_url;
+  showSpinner();
+  while (op.status === "running") {
+    await new Promise(resolve => setTimeout(resolve, 1000));
+    op = await (await fetch(statusUrl)).json();
+    if (op.status === "running" && describe) showToast(describe(op.progress || {}), "info");
+  }
+  hideSpinner();
+  return op;
+}
+
+function deletionProgress(p) {
+  return `Deleting… ${(p.objects || 0) + (p.records || 0)} removed`;
+}
+
 async function clearData() {
   if (!confirm("Are you sure you want to delete all results?")) return;
 
   const res = await fetch("/results/clear", { method: "DELETE" });
-  if (res.ok) {
-    showToast("All results deleted.", "success");
+  const op = await waitForOperation(res, deletionProgress);
+  if (op.status === "done") {
+    showToast(`Deleted ${op.result.objects} objects and ${op.result.records} records.`, "success");
     viewResults();
   } else {
-    showToast("Failed to delete results.", "error");
+    showToast("Failed to delete results: " + (op.error || ""), "error");
   }
 }
 
 // ---------------- Uploads table ----------------
 let currentUploadsPage = 1;
 const uploadsPerPage = 5;
-let uploadsSortColumn = "filename";
-let uploadsSortDirection = "asc";
+let uploadsSortColumn = "timestamp";
+let uploadsSortDirection = "desc";
 let uploadsFilter = "";
 
+let uploadsCursors = [null];
+
 async function viewUploads(page = 1, sort = uploadsSortColumn, order = uploadsSortDirection, q = uploadsFilter) {
   showSpinner();
-  let url = `/upload/list?page=${page}&limit=${uploadsPerPage}&sort=${sort}&order=${order}`;
+  let url = `/upload/list?limit=${uploadsPerPage}&sort=${sort}&order=${order}`;
+  url += pageParam(uploadsCursors, page, sort);
   if (q) url += `&q=${encodeURIComponent(q)}`;
 
   const res = await fetch(url);
@@ -301,13 +441,20 @@ async function viewUploads(page = 1, sort = uploadsSortColumn, order = uploadsSo
     return showToast("Error loading uploads: " + (data.error || "Unknown error"), "error");
   }
 
-  currentUploadsPage = data.page;
-  renderUploadsPage(data.results, data.total);
+  renderUploadsPage(data.results);
+  const paginationDiv = document.getElementById("uploads-pagination");
+  if ("next_cursor" in data) {
+    currentUploadsPage = page;
+    uploadsCursors[page] = data.next_cursor;
+    renderCursorPagination(paginationDiv, page, !!data.next_cursor, viewUploads);
+  } else {
+    currentUploadsPage = data.page;
+    renderPagination(paginationDiv, Math.ceil(data.total / uploadsPerPage), viewUploads);
+  }
 }
 
-function renderUploadsPage(files, total) {
+function renderUploadsPage(files) {
   const uploadsDiv = document.getElementById("uploads-list");
-  const paginationDiv = document.getElementById("uploads-pagination");
 
   let html = `
     <table class="results-table">
@@ -328,15 +475,15 @@ function renderUploadsPage(files, total) {
       <tr>
         <td class="filename-cell" title="${f.filename}">${f.filename}</td>
         <td>
-          <a href="${f.preview_url}" target="_blank">
+          <a href="${f.download_url || f.preview_url}" target="_blank">
             <img src="${f.preview_url}" alt="Uploaded" class="thumbnail">
           </a>
         </td>
         <td>${f.resolution}</td>
         <td>${(f.size_bytes / 1024).toFixed(1)}</td>
         <td>
-          <button onclick="processUpload('${f.filename}')">Process</button>
-          ${isAdmin() ? `<button class="danger-btn" onclick="deleteUpload('${f.filename}')">Delete</button>` : ""}
+          <button onclick="processUpload('${f.filename}', '${f.user || ""}')">Process</button>
+          ${isAdmin() ? `<button class="danger-btn" onclick="deleteUpload('${f.filename}', '${f.user || ""}')">Delete</button>` : ""}
         </td>
       </tr>
     `;
@@ -344,8 +491,6 @@ function renderUploadsPage(files, total) {
 
   html += "</tbody></table>";
   uploadsDiv.innerHTML = html;
-
-  renderPagination(paginationDiv, Math.ceil(total / uploadsPerPage), viewUploads);
 }
 
 function changeUploadsSort(column) {
@@ -371,12 +516,13 @@ async function clearUploads() {
   if (!confirm("Delete ALL uploads?")) return;
 
   const res = await fetch("/upload/clear", { method: "DELETE" });
-  if (res.ok) {
-    showToast("All uploads deleted.", "success");
+  const op = await waitForOperation(res, deletionProgress);
+  if (op.status === "done") {
+    showToast(`Deleted ${op.result.objects} objects and ${op.result.records} records.`, "success");
     viewUploads();
     populateFileDropdown();
   } else {
-    showToast("Failed to delete uploads.", "error");
+    showToast("Failed to delete uploads: " + (op.error || ""), "error");
   }
 }
 
@@ -406,6 +552,36 @@ function renderPagination(container, totalPages, callback) {
   container.appendChild(nextBtn);
 }
 
+// Time-sorted listings page by server cursor; cursors[n - 1] opens page n
+function pageParam(cursors, page, sort) {
+  if (sort !== "timestamp") return `&page=${page}`;
+  if (page === 1) cursors.length = 1;
+  const cursor = cursors[page - 1];
+  return cursor ? `&cursor=${encodeURIComponent(cursor)}` : "";
+}
+
+function renderCursorPagination(container, page, hasNext, callback) {
+  container.innerHTML = "";
+  if (page === 1 && !hasNext) return;
+
+  const prevBtn = document.createElement("button");
+  prevBtn.textContent = "Prev";
+  prevBtn.disabled = page === 1;
+  prevBtn.onclick = () => callback(page - 1);
+  container.appendChild(prevBtn);
+
+  const current = document.createElement("button");
+  current.textContent = page;
+  current.classList.add("active");
+  container.appendChild(current);
+
+  const nextBtn = document.createElement("button");
+  nextBtn.textContent = "Next";
+  nextBtn.disabled = !hasNext;
+  nextBtn.onclick = () => callback(page + 1);
+  container.appendChild(nextBtn);
+}
+
 // ---------------- Auth ----------------
 function logout() {
   window.location.href = "/auth/logout";
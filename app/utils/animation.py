@@ -0,0 +1,66 @@
+from PIL import ImageSequence
+
+# Frame delay (ms) assumed when a frame doesn't set one
+DEFAULT_DURATION = 100
+# GIF disposal method clearing a frame's area before the next one
+RESTORE_BACKGROUND = 2
+
+
+def is_animated(img):
+    return getattr(img, "is_animated", False) and getattr(img, "n_frames", 1) > 1
+
+
+class Animation:
+    """Every frame of an animated image, fully composited, plus its timing.
+
+    Frames come out of Pillow already composited onto what came before,
+    so each one is a complete RGBA picture the plan can run on directly.
+    """
+
+    def __init__(self, frames, durations, disposal, loop, palette=None):
+        self.frames = frames
+        self.durations = durations
+        self.disposal = disposal
+        # None plays once; 0 loops forever (GIF NETSCAPE semantics)
+        self.loop = loop
+        # The source's (global) palette as RGB tuples, for GIF output to reuse
+        self.palette = palette
+
+    @property
+    def size(self):
+        return self.frames[0].size
+
+    @property
+    def mode(self):
+        return self.frames[0].mode
+
+    def __len__(self):
+        return len(self.frames)
+
+    def with_frames(self, frames):
+        """The same timing around new (e.g. rendered) frames."""
+        return Animation(frames, self.durations, self.disposal, self.loop, self.palette)
+
+
+def source_bytes(img):
+    """Memory the decoded frames of an opened animated image will take."""
+    return img.width * img.height * 4 * getattr(img, "n_frames", 1)
+
+
+def _palette(img):
+    if img.mode != "P":
+        return None
+    flat = img.getpalette() or []
+    return [tuple(flat[i:i + 3]) for i in range(0, len(flat), 3)]
+
+
+def decode(img):
+    """Read every frame of an opened animated image into an Animation."""
+    palette = _palette(img)
+    frames, durations, disposal = [], [], []
+    for frame in ImageSequence.Iterator(img):
+        frames.append(frame.convert("RGBA"))
+        durations.append(frame.info.get("duration") or DEFAULT_DURATION)
+        disposal.append(getattr(frame, "disposal_method", 0))
+    print(f"[DEBUG] Decoded {len(frames)} frames of {img.size}, loop={img.info.get('loop')}")
+    return Animation(frames, durations, disposal, img.info.get("loop"), palette)
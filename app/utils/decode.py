@@ -0,0 +1,26 @@
+# reduce() has no implementation for these modes
+UNREDUCIBLE_MODES = {"P", "1"}
+
+
+def load(img, factor=1):
+    """Decode an opened image at 1/`factor` of its size, or a little larger.
+
+    JPEGs are scaled inside the decoder with draft() (DCT scaling by 1/2,
+    1/4 or 1/8), which skips most of the decoding work and memory; what is
+    left of `factor`, and every other format, is taken off with reduce()'s
+    box filter. Returns the decoded image, which may be a new object.
+    """
+    if factor <= 1:
+        img.load()
+        return img
+
+    want = (max(1, img.width // factor), max(1, img.height // factor))
+    if img.format == "JPEG":
+        img.draft(img.mode, want)
+    img.load()
+    remaining = min(img.width // want[0], img.height // want[1])
+    if remaining > 1 and img.mode not in UNREDUCIBLE_MODES:
+        img = img.reduce(remaining)
+    print(f"[DEBUG] Reduced decode by {factor}: {img.size} for at least {want}")
+    return img
+
@@ -0,0 +1,303 @@
+import io
+from PIL import Image, features
+from app.utils.animation import RESTORE_BACKGROUND
+
+# Output formats a job may ask for, by the name used in `operations.output`
+FORMATS = {"jpeg": "JPEG", "png": "PNG", "webp": "WEBP", "avif": "AVIF", "gif": "GIF"}
+EXTENSIONS = {"JPEG": ".jpg", "PNG": ".png", "WEBP": ".webp", "AVIF": ".avif", "GIF": ".gif"}
+
+# Images with at most this many colours count as graphics rather than photos
+GRAPHIC_COLORS = 256
+
+# Formats that can store an animation, and the ones auto mode compares
+ANIMATED = {"GIF", "WEBP", "PNG", "AVIF"}
+ANIMATED_AUTO = ["GIF", "WEBP"]
+# Frames sampled (as a full-resolution mosaic) to build a shared GIF palette,
+# as many as fit in PALETTE_SAMPLE_PIXELS
+PALETTE_SAMPLE_FRAMES = 16
+PALETTE_SAMPLE_PIXELS = 8 * 1024 * 1024
+# Distinct RGBA values counted per frame when looking for an exact GIF palette
+COLOR_SCAN_LIMIT = 1024
+# Palette index reserved for transparent pixels in GIF output
+TRANSPARENT_INDEX = 255
+
+
+def available(fmt):
+    """Whether this Pillow build can encode `fmt`."""
+    if fmt in ("WEBP", "AVIF"):
+        return features.check(fmt.lower())
+    return True
+
+
+def canonical_output(spec):
+    """Normalize the `output` operation so equivalent settings compare equal.
+
+    Accepts a format name or a dict with any of format, quality (1-100),
+    progressive, optimize, lossless and effort (0-10, higher = smaller but
+    slower). Unknown formats and malformed settings raise ValueError.
+    """
+    if isinstance(spec, str):
+        spec = {"format": spec}
+    if not isinstance(spec, dict):
+        raise ValueError(f"Output must be a format name or settings object, not {type(spec).__name__}")
+    canonical = {}
+    fmt = str(spec.get("format") or "").lower()
+    if fmt == "jpg":
+        fmt = "jpeg"
+    if fmt:
+        if fmt != "auto" and fmt not in FORMATS:
+            raise ValueError(f"Unsupported output format: {fmt}")
+        canonical["format"] = fmt
+    for name, low, high in (("quality", 1, 100), ("effort", 0, 10)):
+        if spec.get(name) is None:
+            continue
+        try:
+            canonical[name] = max(low, min(high, int(spec[name])))
+        except (TypeError, ValueError):
+            raise ValueError(f"Output {name} must be a number, not {spec[name]!r}")
+    for flag in ("progressive", "optimize", "lossless"):
+        if spec.get(flag):
+            canonical[flag] = True
+    return canonical
+
+
+def _prepare(img, fmt):
+    """Convert `img` to a mode `fmt` can store."""
+    alpha = img.mode in ("RGBA", "LA", "PA") or (img.mode == "P" and "transparency" in img.info)
+    if fmt == "JPEG":
+        if alpha:
+            rgba = img.convert("RGBA")
+            flat = Image.new("RGB", img.size, "white")
+            flat.paste(rgba, mask=rgba.getchannel("A"))
+            return flat
+        return img if img.mode in ("RGB", "L", "CMYK") else img.convert("RGB")
+    if fmt == "GIF":
+        return img if img.mode in ("P", "L") else img.convert("RGBA" if alpha else "RGB").quantize(256)
+    if fmt in ("WEBP", "AVIF"):
+        return img if img.mode in ("RGB", "RGBA") else img.convert("RGBA" if alpha else "RGB")
+    return img
+
+
+def save_options(fmt, output):
+    """Pillow save() keyword arguments for `fmt` under the `output` settings.
+
+    Settings left out keep Pillow's defaults.
+    """
+    quality, effort = output.get("quality"), output.get("effort")
+    opts = {}
+    if fmt in ("JPEG", "WEBP", "AVIF") and quality is not None:
+        opts["quality"] = quality
+    if fmt in ("JPEG", "PNG", "GIF") and output.get("optimize"):
+        opts["optimize"] = True
+    if fmt == "JPEG" and output.get("progressive"):
+        opts["progressive"] = True
+    if output.get("lossless"):
+        if fmt == "WEBP":
+            opts.update(lossless=True, quality=100)
+        elif fmt == "AVIF":
+            opts["quality"] = 100
+    if effort is not None:
+        if fmt == "PNG":
+            opts["compress_level"] = round(effort * 9 / 10)
+        elif fmt == "WEBP":
+            opts["method"] = round(effort * 6 / 10)
+        elif fmt == "AVIF":
+            opts["speed"] = 10 - effort
+    return opts
+
+
+def _is_graphic(img):
+    """True for flat-colour content (logos, screenshots), where lossless wins."""
+    if img.mode in ("P", "1"):
+        return True
+    sample = img.copy()
+    sample.thumbnail((256, 256))
+    return sample.getcolors(GRAPHIC_COLORS) is not None
+
+
+def _candidates(img, output):
+    """Formats worth trying in auto mode, for this content."""
+    alpha = "A" in img.getbands() or "transparency" in img.info
+    if output.get("lossless") or _is_graphic(img):
+        formats = ["PNG", "WEBP"]
+        output = dict(output, lossless=True)
+    elif alpha:
+        formats = ["WEBP", "AVIF", "PNG"]
+    else:
+        formats = ["JPEG", "WEBP", "AVIF"]
+    return [f for f in formats if available(f)], output
+
+
+def encode(img, out, default_format, output=None):
+    """Encode `img` into `out` as `output` asks and return the format used.
+
+    Without a requested format the source's `default_format` is kept. In
+    auto mode each candidate for the content is encoded and the smallest
+    is written to `out`.
+    """
+    output = output or {}
+    fmt = output.get("format")
+    if fmt == "auto":
+        formats, options = _candidates(img, output)
+        best = None
+        for candidate in formats:
+            buf = io.BytesIO()
+            _prepare(img, candidate).save(buf, format=candidate, **save_options(candidate, options))
+            if best is None or buf.tell() < best[1].tell():
+                best = candidate, buf
+        out.write(best[1].getbuffer())
+        return best[0]
+
+    fmt = FORMATS[fmt] if fmt else default_format
+    if not available(fmt):
+        raise ValueError(f"{fmt} encoding is not available on this worker")
+    _prepare(img, fmt).save(out, format=fmt, **save_options(fmt, output))
+    return fmt
+
+
+def _shared_palette(frames):
+    """One 255-colour palette for all frames, from a mosaic of a sample of them.
+
+    A palette shared by every frame keeps colours from flickering between
+    frames and lets unchanged pixels keep the same index, so the GIF
+    encoder's frame differencing finds more to skip.
+    """
+    w, h = frames[0].size
+    count = max(1, min(PALETTE_SAMPLE_FRAMES, len(frames), PALETTE_SAMPLE_PIXELS // (w * h)))
+    sample = frames[::max(1, len(frames) // count)][:count]
+    mosaic = Image.new("RGB", (w, h * len(sample)))
+    for i, frame in enumerate(sample):
+        mosaic.paste(frame.convert("RGB"), (0, i * h))
+    return mosaic.quantize(TRANSPARENT_INDEX)
+
+
+def _colors(frame, limit):
+    """RGB colours of a frame's opaque pixels; None when there are more than `limit`."""
+    counts = frame.convert("RGBA").getcolors(COLOR_SCAN_LIMIT)
+    if counts is None:
+        return None
+    colors = {rgba[:3] for _, rgba in counts if rgba[3] >= 128}
+    return colors if len(colors) <= limit else None
+
+
+def _padded(colors):
+    """Flat 256-entry palette of `colors`, padded with a colour that isn't
+    one of them so no padding entry is mistaken for a real colour."""
+    used = set(colors)
+    filler = next((i, 0, 0) for i in range(257) if (i, 0, 0) not in used)
+    return [v for rgb in list(colors) + [filler] * (256 - len(colors)) for v in rgb]
+
+
+def _exact_frames(frames, holes, source_palette, limit):
+    """Frames as P images with every colour kept exactly, or None when a
+    frame has more than `limit` colours.
+
+    Frames whose colours all come from the source's palette (e.g. after
+    only a flip or right-angle rotation) are written with that palette,
+    and so keep its indices; otherwise all frames share a palette of the
+    colours they use, or failing that each gets its own.
+    """
+    per_frame = [_colors(frame, limit) for frame in frames]
+    if None in per_frame:
+        return None
+    used = set().union(*per_frame)
+    if source_palette and len(source_palette) <= limit and used <= set(source_palette):
+        palettes = [source_palette] * len(frames)
+    elif len(used) <= limit:
+        palettes = [sorted(used)] * len(frames)
+    else:
+        palettes = [sorted(colors) for colors in per_frame]
+
+    exact = []
+    for frame, colors, palette, hole in zip(frames, per_frame, palettes, holes):
+        rgb = frame.convert("RGB")
+        if hole is not None and colors:
+            # Holes take an existing colour so they don't count as another one
+            rgb.paste(next(iter(colors)), mask=hole)
+        # Median cut keeps every colour when asked for no fewer than there are
+        q = rgb.quantize(max(1, len(colors)), dither=Image.Dither.NONE)
+        index = {}
+        for i, entry in enumerate(palette):
+            index.setdefault(entry, i)
+        flat = q.getpalette()
+        lut = [index.get(tuple(flat[i:i + 3]), 0) for i in range(0, len(flat), 3)]
+        p = Image.frombytes("L", q.size, q.tobytes()).point(lut + [0] * (256 - len(lut)))
+        p = Image.frombytes("P", p.size, p.tobytes())
+        p.putpalette(_padded(palette))
+        exact.append(p)
+    return exact
+
+
+def _gif_frames(frames, source_palette=None):
+    """Quantize RGBA frames for GIF; returns (frames, has transparency).
+
+    Colours are kept exactly when each frame has few enough of them;
+    otherwise every frame shares a palette built from the frames.
+    """
+    holes = []
+    for frame in frames:
+        alpha = frame.getchannel("A") if "A" in frame.getbands() else None
+        hole = alpha is not None and alpha.getextrema()[0] < 128
+        holes.append(alpha.point(lambda a: 255 if a < 128 else 0) if hole else None)
+    transparent = any(hole is not None for hole in holes)
+
+    # One index stays free for transparent pixels
+    quantized = _exact_frames(frames, holes, source_palette, TRANSPARENT_INDEX if transparent else 256)
+    if quantized is None:
+        palette = _shared_palette(frames)
+        quantized = [frame.convert("RGB").quantize(palette=palette, dither=Image.Dither.NONE) for frame in frames]
+    for p, hole in zip(quantized, holes):
+        if hole is not None:
+            p.paste(TRANSPARENT_INDEX, mask=hole)
+    return quantized, transparent
+
+
+def _save_animation(anim, out, fmt, output):
+    if fmt == "GIF":
+        frames, transparent = _gif_frames(anim.frames, anim.palette)
+        opts = {"optimize": True, "disposal": anim.disposal}
+        if transparent:
+            # Full frames with holes must clear what the previous one drew
+            opts.update(transparency=TRANSPARENT_INDEX, disposal=RESTORE_BACKGROUND)
+        if anim.loop is not None:
+            opts["loop"] = anim.loop
+    else:
+        frames = [_prepare(frame, fmt) for frame in anim.frames]
+        opts = save_options(fmt, output)
+        # 1 = play once, like a GIF without a loop extension
+        opts["loop"] = 1 if anim.loop is None else anim.loop
+    frames[0].save(
+        out, format=fmt, save_all=True, append_images=frames[1:], duration=anim.durations, **opts
+    )
+
+
+def stores_animation(output):
+    """Whether the `output` settings leave room for an animated result."""
+    fmt = (output or {}).get("format")
+    return not fmt or fmt == "auto" or FORMATS[fmt] in ANIMATED
+
+
+def encode_animation(anim, out, output=None):
+    """Encode an Animation into `out` and return the format used.
+
+    GIF unless `output` asks for WEBP, PNG (APNG) or AVIF; auto mode keeps
+    the smaller of GIF and WEBP. Durations and loop count carry over, and
+    GIF disposal is kept unless frames have transparent areas.
+    """
+    output = output or {}
+    fmt = output.get("format")
+    if fmt == "auto":
+        best = None
+        for candidate in [f for f in ANIMATED_AUTO if available(f)]:
+            buf = io.BytesIO()
+            _save_animation(anim, buf, candidate, output)
+            if best is None or buf.tell() < best[1].tell():
+                best = candidate, buf
+        out.write(best[1].getbuffer())
+        return best[0]
+
+    fmt = FORMATS[fmt] if fmt else "GIF"
+    if fmt not in ANIMATED or not available(fmt):
+        raise ValueError(f"{fmt} can't store an animation on this worker")
+    _save_animation(anim, out, fmt, output)
+    return fmt
@@ -0,0 +1,48 @@
+UPLOADS = "uploads/"
+RESULTS = "results/"
+# Folder for objects whose owner is unknown
+NO_OWNER = "_shared"
+# Content-addressed upload objects, one per distinct SHA-256, shared by every
+# upload record with those bytes
+CONTENT = UPLOADS + "_content/"
+
+
+def user_prefix(root, user):
+    """Folder holding one user's objects under `root`, e.g. results/alice/."""
+    return f"{root}{user or NO_OWNER}/"
+
+
+def upload_key(user, filename):
+    return user_prefix(UPLOADS, user) + filename
+
+
+def result_key(user, name):
+    return user_prefix(RESULTS, user) + name
+
+
+def folder_owner(key, root):
+    """User whose folder under `root` holds `key`; None for flat-layout keys."""
+    rest = key[len(root):] if key.startswith(root) else ""
+    return rest.split("/", 1)[0] if "/" in rest else None
+
+
+def content_key(digest):
+    return CONTENT + digest
+
+
+def legacy_key(root, name):
+    """Key an object had in the old flat layout, before per-user folders."""
+    return f"{root}{name}"
+
+
+def record_key(record):
+    """S3 key of the object behind an upload or result record.
+
+    Records written before the per-user layout carry no s3_key and still
+    point into the flat layout until scripts/migrate_user_layout.py runs.
+    """
+    if record.get("s3_key"):
+        return record["s3_key"]
+    if "filename" in record:
+        return legacy_key(UPLOADS, record["filename"])
+    return legacy_key(RESULTS, record["output"])
@@ -0,0 +1,45 @@
+import os
+import threading
+from functools import wraps
+
+# Build lazily initialized clients in the background right after startup
+WARMUP = os.environ.get("WARMUP", "1") == "1"
+
+
+def lazy(factory):
+    """Turn a zero-argument factory into a getter that builds its value once.
+
+    The first call runs the factory under a lock, so concurrent first calls
+    still build only one client; later calls return the stored value.
+    """
+    lock = threading.Lock()
+    state = {}
+
+    @wraps(factory)
+    def get():
+        if "value" not in state:
+            with lock:
+                if "value" not in state:
+                    state["value"] = factory()
+        return state["value"]
+
+    get.ready = lambda: "value" in state
+    return get
+
+
+def warm_up(*steps):
+    """Run each step once on a background thread, so /health answers at once
+    but the first real request doesn't pay for client setup. Failures are
+    only logged; the step will simply run again on first use."""
+    if not WARMUP:
+        return
+
+    def run():
+        for step in steps:
+            try:
+                step()
+            except Exception as e:
+                print(f"[DEBUG] Warm-up step {step.__name__} failed: {e}")
+        print("[DEBUG] Warm-up finished")
+
+    threading.Thread(target=run, name="warm-up", daemon=True).start()
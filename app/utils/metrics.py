@@ -0,0 +1,161 @@
+import time
+import threading
+from functools import wraps
+from contextlib import contextmanager
+from flask import g, request, has_request_context
+
+# Latency buckets (seconds) shared by every histogram
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+
+class Histogram:
+    """Minimal Prometheus histogram with labels, safe to observe from any thread."""
+
+    def __init__(self, name, help, labels, buckets=BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self.series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        with self._lock:
+            series = self.series.get(label_values)
+            if series is None:
+                series = self.series[label_values] = [[0] * len(self.buckets), 0.0, 0]
+            for i, upper in enumerate(self.buckets):
+                if value <= upper:
+                    series[0][i] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            items = sorted((k, ([*v[0]], v[1], v[2])) for k, v in self.series.items())
+        for label_values, (counts, total, count) in items:
+            labels = ",".join(f'{k}="{v}"' for k, v in zip(self.labels, label_values))
+            sep = "," if labels else ""
+            for upper, n in zip(self.buckets, counts):
+                lines.append(f'{self.name}_bucket{{{labels}{sep}le="{upper}"}} {n}')
+            lines.append(f'{self.name}_bucket{{{labels}{sep}le="+Inf"}} {count}')
+            lines.append(f"{self.name}_sum{{{labels}}} {total}")
+            lines.append(f"{self.name}_count{{{labels}}} {count}")
+        return "\n".join(lines)
+
+
+STAGE_SECONDS = Histogram(
+    "imageprocessor_stage_seconds", "Time spent in one stage of a request or job", ("stage",)
+)
+REQUEST_SECONDS = Histogram(
+    "imageprocessor_request_seconds", "HTTP request latency", ("service", "endpoint", "method", "status")
+)
+
+_local = threading.local()
+
+
+def _timings():
+    """List collecting stages for the current job or request, if any."""
+    timings = getattr(_local, "timings", None)
+    if timings is not None:
+        return timings
+    if has_request_context():
+        return g.setdefault("timings", [])
+    return None
+
+
+def record(stage, seconds):
+    STAGE_SECONDS.observe(seconds, stage)
+    timings = _timings()
+    if timings is not None:
+        timings.append((stage, seconds))
+
+
+@contextmanager
+def timer(stage):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(stage, time.perf_counter() - start)
+
+
+def timed(stage):
+    """Decorator form of timer()."""
+    def decorate(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            with timer(stage):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+@contextmanager
+def collect():
+    """Gather the stages recorded on this thread into a list, e.g. inside a
+    render process, so they can be handed back and replayed with record()."""
+    previous = getattr(_local, "timings", None)
+    _local.timings = []
+    try:
+        yield _local.timings
+    finally:
+        _local.timings = previous
+
+
+def collected(fn, *args):
+    """Run fn(*args) on a helper thread, gathering the stages it records;
+    returns (result, timings) for the caller to merge()."""
+    with collect() as timings:
+        return fn(*args), timings
+
+
+def merge(timings):
+    """Add stages already observed on another thread to the current job or
+    request (so Server-Timing includes them) without observing them again."""
+    current = _timings()
+    if current is not None:
+        current.extend(timings)
+
+
+def server_timing(timings, upstream=None):
+    """Server-Timing header value; repeated stages are summed, in first-seen order."""
+    totals = {}
+    for stage, seconds in timings:
+        totals[stage] = totals.get(stage, 0.0) + seconds
+    entries = [f"{stage};dur={seconds * 1000:.1f}" for stage, seconds in totals.items()]
+    if upstream:
+        entries.append(upstream)
+    return ", ".join(entries)
+
+
+def init_app(app, service):
+    """Time every request, add a Server-Timing header and serve /metrics."""
+
+    @app.before_request
+    def start_timer():
+        g.request_start = time.perf_counter()
+
+    @app.after_request
+    def finish_timer(response):
+        if "request_start" not in g:
+            return response
+        elapsed = time.perf_counter() - g.request_start
+        REQUEST_SECONDS.observe(elapsed, service, request.endpoint or "unknown", request.method, response.status_code)
+        timings = g.get("timings", []) + [("total", elapsed)]
+        response.headers["Server-Timing"] = server_timing(timings, g.get("upstream_timing"))
+        return response
+
+    @app.route("/metrics")
+    def metrics():
+        body = "\n".join([STAGE_SECONDS.render(), REQUEST_SECONDS.render()]) + "\n"
+        return body, 200, {"Content-Type": "text/plain; version=0.0.4"}
+
+
+def add_upstream(header, prefix):
+    """Pass a downstream service's Server-Timing entries through, renamed
+    with `prefix` so they don't collide with this service's stages."""
+    if not header or not has_request_context():
+        return
+    g.upstream_timing = ", ".join(f"{prefix}{entry.strip()}" for entry in header.split(",") if entry.strip())
@@ -0,0 +1,268 @@
+import os
+import math
+from PIL import Image, ImageFilter, ImageOps
+from app.utils.metrics import timer
+from app.utils import encoding
+
+T = Image.Transpose
+
+# rotate(angle, expand=True) for right angles is an exact transpose
+RIGHT_ANGLES = {90: T.ROTATE_90, 180: T.ROTATE_180, 270: T.ROTATE_270}
+
+# (orientation after rotate, flip) → single transpose doing both
+COMBINED = {
+    (None, "horizontal"): T.FLIP_LEFT_RIGHT,
+    (None, "vertical"): T.FLIP_TOP_BOTTOM,
+    (T.ROTATE_90, "horizontal"): T.TRANSVERSE,
+    (T.ROTATE_90, "vertical"): T.TRANSPOSE,
+    (T.ROTATE_180, "horizontal"): T.FLIP_TOP_BOTTOM,
+    (T.ROTATE_180, "vertical"): T.FLIP_LEFT_RIGHT,
+    (T.ROTATE_270, "horizontal"): T.TRANSPOSE,
+    (T.ROTATE_270, "vertical"): T.TRANSVERSE,
+}
+
+# Transposes that swap width and height
+SWAPS_AXES = {T.ROTATE_90, T.ROTATE_270, T.TRANSPOSE, T.TRANSVERSE}
+
+# Steps that may run on a reduced-resolution decode ahead of the resample
+DECODE_SAFE = {"grayscale", "convert", "rotate"}
+# A reduced decode keeps at least this many times the resample's target size
+DECODE_HEADROOM = float(os.environ.get("DECODE_HEADROOM", 1.0))
+
+
+def _rotated_size(size, angle):
+    """Approximate canvas size of rotate(angle, expand=True)."""
+    w, h = size
+    rad = math.radians(angle)
+    c, s = abs(math.cos(rad)), abs(math.sin(rad))
+    return w * c + h * s, w * s + h * c
+
+
+def target_size(resize, factor, current):
+    """Final size of the merged resize + upscale, relative to `current`."""
+    w = int(resize.get("width", current[0])) if resize else current[0]
+    h = int(resize.get("height", current[1])) if resize else current[1]
+    return int(w * factor), int(h * factor)
+
+
+def _number(name, value, cast=float):
+    """`value` as a finite number, or ValueError naming the operation."""
+    try:
+        number = cast(value)
+    except (TypeError, ValueError):
+        raise ValueError(f"{name} must be a number, not {value!r}")
+    if not math.isfinite(number):
+        raise ValueError(f"{name} must be finite, not {value!r}")
+    return number
+
+
+def canonical_operations(operations):
+    """Normalize an `operations` dict so equivalent requests compare equal.
+
+    Raises ValueError for a malformed operation or unsupported output format.
+    """
+    if not isinstance(operations, dict):
+        raise ValueError(f"Operations must be an object, not {type(operations).__name__}")
+    canonical = {}
+    for name, value in operations.items():
+        if name == "rotate":
+            angle = _number(name, value) % 360
+            if angle:
+                canonical[name] = angle
+        elif name in ("blur", "upscale"):
+            value = _number(name, value)
+            if value != (1.0 if name == "upscale" else 0.0):
+                canonical[name] = value
+        elif name == "resize":
+            if not isinstance(value or {}, dict):
+                raise ValueError(f"resize must be an object with width/height, not {value!r}")
+            resize = {k: _number(f"resize {k}", v, int) for k, v in (value or {}).items() if v is not None}
+            if resize:
+                canonical[name] = resize
+        elif name == "grayscale":
+            if value:
+                canonical[name] = True
+        elif name == "flip":
+            if isinstance(value, str) and value.lower() in ("horizontal", "vertical"):
+                canonical[name] = value.lower()
+        elif name == "output":
+            output = encoding.canonical_output(value or {})
+            if output:
+                canonical[name] = output
+        elif value is not None:
+            canonical[name] = value
+    return canonical
+
+
+def compile_plan(operations, size, mode="RGB"):
+    """Turn an `operations` dict into an ordered list of steps for execute_plan.
+
+    The result matches applying rotate → blur → resize → upscale → grayscale →
+    flip one by one, but grayscale runs first, resize and upscale become one
+    resample, right-angle rotations and flips collapse into a single transpose
+    and both blur and transpose run at whichever resolution is smaller.
+    """
+    plan = []
+
+    if operations.get("grayscale"):
+        plan.append({"op": "grayscale"})
+        mode = "L"
+
+    has_blur = "blur" in operations and float(operations["blur"]) > 0
+    has_resample = "resize" in operations or "upscale" in operations
+    if mode == "P" and (has_blur or has_resample or "rotate" in operations):
+        # Palette images can't be filtered or interpolated
+        plan.append({"op": "convert"})
+
+    orientation, angle = None, 0.0
+    if "rotate" in operations:
+        angle = float(operations["rotate"]) % 360
+        if angle in RIGHT_ANGLES:
+            orientation, angle = RIGHT_ANGLES[angle], 0.0
+
+    flip = operations.get("flip")
+    flip = flip.lower() if isinstance(flip, str) else None
+    if flip in ("horizontal", "vertical"):
+        orientation = COMBINED[(orientation, flip)]
+
+    current = size
+    if angle:
+        plan.append({"op": "rotate", "angle": angle})
+        current = _rotated_size(current, angle)
+
+    swap = orientation in SWAPS_AXES
+    oriented = current[::-1] if swap else current
+
+    resample = None
+    downscale = False
+    if has_resample:
+        target = target_size(operations.get("resize"), float(operations.get("upscale", 1)), oriented)
+        downscale = target[0] * target[1] < oriented[0] * oriented[1]
+        resample = {
+            "op": "resample",
+            "resize": operations.get("resize") or {},
+            "factor": float(operations.get("upscale", 1)),
+        }
+
+    # Transpose and blur are cheapest on the smaller side of the resample
+    if orientation is not None and not downscale:
+        plan.append({"op": "transpose", "method": orientation})
+    if has_blur and not downscale:
+        plan.append({"op": "blur", "radius": float(operations["blur"]), "scaled": False})
+    if resample:
+        resample["swap"] = swap and downscale
+        plan.append(resample)
+    if has_blur and downscale:
+        plan.append({"op": "blur", "radius": float(operations["blur"]), "scaled": True})
+    if orientation is not None and downscale:
+        plan.append({"op": "transpose", "method": orientation})
+
+    print(f"[DEBUG] Compiled plan for {operations}: {[s['op'] for s in plan]}")
+    return plan
+
+
+def _resample_target(step, size):
+    """Size a resample step produces from an image of `size`."""
+    current = size[::-1] if step["swap"] else size
+    target = target_size(step["resize"], step["factor"], current)
+    return target[::-1] if step["swap"] else target
+
+
+def output_size(plan, size):
+    """Predict the size execute_plan will produce, without touching pixels."""
+    for step in plan:
+        if step["op"] == "rotate":
+            w, h = _rotated_size(size, step["angle"])
+            size = (math.ceil(w), math.ceil(h))
+        elif step["op"] == "transpose" and step["method"] in SWAPS_AXES:
+            size = size[::-1]
+        elif step["op"] == "resample":
+            size = _resample_target(step, size)
+    return size
+
+
+def _reducible_resample(plan):
+    """Index of the plan's resample when only DECODE_SAFE steps precede it."""
+    for i, step in enumerate(plan):
+        if step["op"] == "resample":
+            return i
+        if step["op"] not in DECODE_SAFE:
+            return None
+    return None
+
+
+def decode_reduction(plan, size):
+    """Largest integer factor a `size` source can be shrunk by while decoding.
+
+    The reduced image must still cover the resample's target (times
+    DECODE_HEADROOM) on both axes; plans that don't downscale get 1.
+    """
+    i = _reducible_resample(plan)
+    if i is None:
+        return 1
+    before = output_size(plan[:i], size)
+    target = _resample_target(plan[i], before)
+    ratio = min(before[0] / max(1, target[0]), before[1] / max(1, target[1]))
+    return max(1, int(ratio / DECODE_HEADROOM))
+
+
+def rebase_plan(plan, size):
+    """Adapt a plan compiled for a `size` source to a reduced decode of it.
+
+    The resample is pinned to the absolute size it would produce from the
+    full-resolution source, and to its scale, so the output and any
+    post-resample blur radius come out the same.
+    """
+    i = _reducible_resample(plan)
+    if i is None:
+        return plan
+    step = plan[i]
+    before = output_size(plan[:i], size)
+    target = _resample_target(step, before)
+    width, height = target[::-1] if step["swap"] else target
+    pinned = dict(
+        step,
+        resize={"width": width, "height": height},
+        factor=1.0,
+        scale=(target[0] / before[0], target[1] / before[1]),
+    )
+    return plan[:i] + [pinned] + plan[i + 1:]
+
+
+def _execute_step(img, step, scale):
+    """Apply one step; returns the image and the resample scale so far."""
+    op = step["op"]
+    if op == "grayscale":
+        gray = ImageOps.grayscale(img)
+        if "A" in img.getbands():
+            # Keep transparency (e.g. transparent GIF frames) as LA
+            gray.putalpha(img.getchannel("A"))
+        img = gray
+    elif op == "convert":
+        img = img.convert("RGBA" if "transparency" in img.info else "RGB")
+    elif op == "rotate":
+        img = img.rotate(step["angle"], expand=True)
+    elif op == "transpose":
+        img = img.transpose(step["method"])
+    elif op == "blur":
+        radius = step["radius"]
+        if step["scaled"]:
+            radius = (radius * scale[0], radius * scale[1])
+        img = img.filter(ImageFilter.GaussianBlur(radius=radius))
+    elif op == "resample":
+        target = _resample_target(step, img.size)
+        if target != img.size:
+            scale = (target[0] / img.width, target[1] / img.height)
+            img = img.resize(target)
+        # Rebased plans carry the scale relative to the full-resolution source
+        scale = step.get("scale", scale)
+    return img, scale
+
+
+def execute_plan(img, plan):
+    """Apply a compiled plan to a PIL image and return the result."""
+    scale = (1.0, 1.0)
+    for step in plan:
+        with timer(f"op_{step['op']}"):
+            img, scale = _execute_step(img, step, scale)
+    return img
@@ -0,0 +1,72 @@
+import io
+import os
+from PIL import ImageFile, features
+from app.utils.lazy import lazy
+
+THUMBNAIL_PREFIX = "thumbnails/"
+THUMBNAIL_SIZE = int(os.environ.get("THUMBNAIL_SIZE", 256))
+# Undecoded sources bigger than this are not decoded just for a thumbnail
+MAX_SOURCE_PIXELS = int(os.environ.get("THUMBNAIL_MAX_SOURCE_PIXELS", 100_000_000))
+
+
+@lazy
+def encoding():
+    """(format, extension, content type) of thumbnails; WebP when Pillow has it."""
+    if features.check("webp"):
+        return "WEBP", ".webp", "image/webp"
+    return "JPEG", ".jpg", "image/jpeg"
+
+
+def content_type():
+    return encoding()[2]
+
+
+def thumbnail_key(key):
+    """S3 key of the thumbnail for the object at `key`."""
+    return f"{THUMBNAIL_PREFIX}{key}{encoding()[1]}"
+
+
+def object_keys(record, key):
+    """`key` plus its thumbnail keys, including one `record` stored under another format."""
+    found = {key, thumbnail_key(key)}
+    # Only a thumbnail of this very object; never one shared with another record
+    if (record.get("thumbnail") or "").startswith(f"{THUMBNAIL_PREFIX}{key}."):
+        found.add(record["thumbnail"])
+    return sorted(found)
+
+
+def make_thumbnail(img, size=None):
+    """Encode a small preview of `img` and return its bytes.
+
+    `size` overrides the box the preview must fit in, which lets callers
+    preview an output from a source with a different aspect ratio.
+    """
+    if size is None:
+        img.draft("RGB", (THUMBNAIL_SIZE, THUMBNAIL_SIZE))
+        undecoded = isinstance(img, ImageFile.ImageFile) and img.tile
+        if undecoded and img.width * img.height > MAX_SOURCE_PIXELS:
+            raise ValueError(f"{img.width}x{img.height} is too large to thumbnail")
+        # Shrink already-decoded pixels (e.g. a huge render) with a cheap box
+        # reduce first instead of copying them whole
+        factor = max(img.size) // (THUMBNAIL_SIZE * 2)
+        thumb = img.reduce(factor) if factor > 1 and img.mode not in ("P", "1") else img.copy()
+        thumb.thumbnail((THUMBNAIL_SIZE, THUMBNAIL_SIZE))
+    else:
+        thumb = img.resize(size, reducing_gap=2.0)
+
+    if thumb.mode not in ("RGB", "RGBA", "L"):
+        thumb = thumb.convert("RGBA" if "transparency" in thumb.info or "A" in thumb.getbands() else "RGB")
+    fmt = encoding()[0]
+    if fmt == "JPEG" and thumb.mode == "RGBA":
+        thumb = thumb.convert("RGB")
+
+    buf = io.BytesIO()
+    thumb.save(buf, format=fmt, quality=75)
+    return buf.getvalue()
+
+
+def fit(size):
+    """Scale `size` down to fit the thumbnail box, keeping its aspect ratio."""
+    w, h = size
+    scale = min(1.0, THUMBNAIL_SIZE / max(w, h))
+    return max(1, round(w * scale)), max(1, round(h * scale))
@@ -0,0 +1,122 @@
+import os
+import math
+import zlib
+import struct
+from PIL import ImageFilter
+from app.utils.planner import execute_plan, output_size, target_size
+
+MB = 1024 * 1024
+# Peak pixel memory a single job may use before it's refused
+MEMORY_BUDGET = int(os.environ.get("TILE_MEMORY_BUDGET", 512 * MB))
+# Outputs larger than this are rendered in bands instead of in one piece
+TILE_THRESHOLD = int(os.environ.get("TILE_THRESHOLD", 128 * MB))
+
+PNG_MODES = {"L": (0, 1), "RGB": (2, 3), "LA": (4, 2), "RGBA": (6, 4)}
+
+
+class MemoryBudgetExceeded(Exception):
+    pass
+
+
+def _bands(mode):
+    return PNG_MODES.get(mode, (0, 4))[1]
+
+
+def needs_tiling(img, plan, threshold=TILE_THRESHOLD):
+    """True when the plan's output would be too big to hold in one piece."""
+    if not any(step["op"] == "resample" for step in plan):
+        return False
+    w, h = output_size(plan, img.size)
+    return w * h * _bands(img.mode) > threshold
+
+
+class PngStreamWriter:
+    """Write a PNG row band by row band, keeping only one band in memory."""
+
+    def __init__(self, fileobj, size, mode):
+        self.fileobj = fileobj
+        self.mode = mode
+        self.compressor = zlib.compressobj(6)
+        color_type = PNG_MODES[mode][0]
+        fileobj.write(b"\x89PNG\r\n\x1a\n")
+        self._chunk(b"IHDR", struct.pack(">IIBBBBB", size[0], size[1], 8, color_type, 0, 0, 0))
+
+    def _chunk(self, tag, data):
+        self.fileobj.write(struct.pack(">I", len(data)))
+        self.fileobj.write(tag)
+        self.fileobj.write(data)
+        self.fileobj.write(struct.pack(">I", zlib.crc32(data, zlib.crc32(tag))))
+
+    def write(self, band):
+        raw = band.tobytes()
+        stride = len(raw) // band.height
+        # Filter type 0 (None) before every scanline
+        rows = b"".join(b"\x00" + raw[i:i + stride] for i in range(0, len(raw), stride))
+        data = self.compressor.compress(rows)
+        if data:
+            self._chunk(b"IDAT", data)
+
+    def close(self):
+        self._chunk(b"IDAT", self.compressor.flush())
+        self._chunk(b"IEND", b"")
+
+
+def execute_tiled(img, plan, fileobj, budget=MEMORY_BUDGET, preview=None):
+    """Run a plan, rendering everything from the resample on in row bands.
+
+    Steps before the resample run on the whole (source-sized) image. The
+    resample is evaluated band by band through resize(box=...), which reads
+    the same source pixels a full resize would, and a post-resample blur
+    gets enough overlapping rows that band seams are invisible. Bands are
+    encoded straight into `fileobj` as PNG.
+
+    `preview` is an optional callable given the prepared source and the
+    output size, for deriving a thumbnail without decoding the output.
+    Returns the output size, or the preview's result when one is given.
+    """
+    idx = next(i for i, step in enumerate(plan) if step["op"] == "resample")
+    img = execute_plan(img, plan[:idx])
+    resample, post = plan[idx], plan[idx + 1:]
+
+    # Transposes commute with the resample; doing them first keeps bands
+    # row-aligned, and the resize spec is already in the final orientation
+    for step in post:
+        if step["op"] == "transpose":
+            img = img.transpose(step["method"])
+    target = target_size(resample["resize"], resample["factor"], img.size)
+
+    if img.mode not in PNG_MODES:
+        img = img.convert("RGBA" if "A" in img.getbands() else "RGB")
+
+    width, height = target
+    sx, sy = width / img.width, height / img.height
+    blur = next((step for step in post if step["op"] == "blur"), None)
+    bx, by = sx, sy
+    if "scale" in resample:
+        # Scale relative to the full-resolution source, before the transposes
+        bx, by = resample["scale"][::-1] if resample["swap"] else resample["scale"]
+    radius = (blur["radius"] * bx, blur["radius"] * by) if blur else None
+    margin = math.ceil(3 * radius[1]) + 2 if blur else 0
+
+    source_bytes = img.width * img.height * _bands(img.mode)
+    row_bytes = width * _bands(img.mode)
+    # A band, its blurred copy and its encoded rows are alive at once
+    band_rows = (budget - source_bytes) // (3 * row_bytes) - 2 * margin
+    if band_rows < 1:
+        raise MemoryBudgetExceeded(
+            f"{width}x{height} output needs more than {budget // MB} MB"
+        )
+    band_rows = min(band_rows, height)
+    print(f"[DEBUG] Tiled render: {width}x{height} in bands of {band_rows} rows")
+
+    writer = PngStreamWriter(fileobj, target, img.mode)
+    for y0 in range(0, height, band_rows):
+        y1 = min(height, y0 + band_rows)
+        a0, a1 = max(0, y0 - margin), min(height, y1 + margin)
+        band = img.resize((width, a1 - a0), box=(0, a0 / sy, img.width, a1 / sy))
+        if blur:
+            band = band.filter(ImageFilter.GaussianBlur(radius=radius))
+            band = band.crop((0, y0 - a0, width, y1 - a0))
+        writer.write(band)
+    writer.close()
+    return preview(img, target) if preview else target
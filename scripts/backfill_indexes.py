@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+"""Create the uploads/results GSIs and backfill the attributes they key on.
+
+Besides the per-user (exact and lower-cased) and per-kind timelines,
+each table gets a point lookup index on (user, filename) or (user, output),
+and uploads one on (user, content_hash). Records saved without a user are
+given the shared owner so every index covers them.
+
+Usage: python scripts/backfill_indexes.py
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.services import ddb  # noqa: E402
+from app.utils.keys import NO_OWNER  # noqa: E402
+
+# index → (partition key, (sort key, type))
+TIMELINES = {
+    ddb.USER_INDEX: ("user", ("timestamp", "N")),
+    ddb.KIND_INDEX: ("kind", ("timestamp", "N")),
+    ddb.FOLDED_USER_INDEX: ("user_folded", ("timestamp", "N")),
+}
+INDEXES = {
+    "uploads": dict(TIMELINES, **{
+        ddb.UPLOAD_NAME_INDEX: ("user", ("filename", "S")),
+        ddb.UPLOAD_CONTENT_INDEX: ("user", ("content_hash", "S")),
+    }),
+    "results": dict(TIMELINES, **{ddb.RESULT_NAME_INDEX: ("user", ("output", "S"))}),
+}
+
+
+def ensure_indexes(table, indexes):
+    """Create any missing GSI, one at a time as DynamoDB requires."""
+    for index, (partition, (sort, sort_type)) in indexes.items():
+        table.reload()
+        existing = {i["IndexName"] for i in table.global_secondary_indexes or []}
+        if index in existing:
+            print(f"[INFO] {table.name}: {index} already exists")
+            continue
+
+        create = {
+            "IndexName": index,
+            "KeySchema": [
+                {"AttributeName": partition, "KeyType": "HASH"},
+                {"AttributeName": sort, "KeyType": "RANGE"},
+            ],
+            "Projection": {"ProjectionType": "ALL"},
+        }
+        if (table.billing_mode_summary or {}).get("BillingMode") != "PAY_PER_REQUEST":
+            create["ProvisionedThroughput"] = {"ReadCapacityUnits": 5, "WriteCapacityUnits": 5}
+
+        print(f"[INFO] {table.name}: creating {index}")
+        table.meta.client.update_table(
+            TableName=table.name,
+            AttributeDefinitions=[
+                {"AttributeName": partition, "AttributeType": "S"},
+                {"AttributeName": sort, "AttributeType": sort_type},
+            ],
+            GlobalSecondaryIndexUpdates=[{"Create": create}],
+        )
+        while True:
+            table.reload()
+            status = {i["IndexName"]: i["IndexStatus"] for i in table.global_secondary_indexes or []}
+            if status.get(index) == "ACTIVE":
+                break
+            time.sleep(10)
+
+
+def backfill_keys(table, kind):
+    """Tag every record that predates the `kind` or `user_folded` attributes,
+    and give user-less records the shared owner so the user-keyed indexes
+    hold them."""
+    updated = 0
+    kwargs = {"ProjectionExpression": "id, kind, #u, user_folded", "ExpressionAttributeNames": {"#u": "user"}}
+    while True:
+        response = table.scan(**kwargs)
+        for item in response.get("Items", []):
+            if item["id"].startswith(ddb.CONTENT_PREFIX):
+                continue  # content reference counters aren't records
+            user = item.get("user") or NO_OWNER
+            if item.get("kind") != kind or not item.get("user") or item.get("user_folded") != ddb.folded(user):
+                # A user stored as NULL (older writes) is overwritten too
+                table.update_item(
+                    Key={"id": item["id"]},
+                    UpdateExpression="SET kind = :k, #u = :u, user_folded = :f",
+                    ExpressionAttributeNames={"#u": "user"},
+                    ExpressionAttributeValues={":k": kind, ":u": user, ":f": ddb.folded(user)},
+                )
+                updated += 1
+        if "LastEvaluatedKey" not in response:
+            break
+        kwargs["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+    print(f"[INFO] {table.name}: backfilled index keys on {updated} records")
+
+
+if __name__ == "__main__":
+    for table, name, kind in (
+        (ddb.uploads_table(), "uploads", "upload"),
+        (ddb.results_table(), "results", "result"),
+    ):
+        backfill_keys(table, kind)
+        ensure_indexes(table, INDEXES[name])
@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+"""Generate thumbnails for uploads/results stored before thumbnails existed.
+
+Usage: python scripts/backfill_thumbnails.py
+"""
+import io
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from PIL import Image  # noqa: E402
+from app.services import s3, ddb  # noqa: E402
+from app.utils import thumbnails, keys  # noqa: E402
+
+
+def backfill(table, name_attr):
+    done, failed = 0, 0
+    kwargs = {
+        "ProjectionExpression": "id, #n, s3_key, thumbnail",
+        "ExpressionAttributeNames": {"#n": name_attr},
+    }
+    while True:
+        response = table.scan(**kwargs)
+        for item in response.get("Items", []):
+            if item.get("thumbnail") or not item.get(name_attr):
+                continue
+            key = keys.record_key(item)
+            thumb_key = thumbnails.thumbnail_key(key)
+            try:
+                # Records sharing an object (e.g. cached results) share its thumbnail
+                if not s3.get_etag(thumb_key):
+                    with s3.download_fileobj_from_s3(key) as src, Image.open(src) as img:
+                        thumb = thumbnails.make_thumbnail(img)
+                    s3.upload_fileobj_to_s3(io.BytesIO(thumb), thumb_key, thumbnails.content_type())
+                ddb.set_thumbnail(table, item["id"], thumb_key)
+                done += 1
+            except Exception as e:
+                print(f"[WARN] Skipping {key}: {e}")
+                failed += 1
+        if "LastEvaluatedKey" not in response:
+            break
+        kwargs["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+    print(f"[INFO] {table.name}: {done} thumbnails backfilled, {failed} skipped")
+
+
+if __name__ == "__main__":
+    backfill(ddb.uploads_table(), "filename")
+    backfill(ddb.results_table(), "output")
@@ -0,0 +1,276 @@
+#!/usr/bin/env python3
+"""Benchmark every processing operation and common chains.
+
+Runs a matrix of synthetic source images (sizes x modes x formats)
+through the worker pipeline and times each stage separately:
+
+  decode   open + load of the encoded source
+  render   compile_plan + execute_plan
+  encode   saving the output in the source's format
+  thumb    thumbnail generation
+  job      (--job) the whole run_job path, with S3 and DynamoDB replaced
+           by an in-memory store so only local work is measured
+
+Each figure is the median of --repeat runs, in seconds. Save a run with
+--output and pass it back with --baseline to compare: cases slower than
+the baseline by more than --threshold are listed and the exit status is 1,
+so this can gate a deploy.
+
+Usage: python scripts/bench_pipeline.py [--sizes 512,2048] [--modes RGB,P]
+           [--formats PNG,JPEG] [--cases blur,rotate+upscale] [--repeat 5]
+           [--job] [--output run.json] [--baseline run.json [--threshold 0.15] [--min-delta 0.001]]
+"""
+import io
+import os
+import sys
+import json
+import time
+import uuid
+import argparse
+import platform
+import statistics
+import contextlib
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Render on the calling thread: pool start-up and IPC are not what we measure
+os.environ.setdefault("WORKER_PROCESSES", "0")
+os.environ.setdefault("CONFIG_BACKEND", "file")
+
+import PIL  # noqa: E402
+from PIL import Image, features  # noqa: E402
+from app.utils import thumbnails, keys  # noqa: E402
+from app.utils.planner import canonical_operations, compile_plan, execute_plan  # noqa: E402
+
+CASES = {
+    "rotate": {"rotate": 5},
+    "rotate90": {"rotate": 90},
+    "blur": {"blur": 2},
+    "resize": {"resize": {"width": 320, "height": 240}},
+    "upscale": {"upscale": 2},
+    "grayscale": {"grayscale": True},
+    "flip": {"flip": "horizontal"},
+    # The old /stress workload
+    "rotate+upscale": {"rotate": 5, "upscale": 2},
+    "grayscale+blur+resize": {"grayscale": True, "blur": 2, "resize": {"width": 640, "height": 480}},
+    "rotate90+flip": {"rotate": 90, "flip": "vertical"},
+}
+
+SIZES = [512, 2048]
+MODES = ["RGB", "RGBA", "L", "P"]
+FORMATS = ["JPEG", "PNG", "GIF", "WEBP"]
+
+# Modes each format can store without conversion
+FORMAT_MODES = {
+    "JPEG": {"RGB", "L"},
+    "PNG": {"RGB", "RGBA", "L", "P"},
+    "GIF": {"L", "P"},
+    "WEBP": {"RGB", "RGBA"},
+}
+EXTENSIONS = {"JPEG": ".jpg", "PNG": ".png", "GIF": ".gif", "WEBP": ".webp"}
+
+
+def synthetic(size, mode):
+    """A deterministic photo-like test image: gradients plus noise."""
+    w, h = size * 4 // 3, size
+    bands = [
+        Image.linear_gradient("L").resize((w, h)),
+        Image.radial_gradient("L").resize((w, h)),
+        Image.effect_noise((w, h), 40),
+    ]
+    img = Image.merge("RGB", bands)
+    if mode == "RGBA":
+        img.putalpha(Image.linear_gradient("L").rotate(90).resize((w, h)))
+    elif mode == "P":
+        img = img.quantize(256)
+    elif mode == "L":
+        img = img.convert("L")
+    return img
+
+
+def encode(img, fmt):
+    buf = io.BytesIO()
+    img.save(buf, format=fmt)
+    return buf.getvalue()
+
+
+def timed(fn, repeat):
+    """Median wall time of `repeat` calls to fn."""
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - start)
+    return statistics.median(samples)
+
+
+class MemoryStore:
+    """Stands in for the s3/ddb calls run_job makes."""
+
+    def __init__(self):
+        self.objects = {}
+
+    def upload(self, fileobj, key, content_type=None):
+        fileobj.seek(0)
+        self.objects[key] = fileobj.read()
+        return key
+
+    def install(self):
+        from app.services import s3, ddb
+        # A fresh ETag per call keeps the result cache from short-circuiting jobs
+        s3.get_etag = lambda key: uuid.uuid4().hex if key in self.objects else None
+        s3.download_fileobj_from_s3 = lambda key: io.BytesIO(self.objects[key])
+        s3.upload_fileobj_to_s3 = self.upload
+        ddb.find_uploads = lambda user, filename: []
+        ddb.save_result_metadata = lambda input, output, user, thumbnail=None, s3_key=None, *args: {
+            "input": input, "output": output, "thumbnail": thumbnail, "s3_key": s3_key
+        }
+
+
+def bench_source(size, mode, fmt, cases, repeat, store=None):
+    data = encode(synthetic(size, mode), fmt)
+    decoded = Image.open(io.BytesIO(data))
+    decoded.load()
+    key = f"{size}-{mode}{EXTENSIONS[fmt]}"
+    if store:
+        store.objects[keys.upload_key("bench", key)] = data
+        from app.routes.process import run_job
+
+    def decode():
+        with Image.open(io.BytesIO(data)) as img:
+            img.load()
+
+    rows = []
+    decode_time = timed(decode, repeat)
+    for name in cases:
+        operations = canonical_operations(CASES[name])
+        plan = compile_plan(operations, decoded.size, decoded.mode)
+        output = execute_plan(decoded, plan)
+
+        row = {
+            "case": name, "size": size, "mode": mode, "format": fmt,
+            "output_size": list(output.size), "bytes_in": len(data),
+            "decode": decode_time,
+            "render": timed(lambda: execute_plan(decoded, compile_plan(operations, decoded.size, decoded.mode)), repeat),
+            "encode": timed(lambda: output.save(io.BytesIO(), format=fmt), repeat),
+            "thumb": timed(lambda: thumbnails.make_thumbnail(output), repeat),
+        }
+        if store:
+            def job():
+                body, status = run_job({"filename": key, "operations": CASES[name], "username": "bench"})
+                if status != 200:
+                    raise RuntimeError(body)
+            row["job"] = timed(job, repeat)
+        rows.append(row)
+    return rows
+
+
+def run(args):
+    store = None
+    if args.job:
+        store = MemoryStore()
+        store.install()
+
+    rows = []
+    for size in args.sizes:
+        for fmt in args.formats:
+            if fmt == "WEBP" and not features.check("webp"):
+                continue
+            for mode in args.modes:
+                if mode not in FORMAT_MODES[fmt]:
+                    continue
+                rows.extend(bench_source(size, mode, fmt, args.cases, args.repeat, store))
+                print(f"[INFO] {size} {mode} {fmt}: {len(args.cases)} cases", file=sys.stderr)
+    return {
+        "python": platform.python_version(),
+        "pillow": PIL.__version__,
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+        "repeat": args.repeat,
+        "results": rows,
+    }
+
+
+STAGES = ["decode", "render", "encode", "thumb", "job"]
+
+
+def row_key(row):
+    return row["case"], row["size"], row["mode"], row["format"]
+
+
+def compare(report, baseline, threshold, min_delta=0.0):
+    """Return [(key, stage, baseline s, current s)] for every regression.
+
+    Slowdowns under `min_delta` seconds are ignored as timer noise.
+    """
+    before = {row_key(r): r for r in baseline["results"]}
+    regressions = []
+    for row in report["results"]:
+        old = before.get(row_key(row))
+        if not old:
+            continue
+        for stage in STAGES:
+            if stage not in row or stage not in old:
+                continue
+            if row[stage] > old[stage] * (1 + threshold) and row[stage] - old[stage] >= min_delta:
+                regressions.append((row_key(row), stage, old[stage], row[stage]))
+    return regressions
+
+
+def print_table(report):
+    print(f"{'case':24s} {'size':>5s} {'mode':4s} {'fmt':4s} " + " ".join(f"{s + ' ms':>9s}" for s in STAGES))
+    for row in report["results"]:
+        times = " ".join(f"{row[s] * 1000:9.1f}" if s in row else f"{'-':>9s}" for s in STAGES)
+        print(f"{row['case']:24s} {row['size']:5d} {row['mode']:4s} {row['format'][:4]:4s} {times}")
+
+
+def csv(kind, choices=None):
+    def parse(value):
+        items = [kind(v) for v in value.split(",") if v]
+        unknown = [v for v in items if choices and v not in choices]
+        if unknown:
+            raise argparse.ArgumentTypeError(f"unknown: {', '.join(map(str, unknown))}")
+        return items
+    return parse
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=csv(int), default=SIZES, help="source heights in pixels")
+    parser.add_argument("--modes", type=csv(str, MODES), default=MODES)
+    parser.add_argument("--formats", type=csv(str, FORMATS), default=FORMATS)
+    parser.add_argument("--cases", type=csv(str, CASES), default=list(CASES))
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--job", action="store_true", help="also time run_job end to end")
+    parser.add_argument("--output", help="write the JSON report here")
+    parser.add_argument("--baseline", help="JSON report to compare against")
+    parser.add_argument("--threshold", type=float, default=0.15, help="allowed slowdown (0.15 = 15%%)")
+    parser.add_argument("--min-delta", type=float, default=0.001, help="ignore slowdowns under this many seconds")
+    parser.add_argument("--json", action="store_true", help="print the JSON report")
+    args = parser.parse_args()
+
+    # The planner and services log every call; keep timings and output clean
+    with contextlib.redirect_stdout(io.StringIO()):
+        report = run(args)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_table(report)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(report, json.load(f), args.threshold, args.min_delta)
+        for (case, size, mode, fmt), stage, old, new in regressions:
+            print(f"[REGRESSION] {case} {size} {mode} {fmt} {stage}: "
+                  f"{old * 1000:.1f}ms → {new * 1000:.1f}ms (+{(new / old - 1) * 100:.0f}%)")
+        if regressions:
+            sys.exit(1)
+        print(f"[INFO] No regressions over {args.threshold:.0%} against {args.baseline}")
+
+
+if __name__ == "__main__":
+    main()
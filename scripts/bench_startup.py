@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+"""Measure cold-start time of the API and worker services.
+
+For each service a fresh interpreter imports the app module and then
+serves its health route through Flask's test client. Reported per run:
+
+  import   seconds spent importing the module
+  ready    seconds from interpreter start to the first healthy response
+
+Warm-up, queue consumers and the render pool are disabled and config is
+forced offline, so any AWS call sneaking back onto the import path makes
+the run fail instead of just getting slower.
+
+Usage: python scripts/bench_startup.py [--runs 5] [--budget 2.0] [--json]
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import statistics
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SERVICES = {"api": "/health", "worker": "/"}
+
+PROBE = """
+import json, time
+t0 = time.perf_counter()
+import {module}
+t1 = time.perf_counter()
+resp = {module}.app.test_client().get("{path}")
+t2 = time.perf_counter()
+print("BENCH " + json.dumps({{"import": t1 - t0, "status": resp.status_code}}))
+"""
+
+ENV = {
+    "WARMUP": "0",
+    "JOB_WORKERS": "0",
+    "WORKER_PROCESSES": "0",
+    "CONFIG_BACKEND": "file",
+}
+
+
+def run_once(module, path):
+    env = dict(os.environ, **ENV)
+    start = time.perf_counter()
+    proc = subprocess.run(
+        [sys.executable, "-c", PROBE.format(module=module, path=path)],
+        cwd=ROOT, env=env, capture_output=True, text=True,
+    )
+    ready = time.perf_counter() - start
+    line = next((l for l in proc.stdout.splitlines() if l.startswith("BENCH ")), None)
+    if proc.returncode or not line:
+        raise RuntimeError(f"{module} failed to start:\n{proc.stderr[-2000:]}")
+    result = json.loads(line[len("BENCH "):])
+    if result["status"] != 200:
+        raise RuntimeError(f"{module} health check returned {result['status']}")
+    return {"import": result["import"], "ready": ready}
+
+
+def summarize(samples):
+    return {
+        "median": statistics.median(samples),
+        "min": min(samples),
+        "max": max(samples),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--budget", type=float, help="fail if any median ready time exceeds this (s)")
+    parser.add_argument("--json", action="store_true", help="print machine-readable output")
+    args = parser.parse_args()
+
+    report = {}
+    for module, path in SERVICES.items():
+        runs = [run_once(module, path) for _ in range(args.runs)]
+        report[module] = {
+            "import": summarize([r["import"] for r in runs]),
+            "ready": summarize([r["ready"] for r in runs]),
+        }
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        for module, stats in report.items():
+            print(f"{module:7s} import {stats['import']['median']:.3f}s  "
+                  f"ready {stats['ready']['median']:.3f}s  "
+                  f"(min {stats['ready']['min']:.3f}s, max {stats['ready']['max']:.3f}s)")
+
+    if args.budget and any(s["ready"]["median"] > args.budget for s in report.values()):
+        print(f"[ERROR] Startup exceeded {args.budget}s budget")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
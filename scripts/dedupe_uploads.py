@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+"""Move existing uploads into the content-addressed store.
+
+Every upload record without a content_hash has its object hashed and
+pointed at uploads/_content/<sha256>, taking a reference there; identical
+files end up stored once. Old keys (and their thumbnails) are deleted only
+once every record has been moved, since same-name uploads used to share
+one object. Safe to re-run: moved records are skipped.
+
+Usage: python scripts/dedupe_uploads.py [--dry-run] [--keep-legacy] [--workers 8]
+"""
+import os
+import sys
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.services import s3, ddb, content  # noqa: E402
+from app.utils import thumbnails, keys  # noqa: E402
+
+
+def unhashed_records(table):
+    kwargs = {"ProjectionExpression": "id, #u, filename, s3_key, thumbnail, content_hash, size_bytes",
+              "ExpressionAttributeNames": {"#u": "user"}}
+    while True:
+        response = table.scan(**kwargs)
+        for item in response.get("Items", []):
+            if item.get("filename") and not item.get("content_hash"):
+                yield item
+        if "LastEvaluatedKey" not in response:
+            return
+        kwargs["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+
+
+def dedupe_record(item, dry_run):
+    """Hash one record's object and move it into the content store.
+
+    Returns (digest, old keys to delete).
+    """
+    old_key = keys.record_key(item)
+    with s3.download_fileobj_from_s3(old_key) as src:
+        digest = content.digest_file(src)
+    print(f"[INFO] {old_key} → {keys.content_key(digest)}")
+    if dry_run:
+        return digest, []
+
+    new_key, _ = content.acquire(digest, lambda key: s3.copy_object(old_key, key))
+    new_thumb = thumbnails.thumbnail_key(new_key)
+    old_thumb = item.get("thumbnail")
+    if not s3.get_etag(new_thumb):
+        if old_thumb and s3.get_etag(old_thumb):
+            s3.copy_object(old_thumb, new_thumb)
+        else:
+            new_thumb = None
+    ddb.set_content(item["id"], digest, new_key, new_thumb)
+    return digest, [k for k in (old_key, old_thumb) if k]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--dry-run", action="store_true", help="only hash and report duplicates")
+    parser.add_argument("--keep-legacy", action="store_true", help="don't delete the old keys")
+    parser.add_argument("--workers", type=int, default=8)
+    args = parser.parse_args()
+
+    with ThreadPoolExecutor(args.workers) as pool:
+        futures = [
+            (item, pool.submit(dedupe_record, item, args.dry_run))
+            for item in unhashed_records(ddb.uploads_table())
+        ]
+        old_keys, digests, failed, duplicate_bytes = set(), set(), 0, 0
+        for item, future in futures:
+            try:
+                digest, moved = future.result()
+            except Exception as e:
+                print(f"[WARN] Skipping {keys.record_key(item)}: {e}")
+                failed += 1
+                continue
+            if digest in digests:
+                duplicate_bytes += int(item.get("size_bytes") or 0)
+            digests.add(digest)
+            old_keys.update(moved)
+    print(f"[INFO] {len(futures) - failed} records hashed into {len(digests)} distinct files, "
+          f"{duplicate_bytes} duplicate bytes, {failed} failed")
+
+    if failed or args.keep_legacy or not old_keys:
+        if failed:
+            print("[WARN] Some records failed; legacy objects kept. Re-run to retry.")
+        return
+
+    old_keys = sorted(old_keys)
+    deleted = 0
+    for i in range(0, len(old_keys), s3.DELETE_BATCH):
+        done, _ = s3.delete_keys(old_keys[i:i + s3.DELETE_BATCH])
+        deleted += done
+    print(f"[INFO] Deleted {deleted} legacy objects")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+"""Concurrent load generator for the processing endpoint.
+
+Closed-loop by default (--concurrency clients sending back to back); pass
+--rate for open-loop Poisson arrivals, which is what finds the point
+where the worker fleet stops keeping up. Reports p50/p95/p99 latency, a
+latency histogram, throughput and errors by status/exception.
+
+The worker's /process needs no login, so the default target is the
+worker directly; pass the uploader of FILENAME with --user, since the
+worker looks sources up in that user's folder. To go through the API
+pass its /process URL and the session cookie with --cookie instead.
+
+Usage: python scripts/loadtest.py FILENAME [--user NAME] [--url URL] [--duration 30]
+           [--concurrency 8] [--rate 5] [--mix mix.json] [--json]
+
+A mix file is a JSON list of {"weight": N, "operations": {...}}.
+"""
+import os
+import sys
+import json
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.services import loadgen  # noqa: E402
+from app.services.worker_client import WORKER_URL  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("filename", help="uploaded image to process")
+    parser.add_argument("--url", default=f"{WORKER_URL}/process")
+    parser.add_argument("--duration", type=float, default=30)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--rate", type=float, help="open-loop arrivals per second")
+    parser.add_argument("--mix", help="JSON file with the operation mix")
+    parser.add_argument("--timeout", type=float, default=60)
+    parser.add_argument("--cookie", help="session cookie value when targeting the API")
+    parser.add_argument("--user", help="username the jobs run as (and owner of FILENAME)")
+    parser.add_argument("--owner", help="owner of FILENAME when it isn't --user")
+    parser.add_argument("--seed", type=int)
+    parser.add_argument("--json", action="store_true", help="print machine-readable output")
+    args = parser.parse_args()
+    if not args.user and not args.cookie:
+        parser.error("--user is required when targeting the worker directly")
+
+    mix = None
+    if args.mix:
+        with open(args.mix) as f:
+            mix = json.load(f)
+        try:
+            loadgen.check_mix(mix)
+        except ValueError as e:
+            parser.error(f"{args.mix}: {e}")
+    headers = {"Cookie": f"session={args.cookie}"} if args.cookie else None
+
+    report = loadgen.run(
+        args.url, args.filename, duration=args.duration, concurrency=args.concurrency,
+        rate=args.rate, mix=mix, timeout=args.timeout, headers=headers, seed=args.seed,
+        user=args.user, owner=args.owner,
+    )
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return
+
+    lat = report["latency"]
+    fmt = lambda v: "-" if v is None else f"{v * 1000:.0f}ms"  # noqa: E731
+    print(f"requests {report['requests_sent']}  ok {report['successes']}  failed {report['failures']}  "
+          f"throughput {report['throughput']:.2f} req/s")
+    print(f"latency  p50 {fmt(lat['p50'])}  p95 {fmt(lat['p95'])}  p99 {fmt(lat['p99'])}  max {fmt(lat['max'])}")
+    total = max(1, report["successes"])
+    for bucket in report["histogram"]:
+        bar = "#" * round(40 * bucket["count"] / total)
+        label = bucket["le"] if bucket["le"] == "+Inf" else f"{bucket['le']}s"
+        print(f"  <= {label:>6} {bucket['count']:6d} {bar}")
+    for error, count in sorted(report["errors"].items(), key=lambda e: -e[1]):
+        print(f"error    {error}: {count}")
+
+
+if __name__ == "__main__":
+    main()
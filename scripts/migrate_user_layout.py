@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+"""Move objects from the flat uploads/ and results/ layout into per-user folders.
+
+For every record without an s3_key the object (and its thumbnail) is
+copied to uploads/<user>/... or results/<user>/..., then the record is
+pointed at the new key. Old keys are deleted only once every record has
+been migrated, since cached results can share one object between
+records. Safe to re-run: migrated records are skipped and copies that
+already exist are not repeated.
+
+Usage: python scripts/migrate_user_layout.py [--dry-run] [--keep-legacy] [--workers 8]
+"""
+import os
+import sys
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.services import s3, ddb  # noqa: E402
+from app.utils import thumbnails, keys  # noqa: E402
+
+
+def legacy_records(table, name_attr):
+    kwargs = {
+        "ProjectionExpression": "id, #u, #n, s3_key, thumbnail",
+        "ExpressionAttributeNames": {"#u": "user", "#n": name_attr},
+    }
+    while True:
+        response = table.scan(**kwargs)
+        for item in response.get("Items", []):
+            if not item.get("s3_key") and item.get(name_attr):
+                yield item
+        if "LastEvaluatedKey" not in response:
+            return
+        kwargs["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+
+
+def migrate_record(table, item, root, name_attr, dry_run):
+    """Copy one record's object and thumbnail; returns the old keys to delete."""
+    old_key = keys.record_key(item)
+    new_key = keys.user_prefix(root, item.get("user")) + item[name_attr]
+    old_thumb = item.get("thumbnail")
+    new_thumb = thumbnails.thumbnail_key(new_key) if old_thumb else None
+    print(f"[INFO] {old_key} → {new_key}")
+    if dry_run:
+        return []
+
+    if not s3.get_etag(new_key):
+        if not s3.get_etag(old_key):
+            print(f"[WARN] Skipping {old_key}: object missing")
+            return []
+        s3.copy_object(old_key, new_key)
+    if old_thumb and not s3.get_etag(new_thumb):
+        if s3.get_etag(old_thumb):
+            s3.copy_object(old_thumb, new_thumb)
+        else:
+            new_thumb = None
+    ddb.set_s3_key(table, item["id"], new_key, new_thumb)
+    return [k for k in (old_key, old_thumb) if k]
+
+
+def migrate(table, root, name_attr, workers, dry_run):
+    with ThreadPoolExecutor(workers) as pool:
+        futures = [
+            pool.submit(migrate_record, table, item, root, name_attr, dry_run)
+            for item in legacy_records(table, name_attr)
+        ]
+        old_keys, failed = set(), 0
+        for future in futures:
+            try:
+                old_keys.update(future.result())
+            except Exception as e:
+                print(f"[WARN] Migration failed: {e}")
+                failed += 1
+    print(f"[INFO] {table.name}: {len(futures) - failed} records migrated, {failed} failed")
+    return old_keys, failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--dry-run", action="store_true", help="only print what would move")
+    parser.add_argument("--keep-legacy", action="store_true", help="don't delete the old keys")
+    parser.add_argument("--workers", type=int, default=8)
+    args = parser.parse_args()
+
+    old_keys, failed = set(), 0
+    for table, root, name_attr in (
+        (ddb.uploads_table(), keys.UPLOADS, "filename"),
+        (ddb.results_table(), keys.RESULTS, "output"),
+    ):
+        moved, errors = migrate(table, root, name_attr, args.workers, args.dry_run)
+        old_keys |= moved
+        failed += errors
+
+    if failed or args.keep_legacy or not old_keys:
+        if failed:
+            print("[WARN] Some records failed; legacy objects kept. Re-run to retry.")
+        return
+
+    old_keys = sorted(old_keys)
+    deleted = 0
+    for i in range(0, len(old_keys), s3.DELETE_BATCH):
+        done, _ = s3.delete_keys(old_keys[i:i + s3.DELETE_BATCH])
+        deleted += done
+    print(f"[INFO] Deleted {deleted} legacy objects")
+
+
+if __name__ == "__main__":
+    main()
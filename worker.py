@@ -1,12 +1,28 @@
+import os
 from flask import Flask, jsonify
-from app.routes.process import process_bp  # Handles actual image work
+from PIL import Image
+from app.routes.process import process_bp, run_job  # Handles actual image work
+from app.services import job_queue, s3, ddb, executor
+from app.utils.lazy import warm_up
+from app.utils import metrics
 
 print("[DEBUG] Starting worker service...")
 
 # --- Flask Setup ---
 app = Flask(__name__)
+metrics.init_app(app, "worker")
 app.register_blueprint(process_bp, url_prefix="/process")
 
+# --- Queue consumers ---
+# Only the API's async mode puts jobs on the queue
+PROCESS_MODE = os.environ.get("PROCESS_MODE", "sync")
+JOB_WORKERS = int(os.environ.get("JOB_WORKERS", 2))
+if PROCESS_MODE == "async" and JOB_WORKERS > 0:
+    job_queue.start_workers(run_job, JOB_WORKERS)
+
+# --- Background warm-up ---
+warm_up(s3.client, s3.bucket, ddb.results_table, Image.init, executor.get_pool)
+
 # --- Health Check ---
 @app.route("/")
 def health():